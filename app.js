@@ -1208,6 +1208,24 @@ async function downloadMaterial(button, materialId) {
 // Make sure it's still globally accessible
 window.downloadMaterial = downloadMaterial;
 
+// Paged list endpoints (/user/test-attempts, /doubts) return up to one page
+// plus a nextCursor; this follows the cursors and returns every item
+async function fetchAllPages(makeAuthenticatedRequest, endpoint) {
+    const items = [];
+    let cursor = null;
+    do {
+        const separator = endpoint.includes('?') ? '&' : '?';
+        const url = cursor ? `${endpoint}${separator}cursor=${encodeURIComponent(cursor)}` : endpoint;
+        const response = await makeAuthenticatedRequest(url);
+        if (!response.success || !Array.isArray(response.data)) {
+            return { success: false, error: response.error, data: items };
+        }
+        items.push(...response.data);
+        cursor = response.nextCursor;
+    } while (cursor);
+    return { success: true, data: items };
+}
+
 async function loadTests() {
     const testsContainer = document.getElementById('testsContainer');
     const subjectCards = {
@@ -1237,7 +1255,7 @@ async function loadTests() {
         const { makeAuthenticatedRequest } = await import('./auth.js');
 
         // ✅ FEATURE 1: Fetch user's attempts to check which tests are attempted
-        const attemptsResponse = await makeAuthenticatedRequest('/user/test-attempts');
+        const attemptsResponse = await fetchAllPages(makeAuthenticatedRequest, '/user/test-attempts');
         const userAttempts = attemptsResponse.success ? attemptsResponse.data : [];
         const attemptedTestIds = userAttempts.map(a => a.testId);
 
@@ -3448,7 +3466,7 @@ async function loadDoubts() {
         const { makeAuthenticatedRequest } = await import('./auth.js');
 
         // --- Fetch doubts using your backend API ---
-        const response = await makeAuthenticatedRequest('/doubts'); // Use your student backend route
+        const response = await fetchAllPages(makeAuthenticatedRequest, '/doubts'); // Use your student backend route
 
         if (!response.success || !Array.isArray(response.data)) {
              throw new Error(response.error || 'Failed to load doubts or invalid data format');
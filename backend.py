@@ -3,7 +3,7 @@ GeoCatalyst Backend Server
 Flask + Firebase Admin SDK + Razorpay + Cloudflare Stream
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g, has_app_context, stream_with_context
 from flask_cors import CORS
 from functools import wraps
 import firebase_admin
@@ -11,11 +11,33 @@ from firebase_admin import credentials, auth, firestore, storage
 import razorpay
 import requests
 import os
-from datetime import datetime, timedelta
-from functools import wraps
+from datetime import datetime, timedelta, timezone
+from functools import wraps, partial
 import hmac
 import hashlib
 import json
+import gzip
+import base64
+import random
+import sys
+import copy
+import queue
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import threading
+import time
+import bisect
+import click
+import contextvars
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from google.api_core.exceptions import AlreadyExists, NotFound
+try:
+    import brotli  # optional: Content-Encoding: br when installed
+except ImportError:
+    brotli = None
 
 # ============================================
 # FLASK APP INITIALIZATION
@@ -55,6 +77,88 @@ RAZORPAY_KEY_SECRET = os.environ.get('RAZORPAY_KEY_SECRET', 'your_razorpay_key_s
 CLOUDFLARE_ACCOUNT_ID = os.environ.get('CLOUDFLARE_ACCOUNT_ID', 'your_account_id')
 CLOUDFLARE_API_TOKEN = os.environ.get('CLOUDFLARE_API_TOKEN', 'your_api_token')
 
+# Leaderboard user-name cache (names rarely change, so a long TTL is fine)
+USER_NAME_CACHE_TTL = int(os.environ.get('USER_NAME_CACHE_TTL', 600))  # seconds
+USER_NAME_BATCH_SIZE = 100  # documents per db.get_all() round-trip
+
+# User document cache (per worker; other workers may serve a copy up to this old)
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 30))  # seconds
+
+# Verified ID-token cache (entries live until the token's own `exp`)
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+TOKEN_CHECK_REVOKED = os.environ.get('TOKEN_CHECK_REVOKED', 'false').lower() == 'true'
+TOKEN_REVOCATION_RECHECK = int(os.environ.get('TOKEN_REVOCATION_RECHECK', 300))  # seconds
+
+# Content catalog cache (courses, lectures, materials, active tests)
+CATALOG_REFRESH_SECONDS = int(os.environ.get('CATALOG_REFRESH_SECONDS', 60))
+
+# Test index (testIndex/<n>) is rebuilt from `tests` once older than this; 0 disables it
+TEST_INDEX_MAX_AGE = int(os.environ.get('TEST_INDEX_MAX_AGE', 300))  # seconds
+# How long the worker that claimed a stale index has to rebuild it before another may try
+TEST_INDEX_LEASE_SECONDS = int(os.environ.get('TEST_INDEX_LEASE_SECONDS', 60))
+
+# Compiled answer keys, one per test version (the TTL only bounds memory)
+ANSWER_KEY_TTL = int(os.environ.get('ANSWER_KEY_TTL', 300))  # seconds
+
+# Question banks (questionBanks/<hash>) kept in memory, with their student and review views
+QUESTION_BANK_CACHE_SIZE = int(os.environ.get('QUESTION_BANK_CACHE_SIZE', 256))
+
+# Post-submission pipeline (user stats + leaderboard updates off the request thread)
+POST_SUBMISSION_ASYNC = os.environ.get('POST_SUBMISSION_ASYNC', 'true').lower() == 'true'
+POST_SUBMISSION_WORKERS = int(os.environ.get('POST_SUBMISSION_WORKERS', 2))
+POST_SUBMISSION_RETRIES = 3
+
+# Test attempts live at testAttempts/<userId>_<testId>. Older attempts have random
+# IDs and are still found by query until `flask migrate-attempt-ids` has run.
+LEGACY_ATTEMPT_LOOKUP = os.environ.get('LEGACY_ATTEMPT_LOOKUP', 'true').lower() == 'true'
+
+# Independent Firestore reads within one request run concurrently on this pool
+FETCH_WORKERS = int(os.environ.get('FETCH_WORKERS', 8))
+
+# Material downloads: signed URLs are valid for SIGNED_URL_MINUTES and handed out
+# again until SIGNED_URL_MIN_REMAINING seconds before they expire
+SIGNED_URL_MINUTES = 15
+SIGNED_URL_MIN_REMAINING = int(os.environ.get('SIGNED_URL_MIN_REMAINING', 120))
+BLOB_EXISTS_TTL = int(os.environ.get('BLOB_EXISTS_TTL', 3600))  # seconds
+# Download counts shown in the materials listing are re-summed from their shards this often
+DOWNLOAD_COUNTS_TTL = int(os.environ.get('DOWNLOAD_COUNTS_TTL', 600))  # seconds
+
+# Buffered counter/progress writes are flushed in batches this often (and at exit)
+WRITE_BUFFER_INTERVAL = float(os.environ.get('WRITE_BUFFER_INTERVAL', 10))  # seconds
+
+# Sharded counters: shard documents per counted document (more shards, more write throughput)
+COUNTER_SHARDS = int(os.environ.get('COUNTER_SHARDS', 10))
+
+# gzip/brotli response compression (turn off when a proxy in front already compresses)
+RESPONSE_COMPRESSION = os.environ.get('RESPONSE_COMPRESSION', 'true').lower() == 'true'
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+
+# Shared secret for internal/ops endpoints (disabled when unset)
+INTERNAL_METRICS_TOKEN = os.environ.get('INTERNAL_METRICS_TOKEN')
+
+# Request instrumentation (per-endpoint timings and Firestore call counts)
+SERVER_TIMING_HEADER = os.environ.get('SERVER_TIMING_HEADER', 'true').lower() == 'true'
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 1.0))
+
+# Leaderboard pagination
+LEADERBOARD_PAGE_SIZE = int(os.environ.get('LEADERBOARD_PAGE_SIZE', 50))
+LEADERBOARD_MAX_PAGE_SIZE = 200
+
+# Leaderboard snapshots keep the top LEADERBOARD_TOP_K attempts; header stats
+# (attempt count, average) are re-counted at most every LEADERBOARD_STATS_TTL
+LEADERBOARD_TOP_K = int(os.environ.get('LEADERBOARD_TOP_K', 100))
+LEADERBOARD_STATS_TTL = int(os.environ.get('LEADERBOARD_STATS_TTL', 30))  # seconds
+
+# Per-user list pagination (test attempts, doubts, grants)
+LIST_PAGE_SIZE = int(os.environ.get('LIST_PAGE_SIZE', 50))
+LIST_MAX_PAGE_SIZE = 200
+
+# Logging: LOG_LEVEL applies to every logger, LOG_LEVELS overrides single ones,
+# e.g. LOG_LEVELS="geocatalyst.tests=DEBUG,geocatalyst.cache=WARNING"
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.environ.get('LOG_LEVELS', '')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')  # 'json' or 'text'
+
 # Course Pricing (matching frontend exactly)
 COURSE_PRICES = {
     'Remote Sensing': 1000,
@@ -68,6 +172,101 @@ COURSE_PRICES = {
     'Master Package': 5499
 }
 
+# ============================================
+# LOGGING
+# ============================================
+# Request threads only put records on a queue; a listener thread formats them
+# (one JSON object per line by default) and writes them to stdout. Each area of
+# the app logs through its own child of the 'geocatalyst' logger so its level
+# can be tuned with LOG_LEVELS.
+
+log = logging.getLogger('geocatalyst')
+auth_log = log.getChild('auth')
+cache_log = log.getChild('cache')
+materials_log = log.getChild('materials')
+tests_log = log.getChild('tests')
+attempts_log = log.getChild('attempts')
+leaderboard_log = log.getChild('leaderboard')
+doubts_log = log.getChild('doubts')
+writes_log = log.getChild('writes')
+http_log = log.getChild('http')
+
+# Attributes every LogRecord has; anything else came in through `extra=`
+_LOG_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record; `extra=` fields become top-level keys."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _LOG_RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class _DeferredFormatQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # Merge args and render the traceback now (they may reference objects that
+        # change after the request); JSON/text formatting happens on the listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def parse_log_levels(spec):
+    """'geocatalyst.tests=DEBUG,geocatalyst.cache=WARNING' -> {name: level}"""
+    levels = {}
+    for item in spec.split(','):
+        name, _, level = item.strip().partition('=')
+        if name and level:
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+_log_queue = queue.SimpleQueue()
+_log_listener = None
+
+def _start_log_listener():
+    global _log_listener
+    if LOG_FORMAT == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(formatter)
+    _log_listener = QueueListener(_log_queue, stream_handler)
+    _log_listener.start()
+
+def _stop_log_listener():
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()  # drains the queue
+        _log_listener = None
+
+def setup_logging():
+    log.setLevel(LOG_LEVEL)
+    log.handlers[:] = [_DeferredFormatQueueHandler(_log_queue)]
+    log.propagate = False
+    for name, level in parse_log_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+    _start_log_listener()
+    atexit.register(_stop_log_listener)
+    # The listener thread does not survive a fork (gunicorn --preload)
+    os.register_at_fork(after_in_child=_start_log_listener)
+
+setup_logging()
+
 # ============================================
 # FIREBASE INITIALIZATION
 # ============================================
@@ -81,12 +280,12 @@ try:
         import json
         credentials_dict = json.loads(FIREBASE_CREDENTIALS)
         cred = credentials.Certificate(credentials_dict)
-        print("✅ Using Firebase credentials from environment variable")
+        log.info("Using Firebase credentials from environment variable")
     else:
         # Development: Credentials are in file
         FIREBASE_CREDENTIALS_PATH = os.environ.get('FIREBASE_CREDENTIALS_PATH', 'firebase-admin-key.json')
         cred = credentials.Certificate(FIREBASE_CREDENTIALS_PATH)
-        print(f"✅ Using Firebase credentials from file: {FIREBASE_CREDENTIALS_PATH}")
+        log.info("Using Firebase credentials from file: %s", FIREBASE_CREDENTIALS_PATH)
     
     # Initialize Firebase with the credentials
     firebase_admin.initialize_app(cred, {
@@ -94,27 +293,1273 @@ try:
     })
     db = firestore.client()
     bucket = storage.bucket()
-    print("✅ Firebase Admin SDK initialized successfully")
+    log.info("Firebase Admin SDK initialized successfully")
 except Exception as e:
-    print(f"⚠️ Firebase initialization error: {e}")
+    log.warning("Firebase initialization error: %s", e)
     db = None
     bucket = None
 
+# ============================================
+# REQUEST METRICS
+# ============================================
+# Every Firestore RPC goes through the client's GAPIC stub, which is wrapped
+# below, so each request knows how many read, query and write RPCs it issued
+# and how many documents they touched. after_request folds that into
+# per-endpoint totals for this worker (served at /metrics in Prometheus text
+# format) and reports it to the browser in a Server-Timing header. Work done
+# outside a request (post-submission jobs, cache refreshes, CLI commands) is
+# counted under the "background" route.
+#
+# The stub is swapped in through the client's private `_firestore_api_internal`
+# attribute, present in google-cloud-firestore 2.x (pinned in requirements.txt,
+# checked with 2.34). If an upgrade drops it, instrument_firestore_client logs
+# a warning and requests report no Firestore calls.
+
+# RPC name -> counter it feeds; RPCs mapped to None only count towards `rpcs`
+FIRESTORE_RPCS = {
+    'batch_get_documents': 'reads',
+    'run_query': 'queries',
+    'run_aggregation_query': 'queries',
+    'list_documents': 'queries',
+    'list_collection_ids': 'queries',
+    'commit': 'writes',
+    'batch_write': 'writes',
+    'begin_transaction': None,
+    'rollback': None,
+}
+
+# Server-streaming RPCs, and the field that marks a streamed response as carrying a document
+_FIRESTORE_STREAMING_RPCS = ('batch_get_documents', 'run_query', 'run_aggregation_query')
+_FIRESTORE_DOC_FIELDS = {'batch_get_documents': 'found', 'run_query': 'document'}
+
+class FirestoreCallStats:
+    """Firestore work done on behalf of one request (or of background jobs)."""
+
+    FIELDS = ('rpcs', 'reads', 'queries', 'writes', 'docs', 'seconds')
+
+    def __init__(self):
+        self.rpcs = self.reads = self.queries = self.writes = self.docs = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, kind, seconds, docs=0, writes=0):
+        with self._lock:
+            self.rpcs += 1
+            if kind == 'reads':
+                self.reads += 1
+            elif kind == 'queries':
+                self.queries += 1
+            self.writes += writes
+            self.docs += docs
+            self.seconds += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {field: getattr(self, field) for field in self.FIELDS}
+
+
+background_firestore_stats = FirestoreCallStats()
+
+def current_firestore_stats():
+    if has_app_context():
+        stats = g.get('firestore_stats')
+        if stats is not None:
+            return stats
+    return background_firestore_stats
+
+def _written_documents(request_pb):
+    writes = request_pb.get('writes') if isinstance(request_pb, dict) else getattr(request_pb, 'writes', None)
+    return len(writes or ())
+
+class InstrumentedFirestoreApi:
+    """Wraps firestore.Client's GAPIC stub and records every RPC it makes."""
+
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if name not in FIRESTORE_RPCS:
+            return attr
+        return partial(self._call, name, attr)
+
+    def _call(self, name, method, *args, **kwargs):
+        stats = current_firestore_stats()
+        kind = FIRESTORE_RPCS[name]
+        start = time.perf_counter()
+        writes = 0
+        streamed = False
+        try:
+            response = method(*args, **kwargs)
+            if name in _FIRESTORE_STREAMING_RPCS:
+                streamed = True  # recorded by _stream once consumed
+                return self._stream(response, stats, kind, start, _FIRESTORE_DOC_FIELDS.get(name))
+            if kind == 'writes':
+                writes = _written_documents(kwargs.get('request'))
+            return response
+        finally:
+            # Failed RPCs are counted too (with no documents written)
+            if not streamed:
+                stats.record(kind, time.perf_counter() - start, writes=writes)
+
+    @staticmethod
+    def _stream(responses, stats, kind, start, doc_field):
+        # Server-streaming RPC: counted once the caller stops consuming it
+        # (the time therefore includes the caller's per-document work)
+        docs = 0
+        try:
+            for response in responses:
+                if doc_field and doc_field in response:
+                    docs += 1
+                yield response
+        finally:
+            stats.record(kind, time.perf_counter() - start, docs=docs)
+
+def instrument_firestore_client(client):
+    """Routes a firestore.Client's RPCs through InstrumentedFirestoreApi (private client API, see above)."""
+    api = getattr(client, '_firestore_api', None)  # creates the GAPIC stub lazily
+    if api is None or not hasattr(client, '_firestore_api_internal'):
+        log.warning("Firestore client %s has no GAPIC stub to instrument; Firestore call metrics are off",
+                    type(client).__name__)
+    elif not isinstance(api, InstrumentedFirestoreApi):
+        client._firestore_api_internal = InstrumentedFirestoreApi(api)
+    return client
+
+if db is not None:
+    instrument_firestore_client(db)
+
+
+def _prometheus_labels(labels):
+    return ','.join(f'{key}="{str(value)}"' for key, value in labels)
+
+class RequestMetrics:
+    """
+    Per-endpoint request counts, latency histograms and Firestore totals for
+    this worker process, rendered in the Prometheus text format.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._statuses = {}   # (method, route, status) -> count
+        self._latency = {}    # (method, route) -> [bucket counts..., sum, count]
+        self._firestore = {}  # (method, route) -> {field: total}
+
+    def observe(self, method, route, status, seconds, firestore_calls):
+        key = (method, route)
+        with self._lock:
+            status_key = (method, route, status)
+            self._statuses[status_key] = self._statuses.get(status_key, 0) + 1
+            latency = self._latency.setdefault(key, [0] * len(self.BUCKETS) + [0.0, 0])
+            for bucket in range(bisect.bisect_left(self.BUCKETS, seconds), len(self.BUCKETS)):
+                latency[bucket] += 1  # buckets are cumulative (le = less or equal)
+            latency[-2] += seconds
+            latency[-1] += 1
+            self._add_firestore(key, firestore_calls)
+
+    def _add_firestore(self, key, firestore_calls):
+        totals = self._firestore.setdefault(key, dict.fromkeys(FirestoreCallStats.FIELDS, 0))
+        for field in FirestoreCallStats.FIELDS:
+            totals[field] += firestore_calls[field]
+
+    def render(self):
+        with self._lock:
+            statuses = dict(self._statuses)
+            latency = {key: list(values) for key, values in self._latency.items()}
+            firestore_totals = {key: dict(values) for key, values in self._firestore.items()}
+        background = background_firestore_stats.snapshot()
+        if background['rpcs']:
+            firestore_totals[('', 'background')] = background
+
+        lines = [
+            '# HELP geocatalyst_http_requests_total Requests handled, by route and status.',
+            '# TYPE geocatalyst_http_requests_total counter',
+        ]
+        for (method, route, status), count in sorted(statuses.items()):
+            labels = _prometheus_labels([('method', method), ('route', route), ('status', status)])
+            lines.append(f'geocatalyst_http_requests_total{{{labels}}} {count}')
+
+        lines += [
+            '# HELP geocatalyst_http_request_duration_seconds Time spent in the view, by route.',
+            '# TYPE geocatalyst_http_request_duration_seconds histogram',
+        ]
+        for (method, route), values in sorted(latency.items()):
+            base = [('method', method), ('route', route)]
+            for bound, count in zip(self.BUCKETS, values):
+                labels = _prometheus_labels(base + [('le', bound)])
+                lines.append(f'geocatalyst_http_request_duration_seconds_bucket{{{labels}}} {count}')
+            labels = _prometheus_labels(base + [('le', '+Inf')])
+            lines.append(f'geocatalyst_http_request_duration_seconds_bucket{{{labels}}} {values[-1]}')
+            labels = _prometheus_labels(base)
+            lines.append(f'geocatalyst_http_request_duration_seconds_sum{{{labels}}} {values[-2]:.6f}')
+            lines.append(f'geocatalyst_http_request_duration_seconds_count{{{labels}}} {values[-1]}')
+
+        firestore_series = [
+            ('rpcs', 'geocatalyst_firestore_rpcs_total', 'Firestore RPCs issued.'),
+            ('reads', 'geocatalyst_firestore_read_rpcs_total', 'Document get / get_all RPCs.'),
+            ('queries', 'geocatalyst_firestore_query_rpcs_total', 'Query and aggregation RPCs.'),
+            ('writes', 'geocatalyst_firestore_documents_written_total', 'Documents written by commits.'),
+            ('docs', 'geocatalyst_firestore_documents_read_total', 'Documents returned by reads and queries.'),
+            ('seconds', 'geocatalyst_firestore_seconds_total', 'Wall time spent in Firestore RPCs.'),
+        ]
+        for field, name, help_text in firestore_series:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            for (method, route), totals in sorted(firestore_totals.items()):
+                labels = _prometheus_labels([('method', method), ('route', route)])
+                value = f'{totals[field]:.6f}' if field == 'seconds' else totals[field]
+                lines.append(f'{name}{{{labels}}} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.firestore_stats = FirestoreCallStats()
+
+@app.after_request
+def finish_request_metrics(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    firestore_calls = g.firestore_stats.snapshot()
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    request_metrics.observe(request.method, route, response.status_code, elapsed, firestore_calls)
+
+    if SERVER_TIMING_HEADER:
+        # firestore;dur sums every RPC, so it exceeds app;dur when reads ran in parallel
+        response.headers['Server-Timing'] = (
+            f'app;dur={elapsed * 1000:.1f}, '
+            f'firestore;dur={firestore_calls["seconds"] * 1000:.1f};desc="{firestore_calls["reads"]} reads, '
+            f'{firestore_calls["queries"]} queries, {firestore_calls["writes"]} writes, '
+            f'{firestore_calls["docs"]} docs"'
+        )
+        origin = request.headers.get('Origin')
+        if origin in allowed_origins:
+            response.headers['Timing-Allow-Origin'] = origin
+
+    level = logging.WARNING if elapsed >= SLOW_REQUEST_SECONDS else logging.DEBUG
+    if http_log.isEnabledFor(level):
+        http_log.log(level, "%s %s -> %d in %.1fms (firestore: %d rpcs, %d docs, %.1fms)",
+                     request.method, route, response.status_code, elapsed * 1000,
+                     firestore_calls['rpcs'], firestore_calls['docs'], firestore_calls['seconds'] * 1000,
+                     extra={'route': route, 'durationMs': round(elapsed * 1000, 1), 'firestore': firestore_calls})
+    return response
+
 # ============================================
 # RAZORPAY INITIALIZATION
 # ============================================
 
 try:
     razorpay_client = razorpay.Client(auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET))
-    print("✅ Razorpay client initialized successfully")
+    log.info("Razorpay client initialized successfully")
 except Exception as e:
-    print(f"⚠️ Razorpay initialization error: {e}")
+    log.warning("Razorpay initialization error: %s", e)
     razorpay_client = None
 
+# ============================================
+# PARALLEL FETCH
+# ============================================
+# Handlers that need several independent documents issue the reads together,
+# so the request waits for the slowest round-trip instead of their sum. All
+# threads share the one Firestore client. Tasks run in a copy of the caller's
+# context, so flask.g and request work as they do in the handler and
+# Firestore calls are counted against the request that issued them.
+
+fetch_executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix='fetch')
+_fetch_local = threading.local()
+
+def _run_fetch(context, fn, args, kwargs):
+    _fetch_local.in_pool = True
+    try:
+        return context.run(fn, *args, **kwargs)
+    finally:
+        _fetch_local.in_pool = False
+
+def submit_fetch(fn, *args, **kwargs):
+    """
+    Starts fn(*args, **kwargs) on the fetch pool and returns its Future.
+
+    Called from a fetch task, it runs fn inline instead, so nested fetches can't
+    exhaust the pool and deadlock.
+    """
+    if getattr(_fetch_local, 'in_pool', False):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+    return fetch_executor.submit(_run_fetch, contextvars.copy_context(), fn, args, kwargs)
+
+def parallel_fetch(*calls):
+    """
+    Runs the zero-argument callables concurrently and returns their results in
+    order. The first runs on the calling thread. If any raises, the first
+    exception (in argument order) propagates, as it would have sequentially.
+    """
+    futures = [submit_fetch(call) for call in calls[1:]]
+    first = calls[0]()
+    return [first] + [future.result() for future in futures]
+
+# ============================================
+# BUFFERED WRITES
+# ============================================
+# Download counts and video progress are written on every click/ping. Writing
+# each one makes the request wait for a commit and keeps hot documents (a
+# popular PDF) near Firestore's sustained write rate per document. Instead they
+# are coalesced per document in memory and written in batches every
+# WRITE_BUFFER_INTERVAL seconds, and once more when the worker exits.
+
+class WriteBuffer:
+    """
+    Pending increments, updates and merge-sets, keyed by document path.
+
+    Increments follow update() semantics (the document must exist) unless
+    `upsert` is set, which merges them into the document, creating it if needed.
+    Updates never create a document: one deleted before the flush is skipped.
+    Sets merge into the document and the latest value of each field wins. Only
+    for writes that may land a few seconds late, and may be lost if the process
+    is killed.
+    """
+
+    BATCH_LIMIT = 500  # Firestore's maximum writes per batch
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.flushed = 0
+        self.failed = 0
+        self._increments = {}  # path -> (ref, {field_path: amount}, upsert)
+        self._updates = {}     # path -> (ref, {field_path: value})
+        self._sets = {}        # path -> (ref, {field: value})
+        self._pid = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def increment(self, ref, field_path, amount=1, upsert=False):
+        with self._lock:
+            _, fields, _ = self._increments.setdefault(ref.path, (ref, {}, upsert))
+            fields[field_path] = fields.get(field_path, 0) + amount
+        self._ensure_flusher()
+
+    def update(self, ref, data):
+        with self._lock:
+            _, fields = self._updates.setdefault(ref.path, (ref, {}))
+            fields.update(data)
+        self._ensure_flusher()
+
+    def set(self, ref, data):
+        with self._lock:
+            _, fields = self._sets.setdefault(ref.path, (ref, {}))
+            fields.update(data)
+        self._ensure_flusher()
+
+    def flush(self):
+        """Writes everything pending now; returns the number of document writes."""
+        with self._flush_lock:
+            with self._lock:
+                increments, self._increments = self._increments, {}
+                updates, self._updates = self._updates, {}
+                sets, self._sets = self._sets, {}
+            writes = [('set' if upsert else 'update', ref,
+                       {field: firestore.Increment(amount) for field, amount in fields.items()})
+                      for ref, fields, upsert in increments.values()]
+            writes += [('update', ref, fields) for ref, fields in updates.values()]
+            writes += [('set', ref, fields) for ref, fields in sets.values()]
+            for start in range(0, len(writes), self.BATCH_LIMIT):
+                self._commit(writes[start:start + self.BATCH_LIMIT])
+            return len(writes)
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._increments) + len(self._updates) + len(self._sets)
+        return {'pending': pending, 'flushed': self.flushed, 'failed': self.failed}
+
+    def _commit(self, writes):
+        batch = db.batch()
+        for kind, ref, data in writes:
+            if kind == 'update':
+                batch.update(ref, data)
+            else:
+                batch.set(ref, data, merge=True)
+        try:
+            batch.commit()
+            self.flushed += len(writes)
+            return
+        except Exception as e:
+            writes_log.warning("Batched write of %d documents failed, writing them one by one: %s", len(writes), e)
+
+        # A batch is all-or-nothing, so one missing document would drop the rest
+        for kind, ref, data in writes:
+            try:
+                if kind == 'update':
+                    ref.update(data)
+                else:
+                    ref.set(data, merge=True)
+                self.flushed += 1
+            except NotFound:
+                writes_log.info("Skipped buffered update of deleted document %s", ref.path)
+            except Exception as e:
+                self.failed += 1
+                writes_log.warning("Dropped buffered write to %s: %s", ref.path, e)
+
+    def _ensure_flusher(self):
+        # The pid check restarts the flusher in forked workers (threads don't survive fork)
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._flush_loop, name='write-buffer', daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                writes_log.exception("Flushing buffered writes failed")
+
+
+write_buffer = WriteBuffer(interval=WRITE_BUFFER_INTERVAL)
+atexit.register(write_buffer.flush)
+
+# ============================================
+# SHARDED COUNTERS
+# ============================================
+# Aggregates that many requests bump at once (downloads of a popular PDF, a
+# live mock's attempt count) are split over COUNTER_SHARDS shard documents in
+# a subcollection of the counted document. Each increment goes to a random
+# shard, so concurrent writers rarely touch the same document. Totals are the
+# sum over the shards: read in bulk every DOWNLOAD_COUNTS_TTL for the materials
+# listing (downloads), or for one document at a time (a test's attempt totals).
+
+class ShardedCounter:
+    """Counters for the documents of one collection, at <collection>/<id>/<shards_collection>/<n>."""
+
+    def __init__(self, collection, shards_collection, shards=COUNTER_SHARDS):
+        self.collection = collection
+        self.shards_collection = shards_collection
+        self.shards = shards
+
+    def shard_ref(self, doc_id):
+        return db.collection(self.collection).document(doc_id) \
+            .collection(self.shards_collection).document(str(random.randrange(self.shards)))
+
+    def increment(self, doc_id, amounts, transaction=None):
+        """
+        Adds {field: amount} to a random shard: inside `transaction` when given,
+        otherwise with the next buffered flush.
+        """
+        shard_ref = self.shard_ref(doc_id)
+        if transaction is not None:
+            transaction.set(shard_ref, {field: firestore.Increment(amount) for field, amount in amounts.items()},
+                            merge=True)
+            return
+        for field, amount in amounts.items():
+            write_buffer.increment(shard_ref, field, amount, upsert=True)
+
+    def total(self, doc_id):
+        """{field: total} for one document (reads its shards)."""
+        totals = {}
+        shards = db.collection(self.collection).document(doc_id).collection(self.shards_collection)
+        for shard in shards.stream():
+            for field, value in (shard.to_dict() or {}).items():
+                if isinstance(value, (int, float)):
+                    totals[field] = totals.get(field, 0) + value
+        return totals
+
+    def totals(self):
+        """{doc_id: {field: total}} for every counted document (one collection-group query)."""
+        totals = {}
+        for shard in db.collection_group(self.shards_collection).stream():
+            doc_ref = shard.reference.parent.parent
+            if doc_ref is None or doc_ref.parent.id != self.collection:
+                continue
+            doc_totals = totals.setdefault(doc_ref.id, {})
+            for field, value in (shard.to_dict() or {}).items():
+                if isinstance(value, (int, float)):
+                    doc_totals[field] = doc_totals.get(field, 0) + value
+        return totals
+
+
+material_counters = ShardedCounter('materials', 'downloadCounterShards')  # downloads
+test_counters = ShardedCounter('tests', 'attemptCounterShards')  # attempts, scoreSum, percentageSum
+
+# ============================================
+# IN-PROCESS CACHES
+# ============================================
+
+_MISSING = object()
+
+class TTLCache:
+    """
+    Small thread-safe LRU cache whose entries expire after `ttl` seconds.
+
+    Each gunicorn worker holds its own copy, so entries must be safe to serve
+    slightly stale (bounded by the TTL).
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
+
+
+user_name_cache = TTLCache(maxsize=20000, ttl=USER_NAME_CACHE_TTL)
+
+def resolve_user_names(user_ids):
+    """
+    Maps each user ID to its display name ('Anonymous' if unknown).
+
+    Names come from the process-wide cache first; the rest are fetched with
+    chunked db.get_all() calls, so the cost depends on the number of chunks
+    rather than the number of IDs.
+    """
+    names = {}
+    missing = []
+    for uid in dict.fromkeys(user_ids):  # de-duplicate, keep order
+        if not uid:
+            continue
+        name = user_name_cache.get(uid)
+        if name is None:
+            missing.append(uid)
+        else:
+            names[uid] = name
+
+    users_ref = db.collection('users') if missing else None
+    for start in range(0, len(missing), USER_NAME_BATCH_SIZE):
+        chunk = missing[start:start + USER_NAME_BATCH_SIZE]
+        try:
+            refs = [users_ref.document(uid) for uid in chunk]
+            for snap in db.get_all(refs, field_paths=['name']):
+                name = snap.to_dict().get('name', 'Anonymous') if snap.exists else 'Anonymous'
+                user_name_cache.set(snap.id, name)
+                names[snap.id] = name
+        except Exception as e:
+            cache_log.warning("Failed to resolve %d user names: %s", len(chunk), e)
+
+    return {uid: names.get(uid, 'Anonymous') for uid in user_ids if uid}
+
+
+user_doc_cache = TTLCache(maxsize=5000, ttl=USER_CACHE_TTL)
+
+def get_user_data(user_id):
+    """
+    Returns the users/<uid> document as a dict, or None if it doesn't exist.
+
+    Two cache levels: a per-request memo on flask.g, then the process-wide
+    user_doc_cache. Treat the result as read-only; it is shared.
+    """
+    memo = g.setdefault('user_docs', {}) if has_app_context() else None
+    if memo is not None and user_id in memo:
+        return memo[user_id]
+
+    user_data = user_doc_cache.get(user_id, _MISSING)
+    if user_data is _MISSING:
+        user_doc = db.collection('users').document(user_id).get()
+        user_data = user_doc.to_dict() if user_doc.exists else None
+        user_doc_cache.set(user_id, user_data)
+
+    if memo is not None:
+        memo[user_id] = user_data
+    return user_data
+
+def invalidate_user_data(user_id):
+    """Drops cached copies of a user's document after we write to it."""
+    user_doc_cache.pop(user_id)
+    user_name_cache.pop(user_id)
+    if has_app_context():
+        g.get('user_docs', {}).pop(user_id, None)
+
+# ============================================
+# CONTENT CATALOG CACHE
+# ============================================
+
+def _content_version(value):
+    """Short content hash used as a version stamp."""
+    raw = json.dumps(value, sort_keys=True, default=str).encode()
+    return hashlib.sha1(raw).hexdigest()[:16]
+
+# Test fields /api/tests serves (the tests section's version covers only these)
+TEST_LISTING_FIELDS = ('id', 'name', 'subject', 'type', 'duration', 'questionCount', 'totalMarks', 'access')
+
+# Test fields the catalog keeps (everything the listing and access checks read)
+CATALOG_TEST_FIELDS = ['name', 'subject', 'type', 'duration', 'totalMarks', 'access', 'isActive',
+                       'questionCount', 'createdAt']
+
+def question_count(test_data):
+    """
+    Number of questions of a test document: len(questions), or the count of its
+    question bank when the questions were moved there (None if that bank is missing).
+    """
+    if 'questions' not in test_data and test_data.get('questionBankId'):
+        bank = load_question_bank(test_data['questionBankId'])
+        return bank.count if bank is not None else None
+    return len(test_data.get('questions') or [])
+
+def sync_question_count(test_ref, test_data, count):
+    """
+    Keeps tests/<id>.questionCount equal to `count`, the number of questions
+    actually served for the test. Called when the test index publishes the
+    test's questions; a stale or missing count is rewritten with the next
+    buffered flush (as an update, so a test deleted in the meantime is not recreated).
+    """
+    if test_data.get('questionCount') != count:
+        write_buffer.update(test_ref, {'questionCount': count})
+
+def load_active_tests():
+    """Metadata of every active test, read from `tests` (the field mask keeps question arrays out)."""
+    tests = []
+    active_tests = db.collection('tests').where('isActive', '==', True).select(CATALOG_TEST_FIELDS)
+    for doc in active_tests.stream():
+        test_data = doc.to_dict()
+        test_data['id'] = doc.id
+        test_data['updateTime'] = doc.update_time
+        tests.append(test_data)
+
+    # Tests saved before questionCount existed (see `flask backfill-question-counts`)
+    uncounted = [test for test in tests if 'questionCount' not in test]
+    if uncounted:
+        cache_log.info("%d active tests have no questionCount; reading their questions", len(uncounted))
+        refs = [db.collection('tests').document(test['id']) for test in uncounted]
+        counts = {snap.id: question_count(snap.to_dict() or {})
+                  for snap in db.get_all(refs, field_paths=['questions', 'questionBankId'])}
+        for test in uncounted:
+            test['questionCount'] = counts.get(test['id']) or 0
+    return tests
+
+# The test index: one compact row per active test, stored in testIndex/<n>
+# shards of up to TEST_INDEX_SHARD_ROWS rows, so the catalog reads a document
+# or two instead of scanning `tests`. Tests are edited from the admin panel, so
+# the index is rebuilt by `flask sync-test-index` or
+# POST /api/internal/test-index/sync (and /api/internal/catalog/refresh), and
+# once it is older than TEST_INDEX_MAX_AGE by the one worker whose catalog
+# refresh claims the rebuild lease (leases/testIndex). Until it is fresh again
+# the other workers read `tests` directly.
+TEST_INDEX_FIELDS = ('id', 'name', 'subject', 'type', 'duration', 'questionCount', 'totalMarks', 'access',
+                     'updateTime', 'questionBankId')
+TEST_INDEX_SHARD_ROWS = 2000  # ~200 bytes a row, far below the 1 MiB document limit
+
+def read_test_index(max_age=TEST_INDEX_MAX_AGE):
+    """The index rows, or None if the index is missing, incomplete or older than max_age (None: any age)."""
+    if max_age is not None and max_age <= 0:
+        return None
+    shards = sorted((doc.to_dict() for doc in db.collection('testIndex').stream()), key=lambda d: d.get('shard', 0))
+    if not shards or len(shards) != shards[0].get('shardCount'):
+        return None
+    built_at = shards[0].get('builtAt')
+    if max_age is not None and (built_at is None or (datetime.now(timezone.utc) - built_at).total_seconds() > max_age):
+        return None
+    return [dict(row) for shard in shards for row in shard.get('tests', [])]
+
+def sync_test_index():
+    """Rebuilds the test index from `tests` in one atomic batch; returns the rows."""
+    tests = load_active_tests()
+
+    # Question banks: carried over for tests unchanged since the last build, published for the rest
+    previous = {row['id']: row for row in read_test_index(max_age=None) or []}
+    for test in tests:
+        row = previous.get(test['id'])
+        if row and row.get('questionBankId') and row.get('updateTime') == test['updateTime']:
+            test['questionBankId'] = row['questionBankId']
+    published = publish_question_banks([test['id'] for test in tests if not test.get('questionBankId')])
+    tests_by_id = {test['id']: test for test in tests}
+    for test_id, (bank_id, version, count) in published.items():
+        test = tests_by_id[test_id]
+        # Only valid for the version that was hashed; an edit since the query waits for the next build
+        if version == test['updateTime']:
+            test['questionBankId'] = bank_id
+            test['questionCount'] = count
+
+    rows = [{field: test.get(field) for field in TEST_INDEX_FIELDS} for test in tests]
+    chunks = [rows[i:i + TEST_INDEX_SHARD_ROWS] for i in range(0, len(rows), TEST_INDEX_SHARD_ROWS)] or [[]]
+    built_at = datetime.now(timezone.utc)
+
+    index_ref = db.collection('testIndex')
+    batch = db.batch()
+    for shard, chunk in enumerate(chunks):
+        batch.set(index_ref.document(str(shard)), {
+            'shard': shard, 'shardCount': len(chunks), 'builtAt': built_at, 'tests': chunk
+        })
+    for doc_ref in index_ref.list_documents():
+        if not doc_ref.id.isdigit() or int(doc_ref.id) >= len(chunks):
+            batch.delete(doc_ref)
+    batch.commit()
+    cache_log.info("Rebuilt test index: %d active tests in %d shards", len(rows), len(chunks))
+    return rows
+
+@firestore.transactional
+def _claim_lease(transaction, lease_ref, seconds):
+    snapshot = lease_ref.get(transaction=transaction)
+    now = datetime.now(timezone.utc)
+    expires_at = (snapshot.to_dict() or {}).get('expiresAt') if snapshot.exists else None
+    if expires_at is not None and expires_at > now:
+        return False
+    transaction.set(lease_ref, {'holder': os.getpid(), 'expiresAt': now + timedelta(seconds=seconds)})
+    return True
+
+def load_catalog_tests():
+    """
+    Active test rows for the catalog: the test index while it is fresh. A stale
+    index is rebuilt by the worker holding the lease; the others, and a failed
+    rebuild, fall back to reading `tests`.
+    """
+    if TEST_INDEX_MAX_AGE <= 0:
+        return load_active_tests()
+    tests = read_test_index()
+    if tests is not None:
+        return tests
+    try:
+        lease_ref = db.collection('leases').document('testIndex')
+        if _claim_lease(db.transaction(), lease_ref, TEST_INDEX_LEASE_SECONDS):
+            return sync_test_index()
+    except Exception as e:
+        cache_log.warning("Could not rebuild the test index, reading tests directly: %s", e)
+    return load_active_tests()
+
+def load_catalog():
+    """Reads the whole content catalog from Firestore (a handful of collection scans)."""
+    courses = [dict(doc.to_dict(), id=doc.id) for doc in db.collection('courses').stream()]
+
+    # All courses/<id>/lectures in one collection-group scan, sorted like order_by('order')
+    lectures = {}
+    for doc in db.collection_group('lectures').stream():
+        course_ref = doc.reference.parent.parent
+        if course_ref is None or course_ref.parent.id != 'courses':
+            continue
+        lecture_data = doc.to_dict()
+        if 'order' not in lecture_data:
+            continue
+        lecture_data['id'] = doc.id
+        lectures.setdefault(course_ref.id, []).append(lecture_data)
+    for course_lectures in lectures.values():
+        course_lectures.sort(key=lambda lecture: lecture['order'])
+
+    # Download counts on counter shards are added by get_study_materials (see get_download_counts)
+    materials = [dict(doc.to_dict(), id=doc.id) for doc in db.collection('materials').stream()]
+
+    # Active tests from the test index (a document or two), else straight from `tests`
+    tests = load_catalog_tests()
+
+    return {
+        'courses': courses,
+        'lectures': lectures,
+        'materials': materials,
+        'tests': tests,
+        'testsById': {test['id']: test for test in tests}
+    }
+
+class CatalogCache:
+    """
+    In-process copy of the content catalog: courses, lectures, materials and
+    active tests metadata.
+
+    These collections only change when an admin edits content, so each worker
+    loads them on first use and re-reads them on a background thread every
+    `refresh_seconds`. Each section carries a version stamp (content hash) that
+    only changes when its data does; section() returns both from the same load.
+    Returned data is shared: copy before adding per-user fields.
+    """
+
+    SECTIONS = ('courses', 'lectures', 'materials', 'tests')
+    # Fields a section's version covers, where the endpoints serve only some of them
+    VERSIONED_FIELDS = {'tests': TEST_LISTING_FIELDS}
+
+    def __init__(self, refresh_seconds=60):
+        self.refresh_seconds = refresh_seconds
+        self.refreshed_at = None
+        self._state = None  # (data, versions), replaced as a whole by refresh()
+        self._pid = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def get(self, section):
+        self._ensure_loaded()
+        return self._state[0][section]
+
+    def section(self, section):
+        """(data, version) of a section, from the same load."""
+        self._ensure_loaded()
+        data, versions = self._state
+        return data[section], versions[section]
+
+    def refresh(self):
+        """Reloads every section now; keeps serving the old data if this fails."""
+        with self._refresh_lock:
+            data = load_catalog()
+            versions = {section: self._section_version(section, data[section]) for section in self.SECTIONS}
+            self._state = (data, versions)
+            self.refreshed_at = datetime.now()
+        return dict(versions)
+
+    def _section_version(self, section, rows):
+        fields = self.VERSIONED_FIELDS.get(section)
+        if fields is not None:
+            rows = [{field: row.get(field) for field in fields} for row in rows]
+        return _content_version(rows)
+
+    def stats(self):
+        return {
+            'loaded': self._state is not None,
+            'refreshedAt': self.refreshed_at.isoformat() if self.refreshed_at else None,
+            'versions': dict(self._state[1]) if self._state else {}
+        }
+
+    def _ensure_loaded(self):
+        # The pid check restarts the refresher in forked workers (threads don't survive fork)
+        if self._state is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._state is None:
+                self.refresh()
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._refresh_loop, name='catalog-refresh', daemon=True).start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_seconds)
+            try:
+                self.refresh()
+            except Exception as e:
+                cache_log.warning("Catalog refresh failed, serving previous data: %s", e)
+
+
+catalog_cache = CatalogCache(refresh_seconds=CATALOG_REFRESH_SECONDS)
+
+# ============================================
+# QUESTION BANKS
+# ============================================
+# A test's questions are published to questionBanks/<id>, apart from the test
+# metadata. The ID is a hash of the questions, so a bank never changes: editing
+# the questions produces a new bank, and tests with identical questions share
+# one. Each bank is turned into the views the API serves once per process and
+# cached by ID:
+#   student_questions  answers and solutions stripped (test delivery)
+#   review_questions   as stored (attempt review, answer keys)
+#
+# The admin panel still writes questions into tests/<id>. sync_test_index
+# publishes a bank for every test whose document changed and records its ID in
+# the test's index row, which is valid for that document version (updateTime)
+# only. A test without a current row is read in full once per version instead.
+
+# What a student sees of a question before submitting
+STUDENT_QUESTION_FIELDS = ('type', 'question', 'options', 'marks', 'negativeMarks', 'markValue', 'imageUrl')
+
+def question_bank_id(questions):
+    """Content address of a question list."""
+    raw = json.dumps(questions, sort_keys=True, separators=(',', ':'), default=str).encode()
+    return hashlib.sha256(raw).hexdigest()[:32]
+
+class QuestionBank:
+    """One version of a test's questions, with both views built up front. Shared: don't mutate."""
+
+    def __init__(self, bank_id, questions):
+        self.id = bank_id
+        self.count = len(questions)
+        self.review_questions = questions
+        self.student_questions = [{field: q.get(field) for field in STUDENT_QUESTION_FIELDS} for q in questions]
+
+
+# bank ID -> QuestionBank. Banks are immutable, so entries only leave to bound memory.
+question_bank_cache = TTLCache(maxsize=QUESTION_BANK_CACHE_SIZE, ttl=24 * 3600)
+# (test ID, document update time) -> QuestionBank
+test_version_banks = TTLCache(maxsize=QUESTION_BANK_CACHE_SIZE * 4, ttl=24 * 3600)
+
+def _cache_bank(bank_id, questions):
+    # Reuse the views already built for identical questions
+    bank = question_bank_cache.get(bank_id)
+    if bank is None:
+        bank = QuestionBank(bank_id, questions)
+        question_bank_cache.set(bank_id, bank)
+    return bank
+
+def load_question_bank(bank_id):
+    """The QuestionBank with this ID, or None if it was never published."""
+    bank = question_bank_cache.get(bank_id)
+    if bank is None:
+        bank_doc = db.collection('questionBanks').document(bank_id).get()
+        if not bank_doc.exists:
+            return None
+        bank = _cache_bank(bank_id, bank_doc.to_dict().get('questions') or [])
+    return bank
+
+def question_bank_for(test_id, update_time):
+    """
+    The QuestionBank of one version of a test (identified by its document's
+    update time). Resolved once per version: from the bank recorded in the test
+    index when the index has seen this version, else from the test document.
+    """
+    bank = test_version_banks.get((test_id, update_time))
+    if bank is not None:
+        return bank
+
+    catalog_test = catalog_cache.get('testsById').get(test_id)
+    if catalog_test and catalog_test.get('questionBankId') and catalog_test.get('updateTime') == update_time:
+        bank = load_question_bank(catalog_test['questionBankId'])
+
+    if bank is None:
+        test_doc = db.collection('tests').document(test_id).get()
+        test_data = test_doc.to_dict() or {}
+        moved_bank_id = test_data.get('questionBankId') if 'questions' not in test_data else None
+        if moved_bank_id:
+            # Questions moved out of the document entirely
+            bank = load_question_bank(moved_bank_id)
+            if bank is None:
+                cache_log.warning("Test %s refers to missing question bank %s", test_id, moved_bank_id)
+        if bank is None:
+            questions = test_data.get('questions') or []
+            bank = _cache_bank(question_bank_id(questions), questions)
+        update_time = test_doc.update_time or update_time
+
+    test_version_banks.set((test_id, update_time), bank)
+    return bank
+
+def read_test_version(test_id, field_paths):
+    """
+    Reads a test's metadata (only `field_paths`, never the questions) and the
+    QuestionBank of that version: (snapshot, bank), bank None if the test doesn't exist.
+    """
+    test_doc = db.collection('tests').document(test_id).get(field_paths=field_paths)
+    if not test_doc.exists:
+        return test_doc, None
+    return test_doc, question_bank_for(test_id, test_doc.update_time)
+
+def publish_question_banks(test_ids):
+    """
+    Publishes the current questions of each test as a bank, and repairs the
+    test's questionCount to match it. Returns {test_id: (bank_id, update time
+    of the test version that was hashed, question count)}; tests whose moved
+    bank is missing are left out.
+    """
+    refs = [db.collection('tests').document(test_id) for test_id in test_ids]
+    published = {}
+    new_banks = {}
+    for test_doc in (db.get_all(refs) if refs else []):
+        if not test_doc.exists:
+            continue
+        test_data = test_doc.to_dict()
+        if 'questions' not in test_data and test_data.get('questionBankId'):
+            bank = load_question_bank(test_data['questionBankId'])
+            if bank is None:
+                cache_log.warning("Test %s refers to missing question bank %s", test_doc.id, test_data['questionBankId'])
+                continue
+            bank_id, count = bank.id, bank.count
+        else:
+            questions = test_data.get('questions') or []
+            bank_id, count = question_bank_id(questions), len(questions)
+            new_banks[bank_id] = questions
+        published[test_doc.id] = (bank_id, test_doc.update_time, count)
+        sync_question_count(test_doc.reference, test_data, count)
+
+    banks_ref = db.collection('questionBanks')
+    if new_banks:
+        existing = {doc.id for doc in db.get_all([banks_ref.document(bank_id) for bank_id in new_banks],
+                                                 field_paths=['questionCount']) if doc.exists}
+        for bank_id, questions in new_banks.items():
+            if bank_id in existing:
+                continue
+            # One write per bank: a bank can be close to the 1 MiB document limit itself
+            banks_ref.document(bank_id).set({
+                'questions': questions, 'questionCount': len(questions), 'createdAt': datetime.now()
+            })
+            cache_log.info("Published question bank %s (%d questions)", bank_id, len(questions))
+    return published
+
+# ============================================
+# PAGINATION HELPERS
+# ============================================
+
+def encode_cursor(values):
+    """Packs sort-key values into an opaque, URL-safe cursor string."""
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor(). Raises ValueError for malformed cursors."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor')
+    return values
+
+def _cursor_value(value):
+    # Timestamps don't survive JSON; tag them so they decode back to datetimes
+    if isinstance(value, datetime):
+        return {'ts': value.isoformat()}
+    return value
+
+def _from_cursor_value(value):
+    """Inverse of _cursor_value(). Raises ValueError for anything it can't have produced."""
+    if isinstance(value, dict):
+        if set(value) != {'ts'} or not isinstance(value['ts'], str):
+            raise ValueError('Invalid cursor')
+        return datetime.fromisoformat(value['ts'])  # ValueError for a malformed timestamp
+    if isinstance(value, list):
+        raise ValueError('Invalid cursor')
+    return value
+
+class QueryPage:
+    """
+    One page of a Firestore query in a stable order: `field` in `direction`,
+    then document ID (so documents sharing a value are neither skipped nor
+    repeated). Iterating yields the page's snapshots; afterwards `next_cursor`
+    is the cursor for the following page, or None on the last one. Reads at
+    most limit + 1 documents. Raises ValueError for a malformed cursor.
+    """
+
+    def __init__(self, query, field, limit, cursor=None, direction=firestore.Query.DESCENDING):
+        self.limit = limit
+        self.next_cursor = None
+        self._field = field
+        query = query.order_by(field, direction=direction)
+        if field != '__name__':
+            query = query.order_by('__name__', direction=direction)
+        if cursor:
+            values = decode_cursor(cursor)
+            if len(values) != 2 or not isinstance(values[1], str):
+                raise ValueError('Invalid cursor')
+            last_value, last_id = values
+            if field == '__name__':
+                query = query.start_after({'__name__': last_id})
+            else:
+                query = query.start_after({field: _from_cursor_value(last_value), '__name__': last_id})
+        self._query = query.limit(limit + 1)
+
+    def __iter__(self):
+        last = None
+        for count, doc in enumerate(self._query.stream()):
+            if count == self.limit:
+                value = last.id if self._field == '__name__' else last.get(self._field)
+                self.next_cursor = encode_cursor([_cursor_value(value), last.id])
+                return
+            last = doc
+            yield doc
+
+def get_page_size(default, maximum):
+    """Reads ?limit= from the request, clamped to [1, maximum]."""
+    try:
+        limit = int(request.args.get('limit', default))
+    except (TypeError, ValueError):
+        limit = default
+    return max(1, min(limit, maximum))
+
+# ============================================
+# STREAMING RESPONSES
+# ============================================
+# List endpoints backed by a Firestore query write each document to the client
+# as .stream() yields it, so memory stays flat on long histories and the first
+# bytes leave before the last document arrives. Request metrics and the
+# Server-Timing header cover the time to the first item.
+
+STREAM_CHUNK_BYTES = 16 * 1024  # items are sent in chunks of about this size
+
+def stream_json_list(items, tail=None, **fields):
+    """
+    Streams {"success": true, **fields, "data": [...items], **tail()} as a
+    chunked JSON response. `items` is any iterable of JSON-serializable dicts;
+    `tail` is called after the last item for fields that depend on it.
+
+    The first item is fetched before the response starts, so errors from the
+    query itself still reach the caller's except block. Later errors can only
+    cut the body short; they are logged.
+    """
+    dumps = partial(app.json.dumps, separators=(',', ':'))
+    items = iter(items)
+    first = next(items, _MISSING)
+
+    def generate():
+        head = '{"success":true' + ''.join(f',{dumps(k)}:{dumps(v)}' for k, v in fields.items()) + ',"data":['
+        if first is _MISSING:
+            yield head + ']' + _tail_fields() + '}'
+            return
+        yield head + dumps(first)
+        try:
+            chunk = []
+            size = 0
+            for item in items:
+                part = ',' + dumps(item)
+                chunk.append(part)
+                size += len(part)
+                if size >= STREAM_CHUNK_BYTES:
+                    yield ''.join(chunk)
+                    chunk = []
+                    size = 0
+            yield ''.join(chunk) + ']' + _tail_fields() + '}'
+        except Exception:
+            http_log.exception("Streaming %s failed after the response started", request.path)
+
+    def _tail_fields():
+        return ''.join(f',{dumps(k)}:{dumps(v)}' for k, v in (tail() if tail else {}).items())
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+# ============================================
+# CONDITIONAL REQUESTS
+# ============================================
+# Catalog and test-delivery responses carry an ETag computed from the versions
+# they are built from (catalog section hashes, test update times, question bank
+# IDs, the student's access state) instead of from the body, so a matching
+# If-None-Match is answered with 304 before the body is built or serialized.
+# "private, no-cache" lets the browser's HTTP cache keep the body and
+# revalidate it on every use; sw.js fetches through that cache.
+
+CONDITIONAL_CACHE_CONTROL = 'private, no-cache'
+
+def not_modified(*version_parts, shared=False):
+    """
+    Tags the response with an ETag for `version_parts` (which must determine the
+    body completely). Returns a 304 response if the client already holds that
+    version, else None. `shared` marks versions served to many students (catalog
+    lists, test delivery), whose compressed bodies are worth caching.
+    """
+    etag = _content_version(version_parts)
+    g.response_etag = etag
+    g.response_etag_shared = shared
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304)
+    return None
+
+@app.after_request
+def tag_conditional_response(response):
+    etag = g.get('response_etag')
+    if etag is not None and response.status_code in (200, 304):
+        # Weak: the same version may be sent with different encodings
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = CONDITIONAL_CACHE_CONTROL
+    return response
+
+# ============================================
+# RESPONSE COMPRESSION
+# ============================================
+# JSON bodies of COMPRESS_MIN_BYTES or more are sent with gzip or, when the
+# brotli package is installed, br, whichever the client's Accept-Encoding
+# prefers. A response tagged by not_modified(shared=True) is fully determined
+# by an ETag that many students share, so its compressed body is cached under
+# (ETag, encoding) and compressed once, at the highest level. Other responses,
+# per-user ones included, are compressed on every request at a cheaper level.
+# Streamed lists go out uncompressed.
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/plain', 'text/html')
+COMPRESSION_LEVELS = {'br': 5, 'gzip': 6}          # per request
+CACHED_COMPRESSION_LEVELS = {'br': 11, 'gzip': 9}  # once per (ETag, encoding)
+
+compressed_body_cache = TTLCache(maxsize=512, ttl=3600)
+
+def negotiate_encoding():
+    """'br', 'gzip' or None, from the request's Accept-Encoding."""
+    accepted = request.accept_encodings
+    candidates = (['br'] if brotli is not None else []) + ['gzip']
+    # Highest quality wins; br (listed first) on a tie
+    encoding = max(candidates, key=lambda candidate: accepted[candidate])
+    return encoding if accepted[encoding] > 0 else None
+
+def compress_body(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+@app.after_request
+def compress_response(response):
+    if not RESPONSE_COMPRESSION or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers):
+        return response
+    encoding = negotiate_encoding()
+    if encoding is None or (response.content_length or 0) < COMPRESS_MIN_BYTES:
+        return response
+
+    etag = g.get('response_etag')
+    if etag is not None and g.get('response_etag_shared'):
+        key = (etag, encoding)
+        body = compressed_body_cache.get(key)
+        if body is None:
+            body = compress_body(response.get_data(), encoding, CACHED_COMPRESSION_LEVELS[encoding])
+            compressed_body_cache.set(key, body)
+    else:
+        body = compress_body(response.get_data(), encoding, COMPRESSION_LEVELS[encoding])
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
 # ============================================
 # AUTHENTICATION MIDDLEWARE
 # ============================================
 
+verified_token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=3600)
+
+def verify_id_token_cached(id_token):
+    """
+    auth.verify_id_token() with a per-worker cache keyed by the token's SHA-256.
+
+    A token is only verified (RSA signature + claims) the first time a worker
+    sees it; later requests reuse the decoded claims until `exp`. When
+    TOKEN_CHECK_REVOKED is on, cached tokens are re-checked for revocation
+    every TOKEN_REVOCATION_RECHECK seconds.
+    """
+    key = hashlib.sha256(id_token.encode()).hexdigest()
+    now = time.time()
+
+    entry = verified_token_cache.get(key)
+    if entry is not None:
+        decoded_token, checked_at = entry
+        fresh = not TOKEN_CHECK_REVOKED or now - checked_at < TOKEN_REVOCATION_RECHECK
+        if decoded_token.get('exp', 0) > now and fresh:
+            return decoded_token
+        verified_token_cache.pop(key)
+
+    decoded_token = auth.verify_id_token(id_token, check_revoked=TOKEN_CHECK_REVOKED)
+    ttl = decoded_token.get('exp', 0) - now
+    if ttl > 0:
+        verified_token_cache.set(key, (decoded_token, now), ttl=ttl)
+    return decoded_token
+
 def verify_firebase_token(f):
     """Decorator to verify Firebase ID token"""
     @wraps(f)
@@ -140,7 +1585,7 @@ def verify_firebase_token(f):
         
         try:
             # Verify the token
-            decoded_token = auth.verify_id_token(id_token)
+            decoded_token = verify_id_token_cached(id_token)
             request.user_id = decoded_token['uid']
             request.user_email = decoded_token.get('email')
             return f(*args, **kwargs)
@@ -149,6 +1594,22 @@ def verify_firebase_token(f):
     
     return decorated_function
 
+def require_internal_token(f):
+    """
+    Decorator for ops endpoints: requires X-Internal-Token (or, for Prometheus
+    scrapers, `Authorization: Bearer`) == INTERNAL_METRICS_TOKEN
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = request.headers.get('X-Internal-Token', '')
+        if not token and request.headers.get('Authorization', '').startswith('Bearer '):
+            token = request.headers['Authorization'].split('Bearer ', 1)[1]
+        if not INTERNAL_METRICS_TOKEN or not hmac.compare_digest(token, INTERNAL_METRICS_TOKEN):
+            return jsonify({'error': 'Endpoint not found'}), 404
+        return f(*args, **kwargs)
+
+    return decorated_function
+
 # ============================================
 # USER MANAGEMENT ENDPOINTS
 # ============================================
@@ -187,6 +1648,7 @@ def create_user():
         }
         
         db.collection('users').document(user_id).set(user_data)
+        invalidate_user_data(user_id)
         
         return jsonify({
             'success': True,
@@ -231,6 +1693,7 @@ def update_user_profile():
         update_data['updatedAt'] = datetime.now()
         
         db.collection('users').document(user_id).update(update_data)
+        invalidate_user_data(user_id)
         
         return jsonify({
             'success': True,
@@ -252,17 +1715,20 @@ def get_courses():
         user_id = request.user_id
         
         # Get user's enrolled courses
-        user_doc = db.collection('users').document(user_id).get()
-        enrolled_courses = user_doc.to_dict().get('enrolledCourses', []) if user_doc.exists else []
+        user_data = get_user_data(user_id) or {}
+        enrolled_courses = user_data.get('enrolledCourses', [])
+
+        catalog_courses, courses_version = catalog_cache.section('courses')
+        cached = not_modified('courses', courses_version, enrolled_courses, shared=True)
+        if cached:
+            return cached
         
-        # Get all courses
-        courses_ref = db.collection('courses')
+        # Get all courses (from the catalog cache)
         courses = []
         
-        for doc in courses_ref.stream():
-            course_data = doc.to_dict()
-            course_data['id'] = doc.id
-            course_data['enrolled'] = doc.id in enrolled_courses
+        for course in catalog_courses:
+            course_data = dict(course)
+            course_data['enrolled'] = course_data['id'] in enrolled_courses
             courses.append(course_data)
         
         return jsonify({
@@ -281,17 +1747,20 @@ def get_course_lectures(course_id):
         user_id = request.user_id
         
         # Check if user has access to this course
-        user_doc = db.collection('users').document(user_id).get()
-        enrolled_courses = user_doc.to_dict().get('enrolledCourses', []) if user_doc.exists else []
-        user_plan = user_doc.to_dict().get('plan', 'free') if user_doc.exists else 'free'
+        user_data = get_user_data(user_id) or {}
+        enrolled_courses = user_data.get('enrolledCourses', [])
+        user_plan = user_data.get('plan', 'free')
+
+        catalog_lectures, lectures_version = catalog_cache.section('lectures')
+        cached = not_modified('lectures', lectures_version, course_id, enrolled_courses, user_plan, shared=True)
+        if cached:
+            return cached
         
-        # Get lectures
-        lectures_ref = db.collection('courses').document(course_id).collection('lectures')
+        # Get lectures (from the catalog cache, already sorted by 'order')
         lectures = []
         
-        for doc in lectures_ref.order_by('order').stream():
-            lecture_data = doc.to_dict()
-            lecture_data['id'] = doc.id
+        for lecture in catalog_lectures.get(course_id, []):
+            lecture_data = dict(lecture)
             
             # Check access: free lectures OR user enrolled OR premium plan
             is_free = lecture_data.get('isFree', False)
@@ -319,6 +1788,27 @@ def get_course_lectures(course_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# ({material_id: downloads counted on shards}, version stamp) under a single key
+download_counts_cache = TTLCache(maxsize=1, ttl=DOWNLOAD_COUNTS_TTL)
+
+def get_download_counts():
+    """
+    Download counts from the material counter shards (one collection-group
+    query, at most every DOWNLOAD_COUNTS_TTL) and their version stamp.
+    """
+    cached = download_counts_cache.get('all')
+    if cached is None:
+        # Counts are decoration: the listing still loads if the shards can't be read (retried next request)
+        try:
+            totals = material_counters.totals()
+        except Exception as e:
+            materials_log.warning("Could not sum download counter shards: %s", e)
+            return {}, None
+        counts = {material_id: fields.get('downloads', 0) for material_id, fields in totals.items()}
+        cached = (counts, _content_version(counts))
+        download_counts_cache.set('all', cached)
+    return cached
+
 @app.route('/api/materials', methods=['GET'])
 @verify_firebase_token
 def get_study_materials():
@@ -328,20 +1818,24 @@ def get_study_materials():
         subject = request.args.get('subject')
         
         # Get user's enrolled courses
-        user_doc = db.collection('users').document(user_id).get()
-        enrolled_courses = user_doc.to_dict().get('enrolledCourses', []) if user_doc.exists else []
-        user_plan = user_doc.to_dict().get('plan', 'free') if user_doc.exists else 'free'
-        
-        # Query materials
-        materials_ref = db.collection('materials')
-        
-        if subject:
-            materials_ref = materials_ref.where('subject', '==', subject)
+        user_data = get_user_data(user_id) or {}
+        enrolled_courses = user_data.get('enrolledCourses', [])
+        user_plan = user_data.get('plan', 'free')
+
+        catalog_materials, materials_version = catalog_cache.section('materials')
+        download_counts, downloads_version = get_download_counts()
+        cached = not_modified('materials', materials_version, downloads_version, subject, enrolled_courses, user_plan,
+                              shared=True)
+        if cached:
+            return cached
         
+        # Filter materials (from the catalog cache)
         materials = []
-        for doc in materials_ref.stream():
-            material_data = doc.to_dict()
-            material_data['id'] = doc.id
+        for material in catalog_materials:
+            if subject and material.get('subject') != subject:
+                continue
+            material_data = dict(material)
+            material_data['downloads'] = material.get('downloads', 0) + download_counts.get(material['id'], 0)
             
             # Check access
             is_free = material_data.get('access') == 'free'
@@ -365,6 +1859,12 @@ def get_study_materials():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# Signed download URLs by storage path (shared by every student who can see the
+# file) and whether each path exists in Storage
+signed_url_cache = TTLCache(maxsize=2000, ttl=SIGNED_URL_MINUTES * 60 - SIGNED_URL_MIN_REMAINING)
+blob_exists_cache = TTLCache(maxsize=5000, ttl=BLOB_EXISTS_TTL)
+BLOB_MISSING_TTL = 60  # seconds; a file uploaded after a failed check shows up quickly
+
 @app.route('/api/material/<material_id>/download', methods=['GET'])
 @verify_firebase_token # Make sure this decorator is correctly applied
 def get_material_download_url(material_id):
@@ -372,25 +1872,47 @@ def get_material_download_url(material_id):
     Generates a short-lived signed URL for a file in Firebase Storage.
     """
     if not bucket: # Add check in case initialization failed
-         print("❌ Storage bucket not initialized!")
+         materials_log.error("Storage bucket not initialized!")
          return jsonify({'error': 'Storage service unavailable'}), 503
 
     try:
+        # The user document (for the access check) loads while we read the material
+        user_id = request.user_id # Get user ID from the decorator
+        user_future = submit_fetch(get_user_data, user_id)
+
         # 1. Get the material document from Firestore
         material_doc_ref = db.collection('materials').document(material_id)
         material_doc = material_doc_ref.get()
 
         if not material_doc.exists:
-            print(f"❌ Material document not found in Firestore: {material_id}")
+            materials_log.info("Material document not found in Firestore: %s", material_id)
             return jsonify({'error': 'Material record not found'}), 404 # Specific error
 
         material_data = material_doc.to_dict()
 
+        # 2. Get the filename from the 'storageUrl' (preferred) or 'filename' field
+        #    Use storageUrl as it contains the folder path
+        storage_path = material_data.get('storageUrl')
+
+        if not storage_path:
+             # Fallback to filename if storageUrl is missing (less ideal)
+             filename_only = material_data.get('filename')
+             if filename_only:
+                 storage_path = f"materials/{filename_only}" # Assuming it's always in the 'materials' folder
+                 materials_log.warning("Using fallback storage path construction for material %s: %s", material_id, storage_path)
+
+        # 3. Check the blob in Firebase Storage while the user document is still loading,
+        #    unless a cached signed URL or existence check already covers it
+        blob = bucket.blob(storage_path) if storage_path else None # Use the full path
+        download_url = signed_url_cache.get(storage_path) if blob is not None else None
+        blob_exists = blob_exists_cache.get(storage_path) if blob is not None and download_url is None else None
+        blob_exists_future = None
+        if blob is not None and download_url is None and blob_exists is None:
+            blob_exists_future = submit_fetch(blob.exists)
+
         # --- ACCESS CHECK (Crucial!) ---
         # You need to verify if the user actually has access before generating the URL
-        user_id = request.user_id # Get user ID from the decorator
-        user_doc_for_access = db.collection('users').document(user_id).get()
-        user_data_for_access = user_doc_for_access.to_dict() if user_doc_for_access.exists else {}
+        user_data_for_access = user_future.result() or {}
         enrolled_courses_for_access = user_data_for_access.get('enrolledCourses', [])
         user_plan_for_access = user_data_for_access.get('plan', 'free')
 
@@ -401,54 +1923,40 @@ def get_material_download_url(material_id):
 
         has_access = is_free or is_enrolled or is_premium_plan
         if not has_access:
-             print(f"❌ Access denied for user {user_id} to material {material_id} (Subject: {material_subject})")
+             materials_log.info("Access denied for user %s to material %s (subject: %s)", user_id, material_id, material_subject)
              return jsonify({'error': 'Access denied to this material'}), 403
         # --- END ACCESS CHECK ---
 
+        if blob is None:
+            materials_log.error("File path ('storageUrl' or 'filename') missing in Firestore record: %s", material_id)
+            return jsonify({'error': 'File path missing in material record'}), 404 # Specific error
 
-        # 2. Get the filename from the 'storageUrl' (preferred) or 'filename' field
-        #    Use storageUrl as it contains the folder path
-        storage_path = material_data.get('storageUrl')
+        if download_url is None:
+            materials_log.debug("Attempting to access Storage path: %s", storage_path)
 
-        if not storage_path:
-             # Fallback to filename if storageUrl is missing (less ideal)
-             filename_only = material_data.get('filename')
-             if filename_only:
-                 storage_path = f"materials/{filename_only}" # Assuming it's always in the 'materials' folder
-                 print(f"⚠️ Warning: Using fallback storage path construction for material {material_id}: {storage_path}")
-             else:
-                print(f"❌ File path ('storageUrl' or 'filename') missing in Firestore record: {material_id}")
-                return jsonify({'error': 'File path missing in material record'}), 404 # Specific error
-
-        print(f"ℹ️ Attempting to access Storage path: {storage_path}")
+            if blob_exists_future is not None:
+                blob_exists = blob_exists_future.result()
+                blob_exists_cache.set(storage_path, blob_exists, ttl=None if blob_exists else BLOB_MISSING_TTL)
 
-        # 3. Get the blob from Firebase Storage
-        blob = bucket.blob(storage_path) # Use the full path
-
-        if not blob.exists():
-            print(f"❌ File does not exist in Storage at path: {storage_path} (Material ID: {material_id})")
-            return jsonify({'error': 'File does not exist in storage'}), 404 # Specific error
-
-        # 4. Generate a signed URL (valid for 15 minutes)
-        try:
-            download_url = blob.generate_signed_url(
-                expiration=timedelta(minutes=15),
-                method='GET'
-            )
-            print(f"✅ Generated signed URL for: {storage_path}")
-        except Exception as sign_e:
-             print(f"❌ Error generating signed URL for {storage_path}: {sign_e}")
-             # This might happen due to permissions issues with the service account
-             return jsonify({'error': 'Could not generate download link', 'details': str(sign_e)}), 500
+            if not blob_exists:
+                materials_log.error("File does not exist in Storage at path: %s (material %s)", storage_path, material_id)
+                return jsonify({'error': 'File does not exist in storage'}), 404 # Specific error
 
-
-        # --- ADD DOWNLOAD COUNT INCREMENT ---
-        try:
-            material_doc_ref.update({'downloads': firestore.Increment(1)})
-            print(f"📈 Incremented download count for material {material_id}")
-        except Exception as update_e:
-            print(f"⚠️ Failed to increment download count for {material_id}: {update_e}")
-        # --- END DOWNLOAD COUNT ---
+            # 4. Generate a signed URL (valid for SIGNED_URL_MINUTES) and reuse it while enough of it is left
+            try:
+                download_url = blob.generate_signed_url(
+                    expiration=timedelta(minutes=SIGNED_URL_MINUTES),
+                    method='GET'
+                )
+                signed_url_cache.set(storage_path, download_url)
+                materials_log.debug("Generated signed URL for: %s", storage_path)
+            except Exception as sign_e:
+                 materials_log.error("Error generating signed URL for %s: %s", storage_path, sign_e)
+                 # This might happen due to permissions issues with the service account
+                 return jsonify({'error': 'Could not generate download link', 'details': str(sign_e)}), 500
+
+        # Count the download (on a counter shard, with the next buffered flush)
+        material_counters.increment(material_id, {'downloads': 1})
 
         # 5. Return the URL to the frontend
         return jsonify({
@@ -459,9 +1967,7 @@ def get_material_download_url(material_id):
         }), 200
 
     except Exception as e:
-        print(f"❌ Unexpected error in get_material_download_url for {material_id}: {e}")
-        import traceback
-        traceback.print_exc() # Print full traceback for debugging
+        materials_log.exception("Unexpected error in get_material_download_url for %s", material_id)
         return jsonify({'error': 'Failed to get download URL', 'details': str(e)}), 500
 
 @app.route('/api/tests', methods=['GET'])
@@ -473,71 +1979,42 @@ def get_student_tests():
         subject_filter = request.args.get('subject')
         type_filter = request.args.get('type')
 
-        print(f"\n{'='*60}")
-        print(f"📋 GET TESTS REQUEST")
-        print(f"User ID: {user_id}")
-        print(f"Subject Filter: {subject_filter}")
-        print(f"{'='*60}\n")
+        # Per-test access dumps are only built when DEBUG is enabled for geocatalyst.tests
+        debug = tests_log.isEnabledFor(logging.DEBUG)
 
         # --- Get User Data ---
-        user_doc_ref = db.collection('users').document(user_id)
-        user_doc = user_doc_ref.get()
+        user_data = get_user_data(user_id)
         
-        if not user_doc.exists:
-            print(f"❌ User document not found for UID: {user_id}")
+        if user_data is None:
+            tests_log.warning("User document not found for UID: %s", user_id)
             return jsonify({'error': 'User profile not found'}), 404
 
-        user_data = user_doc.to_dict()
         enrolled_courses = user_data.get('enrolledCourses', [])
         user_plan = user_data.get('plan', 'free')
 
-        print(f"👤 USER DATA:")
-        print(f"   Plan: {user_plan}")
-        print(f"   Enrolled Courses: {enrolled_courses}")
-        print(f"   User UID: {user_data.get('uid')}")
+        # --- Load Admin Grants (one query for all tests) ---
+        granted_test_ids = get_granted_test_ids(user_id)
 
-        # --- Query Tests ---
-        tests_query = db.collection('tests').where('isActive', '==', True)
+        catalog_tests, tests_version = catalog_cache.section('tests')
+        cached = not_modified('tests', tests_version, subject_filter, type_filter, enrolled_courses,
+                              user_plan, sorted(granted_test_ids), shared=True)
+        if cached:
+            return cached
 
-        if subject_filter:
-            tests_query = tests_query.where('subject', '==', subject_filter)
+        if debug:
+            tests_log.debug("GET /api/tests user=%s subject=%s plan=%s enrolled=%s granted=%s",
+                            user_id, subject_filter, user_plan, enrolled_courses, sorted(granted_test_ids))
 
+        # --- Active Tests (from the catalog cache) ---
         tests_list = []
-        for doc in tests_query.stream():
-            test_data = doc.to_dict()
-            test_data['id'] = doc.id
-
-            print(f"\n📝 PROCESSING TEST: {test_data.get('name', 'Untitled')}")
-            print(f"   Test ID: {doc.id}")
-            print(f"   Subject: {test_data.get('subject', 'N/A')}")
-            print(f"   Access Level: {test_data.get('access', 'premium')}")
+        for test_data in catalog_tests:
+            if subject_filter and test_data.get('subject') != subject_filter:
+                continue
+            if type_filter and test_data.get('type') != type_filter:
+                continue
 
             # --- Check Admin Grants FIRST ---
-            has_grant = False
-            try:
-                print(f"   🔍 Checking testAccessGrants collection...")
-                grants_query = db.collection('testAccessGrants') \
-                    .where('userId', '==', user_id) \
-                    .where('testId', '==', doc.id) \
-                    .where('isActive', '==', True) \
-                    .limit(1)
-                
-                grants = list(grants_query.stream())
-                
-                if grants:
-                    has_grant = True
-                    grant_doc = grants[0]
-                    grant_data = grant_doc.to_dict()
-                    print(f"   ✅ GRANT FOUND!")
-                    print(f"      Grant ID: {grant_doc.id}")
-                    print(f"      Grant Data: {grant_data}")
-                else:
-                    print(f"   ℹ️ No grants found")
-                    
-            except Exception as grant_e:
-                print(f"   ⚠️ Error checking grants: {grant_e}")
-                import traceback
-                traceback.print_exc()
+            has_grant = test_data['id'] in granted_test_ids
 
             # --- Check Other Access Methods ---
             test_subject = test_data.get('subject', '')
@@ -548,13 +2025,6 @@ def get_student_tests():
             has_test_series = 'Test Series Only' in enrolled_courses
             has_master_plan = user_plan == 'master'
 
-            print(f"   📊 ACCESS CHECKS:")
-            print(f"      Admin Grant: {has_grant}")
-            print(f"      Free Test: {is_free_test}")
-            print(f"      Enrolled in Subject: {is_enrolled_in_subject}")
-            print(f"      Has Test Series: {has_test_series}")
-            print(f"      Master Plan: {has_master_plan}")
-
             # Determine final access
             has_access = (
                 has_grant or
@@ -564,7 +2034,13 @@ def get_student_tests():
                 has_master_plan
             )
 
-            print(f"   🎯 FINAL ACCESS: {has_access}")
+            if debug:
+                tests_log.debug(
+                    "Test %s %r (subject=%s, access=%s): grant=%s free=%s enrolled=%s "
+                    "testSeries=%s master=%s -> hasAccess=%s",
+                    test_data['id'], test_data.get('name', 'Untitled'), test_subject, test_access_level,
+                    has_grant, is_free_test, is_enrolled_in_subject, has_test_series, has_master_plan, has_access
+                )
 
             # Prepare summary
             test_summary = {
@@ -573,16 +2049,14 @@ def get_student_tests():
                 'subject': test_subject,
                 'type': test_data.get('type', 'practice'),
                 'duration': test_data.get('duration', 0),
-                'totalQuestions': len(test_data.get('questions', [])),
+                'totalQuestions': test_data.get('questionCount', 0),
                 'totalMarks': test_data.get('totalMarks', 0),
                 'access': test_access_level,
                 'hasAccess': has_access
             }
             tests_list.append(test_summary)
 
-        print(f"\n{'='*60}")
-        print(f"✅ RETURNING {len(tests_list)} TESTS")
-        print(f"{'='*60}\n")
+        tests_log.debug("Returning %d tests to user %s", len(tests_list), user_id)
 
         return jsonify({
             'success': True,
@@ -590,12 +2064,7 @@ def get_student_tests():
         }), 200
 
     except Exception as e:
-        print(f"\n{'='*60}")
-        print(f"❌ ERROR IN get_student_tests:")
-        print(f"   {str(e)}")
-        print(f"{'='*60}\n")
-        import traceback
-        traceback.print_exc()
+        tests_log.exception("Error in get_student_tests for user %s", request.user_id)
         return jsonify({'error': 'Failed to fetch tests', 'details': str(e)}), 500
 
 # @app.route('/api/tests', methods=['GET'])
@@ -645,8 +2114,39 @@ def get_student_tests():
 #     except Exception as e:
 #         return jsonify({'error': str(e)}), 500
 
-# Add this import if you don't have it
-import traceback
+def get_granted_test_ids(user_id):
+    """
+    Returns the set of testIds the user holds an active admin grant for.
+
+    All of the user's active testAccessGrants are loaded with ONE query and
+    memoized on flask.g, so a request costs a single grants read no matter
+    how many tests it checks.
+    """
+    if not user_id:
+        return set()
+
+    memo = None
+    if has_app_context():
+        memo = g.setdefault('granted_test_ids', {})
+        if user_id in memo:
+            return memo[user_id]
+
+    granted = set()
+    try:
+        grants_query = db.collection('testAccessGrants') \
+            .where('userId', '==', user_id) \
+            .where('isActive', '==', True)
+
+        for grant_doc in grants_query.stream():
+            grant_test_id = grant_doc.to_dict().get('testId')
+            if grant_test_id:
+                granted.add(grant_test_id)
+    except Exception as grant_e:
+        tests_log.exception("Error loading test grants for user %s: %s", user_id, grant_e)
+
+    if memo is not None:
+        memo[user_id] = granted
+    return granted
 
 # --- Add or Verify this Helper Function ---
 def check_user_access(user_data, content_subject, content_access='premium', is_test=False, test_id=None):
@@ -674,26 +2174,11 @@ def check_user_access(user_data, content_subject, content_access='premium', is_t
 
     # ✅ FEATURE 2: Check test-specific grants FIRST
     if is_test and test_id:
-        try:
-            user_id = user_data.get('uid')
-            grants_query = db.collection('testAccessGrants') \
-                .where('userId', '==', user_id) \
-                .where('testId', '==', test_id) \
-                .where('isActive', '==', True) \
-                .limit(1)
-            
-            grants = list(grants_query.stream())
-            
-            if grants:
-                print(f"✅ User {user_id} has admin-granted access to test {test_id}")
-                return True
-            else:
-                print(f"ℹ️ No grants found for user {user_id} on test {test_id}")
-                
-        except Exception as grant_e:
-            print(f"⚠️ Error checking test grants: {grant_e}")
-            import traceback
-            traceback.print_exc()
+        user_id = user_data.get('uid')
+        if test_id in get_granted_test_ids(user_id):
+            tests_log.debug("User %s has admin-granted access to test %s", user_id, test_id)
+            return True
+        tests_log.debug("No grants found for user %s on test %s", user_id, test_id)
 
     # Check master plan
     user_plan = user_data.get('plan', 'free')
@@ -715,16 +2200,21 @@ def check_user_access(user_data, content_subject, content_access='premium', is_t
 @app.route('/api/debug/grants/<user_id>', methods=['GET'])
 @verify_firebase_token
 def debug_user_grants(user_id):
-    """Debug endpoint to check all grants for a user"""
+    """Debug endpoint to check all grants for a user (paged: ?limit=&cursor=)"""
     try:
         # Verify requesting user is admin or same user
         requesting_user = request.user_id
         
-        # Get all grants for this user
+        # Get this user's grants, one page at a time (by grant ID)
         grants_query = db.collection('testAccessGrants').where('userId', '==', user_id)
+        try:
+            page = QueryPage(grants_query, '__name__', get_page_size(LIST_PAGE_SIZE, LIST_MAX_PAGE_SIZE),
+                             request.args.get('cursor'), direction=firestore.Query.ASCENDING)
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
         grants = []
         
-        for doc in grants_query.stream():
+        for doc in page:
             grant_data = doc.to_dict()
             grant_data['id'] = doc.id
             
@@ -738,19 +2228,24 @@ def debug_user_grants(user_id):
             'success': True,
             'data': {
                 'userId': user_id,
-                'totalGrants': len(grants),
-                'grants': grants
+                'totalGrants': len(grants),  # on this page
+                'grants': grants,
+                'nextCursor': page.next_cursor
             }
         }), 200
         
     except Exception as e:
-        print(f"❌ Error fetching grants: {e}")
+        tests_log.exception("Error fetching grants for user %s", user_id)
         return jsonify({'error': str(e)}), 500
 
 
 # ============================================
 # 1. GET FULL TEST DETAILS (WITH QUESTIONS)
 # ============================================
+# Test fields returned with the questions (the question arrays come from the bank)
+TEST_DELIVERY_FIELDS = ['name', 'title', 'description', 'instructions', 'subject', 'type', 'duration',
+                        'totalMarks', 'access', 'isActive', 'questionCount', 'createdAt']
+
 @app.route('/api/tests/<test_id>', methods=['GET'])
 @verify_firebase_token
 def get_test_details_with_questions(test_id):
@@ -758,12 +2253,12 @@ def get_test_details_with_questions(test_id):
     try:
         user_id = request.user_id
 
-        # Fetch Test Document
-        test_doc_ref = db.collection('tests').document(test_id)
-        test_doc = test_doc_ref.get()
+        # Fetch the test (metadata, plus its question bank) and the user (for the access check) together
+        (test_doc, question_bank), user_data = parallel_fetch(
+            partial(read_test_version, test_id, TEST_DELIVERY_FIELDS), partial(get_user_data, user_id))
 
         if not test_doc.exists:
-            print(f"❌ Test not found in Firestore: {test_id}")
+            tests_log.info("Test not found in Firestore: %s", test_id)
             return jsonify({'error': 'Test not found'}), 404
 
         test_data = test_doc.to_dict()
@@ -771,16 +2266,12 @@ def get_test_details_with_questions(test_id):
 
         # Check if Test is Active
         if not test_data.get('isActive', False):
-             print(f"⚠️ Access denied for test {test_id}: Test is not active.")
+             tests_log.info("Access denied for test %s: test is not active", test_id)
              return jsonify({'error': 'This test is currently inactive.'}), 403
 
-        # Fetch User Data for Access Check
-        user_doc_ref = db.collection('users').document(user_id)
-        user_doc = user_doc_ref.get()
-        if not user_doc.exists:
-            print(f"⚠️ User document not found for UID: {user_id}")
+        if user_data is None:
+            tests_log.warning("User document not found for UID: %s", user_id)
             return jsonify({'error': 'User profile not found'}), 404
-        user_data = user_doc.to_dict()
 
         # ✅ FEATURE 2: Perform Access Check WITH test_id parameter
         has_access = check_user_access(
@@ -792,43 +2283,343 @@ def get_test_details_with_questions(test_id):
         )
 
         if not has_access:
-            print(f"🚫 Access denied for user {user_id} to test {test_id}")
+            tests_log.info("Access denied for user %s to test %s", user_id, test_id)
             return jsonify({
                 'error': 'Access Denied', 
                 'message': f'Upgrade needed for {test_data.get("subject", "this test")}.'
             }), 403
 
-        # Access Granted: Return Full Test Data
-        test_data.setdefault('questions', [])
-        test_data.setdefault('totalMarks', 0)
+        # Access Granted: Return Full Test Data (unless the client has this version)
+        cached = not_modified('test', test_id, test_doc.update_time, question_bank.id, shared=True)
+        if cached:
+            return cached
 
-        # Clean questions before sending
-        cleaned_questions = []
-        for q in test_data['questions']:
-            cleaned_q = {
-                'type': q.get('type'),
-                'question': q.get('question'),
-                'options': q.get('options'),
-                'marks': q.get('marks'),
-                'negativeMarks': q.get('negativeMarks'),
-                'markValue': q.get('markValue'),
-                'imageUrl': q.get('imageUrl')
-            }
-            cleaned_questions.append(cleaned_q)
-        test_data['questions'] = cleaned_questions
+        test_data.setdefault('totalMarks', 0)
+        # Answers stripped once per test version (see QuestionBank)
+        test_data['questions'] = question_bank.student_questions
 
-        print(f"✅ Access granted for user {user_id} to test {test_id}")
+        tests_log.debug("Access granted for user %s to test %s", user_id, test_id)
         return jsonify({
             'success': True,
             'data': test_data
         }), 200
 
     except Exception as e:
-        print(f"❌ Error fetching test {test_id}: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        tests_log.exception("Error fetching test %s", test_id)
         return jsonify({'error': 'Failed to load test', 'details': str(e)}), 500
 
+# ============================================
+# COMPILED ANSWER KEYS
+# ============================================
+# A test's scoring data parsed once per test version instead of on every
+# submission: marks live in float arrays, and per-type index lists let the
+# scorer make one tight pass per question type with no dict walking or
+# float() parsing.
+
+# Per-question outcomes recorded by score_submission()
+UNATTEMPTED, CORRECT, WRONG_PENALIZED, WRONG, UNSCORED = range(5)
+
+class CompiledAnswerKey:
+    """Scoring data for one version of a test (see compile_answer_key)."""
+
+    def __init__(self, test_data, version=None):
+        questions = test_data.get('questions', []) or []
+
+        self.version = version
+        self.test_name = test_data.get('name', 'Test')
+        self.subject = test_data.get('subject', '')
+        self.total_marks = test_data.get('totalMarks', 0)
+        self.count = len(questions)
+        self.index_keys = [str(i) for i in range(self.count)]  # answers dict uses string indexes
+        self.marks = array('d', (float(q.get('marks', 0)) for q in questions))
+        self.negative_marks = array('d', (float(q.get('negativeMarks', 0)) for q in questions))
+
+        self.mcq = []         # (index, correctAnswer)
+        self.true_false = []  # (index, correctAnswer)
+        self.msq = []         # (index, {option: bit}, bitmask of all correct options)
+        self.numerical = []   # (index, correct value, tolerance)
+        self.invalid = []     # indexes whose answer key can't be evaluated: attempts count as wrong
+        self.unscored = []    # indexes of unknown question types
+
+        for i, q in enumerate(questions):
+            q_type = q.get('type')
+            if q_type == 'mcq':
+                self.mcq.append((i, q.get('correctAnswer')))
+            elif q_type == 'true-false':
+                self.true_false.append((i, q.get('correctAnswer')))
+            elif q_type == 'msq':
+                try:
+                    correct_options = set(q.get('correctAnswers', []))
+                except TypeError:
+                    self.invalid.append(i)
+                    continue
+                option_bits = {option: 1 << bit for bit, option in enumerate(correct_options)}
+                self.msq.append((i, option_bits, (1 << len(option_bits)) - 1))
+            elif q_type == 'numerical':
+                try:
+                    correct_num = float(q.get('correctAnswer', float('inf')))
+                    tolerance = float(q.get('tolerance', 0))
+                except (ValueError, TypeError):
+                    self.invalid.append(i)
+                    continue
+                self.numerical.append((i, correct_num, tolerance))
+            else:
+                self.unscored.append(i)
+
+def score_submission(answer_key, student_answers):
+    """
+    Scores a submission against a compiled key.
+
+    Returns (score, correct_count, wrong_count, unattempted_count) with the
+    same rules as before: MCQ and true/false wrong answers lose negativeMarks,
+    MSQ needs the exact option set, numerical answers must be within tolerance.
+    """
+    answers = [student_answers.get(key) for key in answer_key.index_keys]
+    outcome = bytearray(answer_key.count)  # all UNATTEMPTED
+
+    for i, correct_answer in answer_key.mcq:
+        answer = answers[i]
+        if answer is not None and answer != '':
+            outcome[i] = CORRECT if answer == correct_answer else WRONG_PENALIZED
+
+    for i, correct_bool in answer_key.true_false:
+        answer = answers[i]
+        if answer is not None and answer != '':
+            outcome[i] = CORRECT if (str(answer).lower() == 'true') == correct_bool else WRONG_PENALIZED
+
+    for i, option_bits, correct_mask in answer_key.msq:
+        answer = answers[i]
+        if answer is None or answer == '':
+            continue
+        selected = answer if isinstance(answer, list) else [answer]
+        mask = 0
+        try:
+            for option in selected:
+                bit = option_bits.get(option)
+                if bit is None:
+                    mask = -1
+                    break
+                mask |= bit
+        except TypeError:  # unhashable option
+            mask = -1
+        outcome[i] = CORRECT if selected and mask == correct_mask else WRONG
+
+    for i, correct_num, tolerance in answer_key.numerical:
+        answer = answers[i]
+        if answer is None or answer == '':
+            continue
+        try:
+            outcome[i] = CORRECT if abs(float(answer) - correct_num) <= tolerance else WRONG
+        except (ValueError, TypeError):
+            outcome[i] = WRONG
+
+    for indexes, attempted_outcome in ((answer_key.invalid, WRONG), (answer_key.unscored, UNSCORED)):
+        for i in indexes:
+            answer = answers[i]
+            if answer is not None and answer != '':
+                outcome[i] = attempted_outcome
+
+    # Sum in question order so rounding matches the old per-question loop
+    marks, negative_marks = answer_key.marks, answer_key.negative_marks
+    score = sum(
+        (marks[i] if result == CORRECT else -negative_marks[i]
+         for i, result in enumerate(outcome) if result == CORRECT or result == WRONG_PENALIZED),
+        0.0
+    )
+    wrong_count = outcome.count(WRONG_PENALIZED) + outcome.count(WRONG)
+    return score, outcome.count(CORRECT), wrong_count, outcome.count(UNATTEMPTED)
+
+
+# (test ID, document update time) -> CompiledAnswerKey
+answer_key_cache = TTLCache(maxsize=256, ttl=ANSWER_KEY_TTL)
+ANSWER_KEY_TEST_FIELDS = ['name', 'subject', 'totalMarks']
+
+def get_answer_key(test_id):
+    """
+    Returns the CompiledAnswerKey for a test, or None if the test doesn't exist.
+
+    Every call reads the test's metadata (field mask, no questions) for the
+    document's current update time, so a submission is always scored against
+    the version of the test being served; the key is compiled once per version.
+    """
+    test_doc = db.collection('tests').document(test_id).get(field_paths=ANSWER_KEY_TEST_FIELDS)
+    if not test_doc.exists:
+        return None
+
+    cache_key = (test_id, test_doc.update_time)
+    answer_key = answer_key_cache.get(cache_key)
+    if answer_key is None:
+        question_bank = question_bank_for(test_id, test_doc.update_time)
+        answer_key = CompiledAnswerKey(dict(test_doc.to_dict(), questions=question_bank.review_questions),
+                                       version=test_doc.update_time)
+        answer_key_cache.set(cache_key, answer_key)
+    return answer_key
+
+# ============================================
+# POST-SUBMISSION PIPELINE
+# ============================================
+# submit_test_attempt only writes the attempt. The steps below apply it to
+# derived data on a background thread. Each step is idempotent per attempt ID
+# (recorded in the attempt's `postProcessed` map), so retries and the
+# `flask process-pending-attempts` sweep never double-count.
+
+post_submission_executor = ThreadPoolExecutor(
+    max_workers=POST_SUBMISSION_WORKERS,
+    thread_name_prefix='post-submission'
+)
+
+@firestore.transactional
+def _apply_attempt_to_user_stats(transaction, attempt_ref, user_ref, new_percentage):
+    attempt_snapshot = attempt_ref.get(transaction=transaction)
+    if (attempt_snapshot.to_dict() or {}).get('postProcessed', {}).get('userStats'):
+        return  # already counted
+    user_snapshot = user_ref.get(transaction=transaction)
+
+    if user_snapshot.exists:
+        stats = user_snapshot.to_dict().get('stats', {})
+
+        # Get current values, default to 0 if not present
+        current_attempts = stats.get('testsAttempted', 0)
+        current_sum = stats.get('totalPercentageSum', 0)
+
+        # Calculate new values
+        new_attempts = current_attempts + 1
+        new_sum = current_sum + new_percentage
+        new_average = new_sum / new_attempts if new_attempts > 0 else 0
+
+        # Update the stats map
+        transaction.update(user_ref, {
+            'stats.testsAttempted': new_attempts,
+            'stats.totalPercentageSum': new_sum,
+            'stats.avgScore': round(new_average, 2), # Store the new average
+            'updatedAt': firestore.SERVER_TIMESTAMP
+        })
+        attempts_log.debug("Updated stats for user %s: avgScore=%.2f", user_ref.id, new_average)
+    else:
+        attempts_log.warning("User %s not found, cannot update stats", user_ref.id)
+
+    transaction.update(attempt_ref, {'postProcessed.userStats': True})
+
+def update_user_stats_step(attempt_id, attempt_data):
+    user_id = attempt_data['userId']
+    attempt_ref = db.collection('testAttempts').document(attempt_id)
+    user_ref = db.collection('users').document(user_id)
+    _apply_attempt_to_user_stats(db.transaction(), attempt_ref, user_ref, attempt_data.get('percentage', 0))
+    invalidate_user_data(user_id)
+
+@firestore.transactional
+def _apply_attempt_to_test_counters(transaction, attempt_ref, test_id, score, percentage):
+    attempt_snapshot = attempt_ref.get(transaction=transaction)
+    if (attempt_snapshot.to_dict() or {}).get('postProcessed', {}).get('testCounters'):
+        return  # already counted
+    test_counters.increment(test_id, {'attempts': 1, 'scoreSum': score, 'percentageSum': percentage},
+                            transaction=transaction)
+    transaction.update(attempt_ref, {'postProcessed.testCounters': True})
+
+def update_test_counters_step(attempt_id, attempt_data):
+    attempt_ref = db.collection('testAttempts').document(attempt_id)
+    _apply_attempt_to_test_counters(db.transaction(), attempt_ref, attempt_data['testId'],
+                                    attempt_data.get('score', 0), attempt_data.get('percentage', 0))
+
+def update_leaderboard_step(attempt_id, attempt_data):
+    # Idempotent on its own: a user already on the board is not inserted again
+    test_meta = {'name': attempt_data.get('testTitle', 'Test'), 'totalMarks': attempt_data.get('totalMarks', 0)}
+    add_attempt_to_leaderboard(attempt_data['testId'], test_meta, attempt_id, attempt_data)
+
+POST_SUBMISSION_STEPS = [
+    ('userStats', update_user_stats_step),
+    ('leaderboard', update_leaderboard_step),
+    ('testCounters', update_test_counters_step),
+]
+
+def run_post_submission(attempt_id, attempt_data):
+    """
+    Applies a saved attempt to every derived dataset. Returns True when all steps
+    succeeded, in which case the attempt's postProcessingPending flag is cleared.
+    """
+    done = attempt_data.get('postProcessed', {})
+    updates = {}
+    failed = False
+    for step_name, step in POST_SUBMISSION_STEPS:
+        if done.get(step_name):
+            continue
+        try:
+            step(attempt_id, attempt_data)
+            updates[f'postProcessed.{step_name}'] = True
+        except Exception as step_e:
+            failed = True
+            attempts_log.warning("Post-submission step '%s' failed for attempt %s: %s", step_name, attempt_id, step_e)
+
+    if not failed:
+        updates['postProcessingPending'] = False
+    if updates:
+        db.collection('testAttempts').document(attempt_id).update(updates)
+    return not failed
+
+def _post_submission_job(attempt_id, attempt_data):
+    for retry in range(POST_SUBMISSION_RETRIES):
+        try:
+            if retry:
+                time.sleep(0.5 * 2 ** retry)
+                # Re-read so steps that already succeeded are skipped
+                attempt_data = db.collection('testAttempts').document(attempt_id).get().to_dict() or attempt_data
+            if run_post_submission(attempt_id, attempt_data):
+                return
+        except Exception as job_e:
+            attempts_log.warning("Post-submission job for attempt %s failed: %s", attempt_id, job_e)
+    attempts_log.error("Giving up on post-submission for attempt %s; "
+                       "`flask process-pending-attempts` will retry it", attempt_id)
+
+def enqueue_post_submission(attempt_id, attempt_data):
+    """Schedules the derived-data updates for a freshly saved attempt."""
+    if POST_SUBMISSION_ASYNC:
+        post_submission_executor.submit(_post_submission_job, attempt_id, attempt_data)
+    else:
+        _post_submission_job(attempt_id, attempt_data)
+
+# ============================================
+# ATTEMPT DOCUMENTS
+# ============================================
+# A student gets one attempt per test, so the attempt's document ID is derived
+# from both: saving is an atomic create-if-absent and lookups are a direct get.
+
+def attempt_doc_id(user_id, test_id):
+    return f"{user_id}_{test_id}"
+
+def test_id_from_attempt_id(user_id, attempt_id):
+    """The test ID encoded in one of the user's attempt IDs, or None (e.g. legacy random IDs)."""
+    prefix = f"{user_id}_"
+    if not attempt_id.startswith(prefix):
+        return None
+    return attempt_id[len(prefix):] or None
+
+def attempt_ref_for(user_id, test_id):
+    return db.collection('testAttempts').document(attempt_doc_id(user_id, test_id))
+
+def _legacy_attempt_query(user_id, test_id):
+    # Matches attempts saved under random IDs (and new ones, which carry the same fields)
+    return db.collection('testAttempts') \
+        .where('userId', '==', user_id) \
+        .where('testId', '==', test_id) \
+        .limit(1)
+
+def find_test_attempt(user_id, test_id):
+    """Returns the user's attempt snapshot for a test, or None."""
+    attempt_doc = attempt_ref_for(user_id, test_id).get()
+    if attempt_doc.exists:
+        return attempt_doc
+    if LEGACY_ATTEMPT_LOOKUP:
+        for legacy_doc in _legacy_attempt_query(user_id, test_id).stream():
+            return legacy_doc
+    return None
+
+def already_attempted_response(user_id, test_id):
+    attempts_log.info("User %s tried to re-submit test %s that was already attempted", user_id, test_id)
+    return jsonify({
+        'error': 'You have already attempted this test',
+        'code': 'ALREADY_ATTEMPTED'
+    }), 403
+
 # ============================================
 # 2. SUBMIT TEST ANSWERS
 # ============================================
@@ -838,121 +2629,29 @@ def submit_test_attempt(test_id):
     """Receives student answers, evaluates them, and saves the attempt."""
     try:
         user_id = request.user_id
-        
-        existing_attempt_query = db.collection('testAttempts') \
-            .where('userId', '==', user_id) \
-            .where('testId', '==', test_id) \
-            .limit(1)
-        
-        existing_attempts = list(existing_attempt_query.stream())
-        
-        if existing_attempts:
-            print(f"🚫 User {user_id} tried to re-submit test {test_id} that was already attempted")
-            return jsonify({
-                'error': 'You have already attempted this test',
-                'code': 'ALREADY_ATTEMPTED'
-            }), 403
-        
+
+        # New attempts are guarded by create() below; only pre-migration ones need a query
+        if LEGACY_ATTEMPT_LOOKUP and list(_legacy_attempt_query(user_id, test_id).stream()):
+            return already_attempted_response(user_id, test_id)
+
         submission_data = request.get_json()
         student_answers = submission_data.get('answers', {}) # { "0": "A", "1": ["B", "C"], "2": "12.5" }
         time_taken = submission_data.get('timeTaken', 0) # In seconds
 
-        # --- Fetch Correct Test Data (including answers) ---
-        test_doc_ref = db.collection('tests').document(test_id)
-        test_doc = test_doc_ref.get()
+        # --- Compiled Answer Key (cached per test version) ---
+        answer_key = get_answer_key(test_id)
 
-        if not test_doc.exists:
-            print(f"❌ Test not found during submission: {test_id}")
+        if answer_key is None:
+            attempts_log.warning("Test not found during submission: %s", test_id)
             return jsonify({'error': 'Test not found'}), 404
 
-        test_data = test_doc.to_dict()
-        questions = test_data.get('questions', [])
-        total_test_marks = test_data.get('totalMarks', 0)
+        total_test_marks = answer_key.total_marks
 
-        if not questions:
+        if answer_key.count == 0:
             return jsonify({'error': 'Test has no questions to evaluate'}), 400
 
         # --- Evaluate Answers ---
-        score = 0.0 # Use float for potential fractions
-        correct_count = 0
-        wrong_count = 0
-        unattempted_count = 0
-        evaluated_answers = {} # Store evaluation details per question if needed
-
-        for i, q in enumerate(questions):
-            q_index_str = str(i) # Answers dict uses string index
-            student_answer = student_answers.get(q_index_str)
-            q_marks = float(q.get('marks', 0))
-            q_negative_marks = float(q.get('negativeMarks', 0))
-            q_type = q.get('type')
-            is_correct = False
-
-            # Handle unattempted first
-            if student_answer is None or student_answer == '':
-                unattempted_count += 1
-                evaluated_answers[q_index_str] = {'status': 'unattempted'}
-                continue
-
-            try:
-                if q_type == 'mcq':
-                    correct_answer = q.get('correctAnswer') # e.g., "A"
-                    if student_answer == correct_answer:
-                        is_correct = True
-                    else:
-                        score -= q_negative_marks
-                        wrong_count += 1
-                elif q_type == 'msq':
-                    correct_answers_set = set(q.get('correctAnswers', [])) # e.g., {"B", "C"}
-                    # Ensure student_answer is a list/set before comparison
-                    student_answers_list = student_answer if isinstance(student_answer, list) else [student_answer]
-                    student_answers_set = set(student_answers_list)
-                    # Full marks only if sets are identical
-                    if student_answers_set == correct_answers_set and len(student_answers_set) > 0 : # Check not empty
-                        is_correct = True
-                    else:
-                        # MSQ has no negative marking
-                        wrong_count += 1 # Any deviation from perfect answer is wrong
-                elif q_type == 'numerical':
-                    correct_num = float(q.get('correctAnswer', float('inf')))
-                    tolerance = float(q.get('tolerance', 0))
-                    try:
-                        # Convert student answer string to float for comparison
-                         student_num = float(student_answer)
-                         if abs(student_num - correct_num) <= tolerance:
-                            is_correct = True
-                         else:
-                            # Numerical has no negative marking
-                            wrong_count += 1
-                    except (ValueError, TypeError):
-                         print(f"⚠️ Invalid numerical input '{student_answer}' for Q{i+1}")
-                         wrong_count += 1 # Invalid format is wrong
-                elif q_type == 'true-false':
-                     correct_bool = q.get('correctAnswer') # Should be True or False
-                     # Convert submitted string answer ('true'/'false') to boolean
-                     student_bool = str(student_answer).lower() == 'true'
-                     if student_bool == correct_bool:
-                         is_correct = True
-                     else:
-                        score -= q_negative_marks # Assume T/F has negative marking like MCQ
-                        wrong_count += 1
-                # Add other question type evaluations here
-
-                # Update score and counts based on evaluation
-                if is_correct:
-                    score += q_marks
-                    correct_count += 1
-                    evaluated_answers[q_index_str] = {'status': 'correct'}
-                elif q_type not in ['mcq', 'true-false']: # Only add to wrong if not already handled by negative mark logic
-                    # wrong_count was already incremented where needed above
-                    evaluated_answers[q_index_str] = {'status': 'wrong'}
-                else: # MCQ/TF wrong case already handled score/count
-                     evaluated_answers[q_index_str] = {'status': 'wrong'}
-
-
-            except Exception as eval_error:
-                 print(f"⚠️ Error evaluating Q{i+1} (type: {q_type}, answer: {student_answer}): {eval_error}")
-                 wrong_count += 1 # Mark as wrong if evaluation logic fails
-                 evaluated_answers[q_index_str] = {'status': 'error'}
+        score, correct_count, wrong_count, unattempted_count = score_submission(answer_key, student_answers)
 
         # Calculate percentage
         percentage = (score / total_test_marks * 100) if total_test_marks > 0 else 0
@@ -961,8 +2660,8 @@ def submit_test_attempt(test_id):
         attempt_data = {
             'userId': user_id,
             'testId': test_id,
-            'testTitle': test_data.get('name', 'Test'),
-            'subject': test_data.get('subject', ''),
+            'testTitle': answer_key.test_name,
+            'subject': answer_key.subject,
             'score': round(score, 2), # Round final score
             'totalMarks': total_test_marks,
             'percentage': round(percentage, 2),
@@ -972,55 +2671,24 @@ def submit_test_attempt(test_id):
             'timeTaken': time_taken,
             'submittedAt': datetime.now(),
             'answers': student_answers, # Store what the student submitted
-            # 'evaluation': evaluated_answers # Optionally store detailed evaluation status
+            'postProcessingPending': True, # Cleared once stats/leaderboard are updated
         }
-        attempt_ref = db.collection('testAttempts').add(attempt_data)
-        print(f"✅ Test attempt saved: {attempt_ref[1].id} for user {user_id} - Score: {score}/{total_test_marks}")
-
-        # --- Update User Stats ---
-        @firestore.transactional
-        def update_user_stats(transaction, user_ref, new_percentage):
-            user_snapshot = user_ref.get(transaction=transaction)
-            if not user_snapshot.exists:
-                print(f"⚠️ User {user_id} not found, cannot update stats.")
-                return
-
-            user_data = user_snapshot.to_dict()
-            stats = user_data.get('stats', {})
-
-            # Get current values, default to 0 if not present
-            current_attempts = stats.get('testsAttempted', 0)
-            current_sum = stats.get('totalPercentageSum', 0)
-
-            # Calculate new values
-            new_attempts = current_attempts + 1
-            new_sum = current_sum + new_percentage
-            new_average = new_sum / new_attempts if new_attempts > 0 else 0
-
-            # Update the stats map
-            transaction.update(user_ref, {
-                'stats.testsAttempted': new_attempts,
-                'stats.totalPercentageSum': new_sum,
-                'stats.avgScore': round(new_average, 2), # Store the new average
-                'updatedAt': firestore.SERVER_TIMESTAMP
-            })
-            print(f"✅ Updated stats for user {user_id}: AvgScore={new_average:.2f}")
-
+        attempt_ref = attempt_ref_for(user_id, test_id)
         try:
-            user_ref = db.collection('users').document(user_id)
-            # Use the new percentage from this attempt
-            new_percentage_from_this_test = round(percentage, 2) 
-            
-            transaction = db.transaction()
-            update_user_stats(transaction, user_ref, new_percentage_from_this_test)
-            
-        except Exception as stat_e:
-            print(f"⚠️ Failed to update user stats after test submission: {stat_e}")
-        # --- End Update User Stats ---
+            # Fails if the attempt exists, so double-clicks and retries cannot save twice
+            attempt_ref.create(attempt_data)
+        except AlreadyExists:
+            return already_attempted_response(user_id, test_id)
+        attempts_log.info("Test attempt saved: %s for user %s - score %s/%s", attempt_ref.id, user_id, score, total_test_marks,
+                          extra={'userId': user_id, 'testId': test_id, 'attemptId': attempt_ref.id})
+
+        # --- Derived Data (user stats, leaderboard) ---
+        # The attempt is durably written; everything else happens off the request thread
+        enqueue_post_submission(attempt_ref.id, attempt_data)
 
         # --- Return Result Summary to Frontend ---
         result_summary = {
-            'attemptId': attempt_ref[1].id,
+            'attemptId': attempt_ref.id,
             'score': round(score, 2),
             'totalMarks': total_test_marks,
             'percentage': round(percentage, 2),
@@ -1033,8 +2701,7 @@ def submit_test_attempt(test_id):
         return jsonify({'success': True, 'data': result_summary}), 200
 
     except Exception as e:
-        print(f"❌ Error submitting test {test_id} for user {user_id}: {str(e)}")
-        traceback.print_exc()
+        attempts_log.exception("Error submitting test %s for user %s", test_id, request.user_id)
         return jsonify({'error': 'Failed to submit test attempt', 'details': str(e)}), 500
 
 
@@ -1044,7 +2711,14 @@ def submit_test_attempt(test_id):
 @app.route('/api/user/test-attempts', methods=['GET'])
 @verify_firebase_token
 def get_user_test_attempts():
-    """Fetches summaries of the current user's past test attempts."""
+    """
+    Fetches summaries of the current user's past test attempts, newest first.
+
+    Query params:
+        testId: only attempts at this test
+        limit:  attempts per page (default LIST_PAGE_SIZE)
+        cursor: nextCursor from the previous page
+    """
     try:
         user_id = request.user_id
         test_id_filter = request.args.get('testId') # Optional filter
@@ -1054,46 +2728,54 @@ def get_user_test_attempts():
         if test_id_filter:
             attempts_query = attempts_query.where('testId', '==', test_id_filter)
 
-        # Order by submission time, newest first
-        attempts_query = attempts_query.order_by('submittedAt', direction=firestore.Query.DESCENDING)
-
-        attempts_list = []
-        for doc in attempts_query.stream():
-            attempt_data = doc.to_dict()
-            # Convert timestamp to ISO string for JSON compatibility
-            submitted_at_iso = None
-            if 'submittedAt' in attempt_data and hasattr(attempt_data['submittedAt'], 'isoformat'):
-                submitted_at_iso = attempt_data['submittedAt'].isoformat() + "Z" # Add Z for UTC
-
-            attempt_summary = {
-                'id': doc.id, # Attempt document ID
-                'testId': attempt_data.get('testId'),
-                'testTitle': attempt_data.get('testTitle', 'Test'),
-                'subject': attempt_data.get('subject', ''),
-                'score': attempt_data.get('score'),
-                'totalMarks': attempt_data.get('totalMarks'),
-                'percentage': attempt_data.get('percentage'),
-                'submittedAt': submitted_at_iso,
-                'correctAnswers': attempt_data.get('correctAnswers'),
-                'wrongAnswers': attempt_data.get('wrongAnswers'),
-                'unattempted': attempt_data.get('unattempted'),
-                'timeTaken': attempt_data.get('timeTaken')
-            }
-            attempts_list.append(attempt_summary)
+        # Order by submission time, newest first, one page at a time
+        try:
+            page = QueryPage(attempts_query, 'submittedAt', get_page_size(LIST_PAGE_SIZE, LIST_MAX_PAGE_SIZE),
+                             request.args.get('cursor'))
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+
+        def attempt_summaries():
+            count = 0
+            for doc in page:
+                attempt_data = doc.to_dict()
+                # Convert timestamp to ISO string for JSON compatibility
+                submitted_at_iso = None
+                if 'submittedAt' in attempt_data and hasattr(attempt_data['submittedAt'], 'isoformat'):
+                    submitted_at_iso = attempt_data['submittedAt'].isoformat() + "Z" # Add Z for UTC
+
+                attempt_summary = {
+                    'id': doc.id, # Attempt document ID
+                    'testId': attempt_data.get('testId'),
+                    'testTitle': attempt_data.get('testTitle', 'Test'),
+                    'subject': attempt_data.get('subject', ''),
+                    'score': attempt_data.get('score'),
+                    'totalMarks': attempt_data.get('totalMarks'),
+                    'percentage': attempt_data.get('percentage'),
+                    'submittedAt': submitted_at_iso,
+                    'correctAnswers': attempt_data.get('correctAnswers'),
+                    'wrongAnswers': attempt_data.get('wrongAnswers'),
+                    'unattempted': attempt_data.get('unattempted'),
+                    'timeTaken': attempt_data.get('timeTaken')
+                }
+                count += 1
+                yield attempt_summary
 
-        print(f"✅ Fetched {len(attempts_list)} attempt summaries for user {user_id}")
+            attempts_log.debug("Streamed %d attempt summaries for user %s", count, user_id)
 
-        return jsonify({'success': True, 'data': attempts_list}), 200
+        return stream_json_list(attempt_summaries(), tail=lambda: {'nextCursor': page.next_cursor}), 200
 
     except Exception as e:
-        print(f"❌ Error fetching user test attempts for user {user_id}: {str(e)}")
-        traceback.print_exc()
+        attempts_log.exception("Error fetching user test attempts for user %s", request.user_id)
         return jsonify({'error': 'Failed to fetch test attempts', 'details': str(e)}), 500
 
 
 # ============================================
 # 4. GET SPECIFIC TEST ATTEMPT RESULT - UPDATED
 # ============================================
+# The review only needs the test's version; its questions come from the bank
+REVIEW_TEST_FIELDS = ['name']
+
 @app.route('/api/user/test-attempts/<attempt_id>', methods=['GET'])
 @verify_firebase_token
 def get_specific_test_attempt(attempt_id):
@@ -1101,6 +2783,12 @@ def get_specific_test_attempt(attempt_id):
     try:
         user_id = request.user_id
 
+        # The test is known from the attempt ID, so read it alongside the attempt
+        expected_test_id = test_id_from_attempt_id(user_id, attempt_id)
+        test_future = None
+        if expected_test_id:
+            test_future = submit_fetch(read_test_version, expected_test_id, REVIEW_TEST_FIELDS)
+
         attempt_doc_ref = db.collection('testAttempts').document(attempt_id)
         attempt_doc = attempt_doc_ref.get()
 
@@ -1111,7 +2799,8 @@ def get_specific_test_attempt(attempt_id):
 
         # Verify ownership
         if attempt_data.get('userId') != user_id:
-            print(f"🚫 Access denied: User {user_id} tried to access attempt {attempt_id} belonging to {attempt_data.get('userId')}")
+            attempts_log.warning("Access denied: user %s tried to access attempt %s belonging to %s",
+                                 user_id, attempt_id, attempt_data.get('userId'))
             return jsonify({'error': 'Access denied to this test result'}), 403
 
         # Convert timestamp
@@ -1119,29 +2808,33 @@ def get_specific_test_attempt(attempt_id):
              attempt_data['submittedAt'] = attempt_data['submittedAt'].isoformat() + "Z"
 
         # 🆕 FETCH ORIGINAL TEST WITH FULL QUESTIONS (INCLUDING SOLUTION IMAGES)
+        question_bank = None
         try:
-            test_doc_ref = db.collection('tests').document(attempt_data['testId'])
-            test_doc = test_doc_ref.get()
+            if test_future is not None and attempt_data['testId'] == expected_test_id:
+                test_doc, question_bank = test_future.result()
+            else:
+                test_doc, question_bank = read_test_version(attempt_data['testId'], REVIEW_TEST_FIELDS)
             if test_doc.exists:
-                original_test_data = test_doc.to_dict()
-                
                 # 🆕 INCLUDE FULL QUESTIONS WITH CORRECT ANSWERS, EXPLANATIONS, AND SOLUTION IMAGES
-                attempt_data['testQuestions'] = original_test_data.get('questions', [])
+                attempt_data['testQuestions'] = question_bank.review_questions
                 
-                print(f"✅ Fetched {len(attempt_data['testQuestions'])} questions WITH answers/explanations/images for review")
+                attempts_log.debug("Fetched %d questions with answers for review", len(attempt_data['testQuestions']))
             else:
-                print(f"⚠️ Original test document {attempt_data['testId']} not found for review.")
+                attempts_log.warning("Original test document %s not found for review", attempt_data['testId'])
                 attempt_data['testQuestions'] = []
         except Exception as test_fetch_e:
-             print(f"⚠️ Could not fetch original test details for attempt review: {test_fetch_e}")
+             attempts_log.warning("Could not fetch original test details for attempt review: %s", test_fetch_e)
              attempt_data['testQuestions'] = []
 
-        print(f"✅ Fetched detailed attempt {attempt_id} for user {user_id}")
+        cached = not_modified('attempt', attempt_id, attempt_doc.update_time, question_bank.id if question_bank else None)
+        if cached:
+            return cached
+
+        attempts_log.debug("Fetched detailed attempt %s for user %s", attempt_id, user_id)
         return jsonify({'success': True, 'data': attempt_data}), 200
 
     except Exception as e:
-        print(f"❌ Error fetching specific test attempt {attempt_id}: {str(e)}")
-        traceback.print_exc()
+        attempts_log.exception("Error fetching specific test attempt %s", attempt_id)
         return jsonify({'error': 'Failed to fetch test result details', 'details': str(e)}), 500
 
 # ============================================
@@ -1158,17 +2851,11 @@ def check_test_attempt(test_id):
     try:
         user_id = request.user_id
 
-        # Query testAttempts collection for this user and test
-        attempts_query = db.collection('testAttempts') \
-            .where('userId', '==', user_id) \
-            .where('testId', '==', test_id) \
-            .limit(1)
-        
-        attempts = list(attempts_query.stream())
-        
-        if attempts:
+        # Direct get of testAttempts/<userId>_<testId>
+        attempt_doc = find_test_attempt(user_id, test_id)
+
+        if attempt_doc is not None:
             # User has attempted this test
-            attempt_doc = attempts[0]
             attempt_data = attempt_doc.to_dict()
             attempt_data['id'] = attempt_doc.id
             
@@ -1176,7 +2863,7 @@ def check_test_attempt(test_id):
             if 'submittedAt' in attempt_data and hasattr(attempt_data['submittedAt'], 'isoformat'):
                 attempt_data['submittedAt'] = attempt_data['submittedAt'].isoformat() + "Z"
             
-            print(f"✅ User {user_id} has already attempted test {test_id}")
+            attempts_log.debug("User %s has already attempted test %s", user_id, test_id)
             
             return jsonify({
                 'success': True,
@@ -1187,7 +2874,7 @@ def check_test_attempt(test_id):
             }), 200
         else:
             # User has NOT attempted this test
-            print(f"ℹ️ User {user_id} has NOT attempted test {test_id}")
+            attempts_log.debug("User %s has not attempted test %s", user_id, test_id)
             
             return jsonify({
                 'success': True,
@@ -1198,11 +2885,37 @@ def check_test_attempt(test_id):
             }), 200
 
     except Exception as e:
-        print(f"❌ Error checking attempt for test {test_id}: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        attempts_log.exception("Error checking attempt for test %s", test_id)
         return jsonify({'error': 'Failed to check attempt status', 'details': str(e)}), 500
 
+# Attempt totals per test, summed from the test's counter shards
+test_stats_cache = TTLCache(maxsize=500, ttl=CATALOG_REFRESH_SECONDS)
+
+@app.route('/api/tests/<test_id>/stats', methods=['GET'])
+@verify_firebase_token
+def get_test_stats(test_id):
+    """How many students attempted a test and their average score (refreshed every CATALOG_REFRESH_SECONDS)."""
+    try:
+        totals = test_stats_cache.get(test_id)
+        if totals is None:
+            totals = test_counters.total(test_id)
+            test_stats_cache.set(test_id, totals)
+
+        attempts = totals.get('attempts', 0)
+        return jsonify({
+            'success': True,
+            'data': {
+                'testId': test_id,
+                'attemptCount': attempts,
+                'avgScore': round(totals.get('scoreSum', 0) / attempts, 2) if attempts else 0,
+                'avgPercentage': round(totals.get('percentageSum', 0) / attempts, 2) if attempts else 0
+            }
+        }), 200
+
+    except Exception as e:
+        tests_log.exception("Error fetching stats for test %s", test_id)
+        return jsonify({'error': 'Failed to fetch test stats', 'details': str(e)}), 500
+
 
 @app.route('/api/user/test-attempts', methods=['GET'])
 @verify_firebase_token
@@ -1254,14 +2967,12 @@ def get_all_user_attempts():
             }
             attempts_list.append(attempt_summary)
 
-        print(f"✅ Fetched {len(attempts_list)} attempt summaries for user {user_id}")
+        attempts_log.debug("Fetched %d attempt summaries for user %s", len(attempts_list), user_id)
 
         return jsonify({'success': True, 'data': attempts_list}), 200
 
     except Exception as e:
-        print(f"❌ Error fetching user test attempts: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        attempts_log.exception("Error fetching user test attempts")
         return jsonify({'error': 'Failed to fetch test attempts', 'details': str(e)}), 500
 
 # ============================================
@@ -1271,23 +2982,20 @@ def get_all_user_attempts():
 @app.route('/api/doubts', methods=['GET'])
 @verify_firebase_token
 def get_doubts():
-    """Get user's doubts"""
+    """Get user's doubts (paged like /api/user/test-attempts: ?limit=&cursor=)"""
     try:
         user_id = request.user_id
         
-        # Get doubts for this user
-        doubts_ref = db.collection('doubts').where('userId', '==', user_id).order_by('createdAt', direction=firestore.Query.DESCENDING)
-        
-        doubts = []
-        for doc in doubts_ref.stream():
-            doubt_data = doc.to_dict()
-            doubt_data['id'] = doc.id
-            doubts.append(doubt_data)
-        
-        return jsonify({
-            'success': True,
-            'data': doubts
-        }), 200
+        # Get doubts for this user, newest first, one page at a time
+        doubts_ref = db.collection('doubts').where('userId', '==', user_id)
+        try:
+            page = QueryPage(doubts_ref, 'createdAt', get_page_size(LIST_PAGE_SIZE, LIST_MAX_PAGE_SIZE),
+                             request.args.get('cursor'))
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+
+        doubts = (dict(doc.to_dict(), id=doc.id) for doc in page)
+        return stream_json_list(doubts, tail=lambda: {'nextCursor': page.next_cursor}), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1309,11 +3017,11 @@ def submit_doubt():
         # Get User's Name
         user_name = "Student" # Default name
         try:
-            user_doc = db.collection('users').document(user_id).get()
-            if user_doc.exists:
-                user_name = user_doc.to_dict().get('name', user_doc.to_dict().get('displayName', "Student"))
+            user_data = get_user_data(user_id)
+            if user_data is not None:
+                user_name = user_data.get('name', user_data.get('displayName', "Student"))
         except Exception as e:
-            print(f"⚠️ Could not fetch user name for {user_id}: {e}")
+            doubts_log.warning("Could not fetch user name for %s: %s", user_id, e)
 
         # Create Initial Conversation Log Entry
         # --- Use datetime.now() instead of SERVER_TIMESTAMP ---
@@ -1348,10 +3056,11 @@ def submit_doubt():
             db.collection('users').document(user_id).update({
                 'stats.doubtsAsked': firestore.Increment(1)
             })
+            invalidate_user_data(user_id)
         except Exception as e:
-             print(f"⚠️ Could not update user stats for {user_id}: {e}")
+             doubts_log.warning("Could not update user stats for %s: %s", user_id, e)
 
-        print(f"✅ Doubt created with conversation log: {doubt_ref[1].id} by {user_name}")
+        doubts_log.info("Doubt created with conversation log: %s by %s", doubt_ref[1].id, user_name)
 
         return jsonify({
             'success': True,
@@ -1360,9 +3069,7 @@ def submit_doubt():
         }), 201
 
     except Exception as e:
-        print(f"❌ Error submitting doubt: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        doubts_log.exception("Error submitting doubt")
         return jsonify({'error': f'Internal server error: {str(e)}'}), 500
 
 # ============================================
@@ -1483,6 +3190,7 @@ def verify_payment():
                 'enrolledCourses': firestore.ArrayUnion([course_name]),
                 'updatedAt': datetime.now()
             })
+        invalidate_user_data(user_id)
         
         return jsonify({
             'success': True,
@@ -1571,12 +3279,12 @@ def get_user_stats():
     try:
         user_id = request.user_id
         
-        user_doc = db.collection('users').document(user_id).get()
+        user_data = get_user_data(user_id)
         
-        if not user_doc.exists:
+        if user_data is None:
             return jsonify({'error': 'User not found'}), 404
         
-        stats = user_doc.to_dict().get('stats', {})
+        stats = user_data.get('stats', {})
         
         return jsonify({
             'success': True,
@@ -1597,17 +3305,15 @@ def track_video_watched():
         video_id = data.get('videoId')
         progress = data.get('progress', 0)  # 0-100
         
-        # Update stats
-        db.collection('users').document(user_id).update({
-            'stats.videosWatched': firestore.Increment(1)
-        })
-        
-        # Track individual video progress
-        db.collection('users').document(user_id).collection('videoProgress').document(video_id).set({
+        # Update stats and individual video progress with the next buffered flush.
+        # Cached copies of the user pick the new count up within WRITE_BUFFER_INTERVAL + USER_CACHE_TTL.
+        user_ref = db.collection('users').document(user_id)
+        write_buffer.increment(user_ref, 'stats.videosWatched')
+        write_buffer.set(user_ref.collection('videoProgress').document(video_id), {
             'videoId': video_id,
             'progress': progress,
             'lastWatched': datetime.now()
-        }, merge=True)
+        })
         
         return jsonify({
             'success': True,
@@ -1617,6 +3323,233 @@ def track_video_watched():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# ============================================
+# LEADERBOARD SNAPSHOTS
+# ============================================
+# Every test has a precomputed leaderboard document at leaderboards/<test_id>
+# whose `entries` are the top LEADERBOARD_TOP_K attempts as compact rows, sorted
+# by score (desc), then submit time. The cap keeps the document far below
+# Firestore's 1 MiB limit however many students take a mock (_cap_leaderboard
+# also trims by size), and once the board is full only attempts that make the
+# top K write to it, so a burst of submissions doesn't queue on one document.
+# The header stats (attempt count, average) and the rank of a student below the
+# top K are count/avg aggregations over testAttempts (composite index on
+# testId + score).
+# The post-submission pipeline (update_leaderboard_step) inserts each attempt
+# into the snapshot incrementally; `flask rebuild-leaderboards` recomputes it
+# from testAttempts (backfill / consistency check).
+
+LEADERBOARD_MAX_BYTES = 800 * 1024  # size guard, below the 1 MiB document limit
+
+LEADERBOARD_ENTRY_FIELDS = [
+    'userId', 'score', 'percentage', 'correctAnswers',
+    'wrongAnswers', 'timeTaken', 'submittedAt'
+]
+
+def to_iso_timestamp(value):
+    """Converts a Firestore/datetime timestamp to the ISO string the frontend expects."""
+    try:
+        # Check if it's already a datetime object
+        if isinstance(value, datetime):
+            return value.isoformat() + "Z"
+        # Check if it's a Firestore Timestamp
+        if hasattr(value, 'seconds'):
+            return datetime.fromtimestamp(value.seconds).isoformat() + "Z"
+        # Check if it has _seconds (older format)
+        if hasattr(value, '_seconds'):
+            return datetime.fromtimestamp(value._seconds).isoformat() + "Z"
+        # If it's already a string, validate and keep it
+        if isinstance(value, str):
+            datetime.fromisoformat(value.replace('Z', ''))
+            return value
+    except Exception as ts_error:
+        leaderboard_log.warning("Timestamp conversion error for value %r: %s", value, ts_error)
+        return None
+
+    if value is not None:
+        leaderboard_log.warning("Unknown timestamp type: %s", type(value))
+    return None
+
+def _timestamp_seconds(value):
+    if isinstance(value, datetime):
+        # Firestore stores naive datetimes as UTC
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    return float('inf')
+
+def leaderboard_sort_key(entry):
+    """Higher score first; ties go to the earlier submission."""
+    return (-(entry.get('score') or 0), _timestamp_seconds(entry.get('submittedAt')), entry.get('attemptId', ''))
+
+def decode_leaderboard_cursor(cursor):
+    """A leaderboard_sort_key() tuple from a cursor. Raises ValueError unless it is [number, number, str]."""
+    values = decode_cursor(cursor)
+    if (len(values) != 3 or not isinstance(values[2], str) or
+            not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values[:2])):
+        raise ValueError('Invalid cursor')
+    return tuple(values)
+
+def make_leaderboard_entry(attempt_id, attempt_data):
+    entry = {field: attempt_data.get(field) for field in LEADERBOARD_ENTRY_FIELDS}
+    entry['attemptId'] = attempt_id
+    entry['score'] = entry['score'] or 0
+    entry['percentage'] = entry['percentage'] or 0
+    return entry
+
+def _cap_leaderboard(board):
+    """Trims board['entries'] to LEADERBOARD_TOP_K rows, and further if they exceed LEADERBOARD_MAX_BYTES."""
+    entries = board['entries']
+    del entries[LEADERBOARD_TOP_K:]
+    size = len(json.dumps(board, default=str))  # close to the stored document size
+    if size > LEADERBOARD_MAX_BYTES:
+        keep = int(len(entries) * LEADERBOARD_MAX_BYTES / size * 0.9)
+        leaderboard_log.warning("Leaderboard %s is %d bytes with %d rows; keeping the top %d",
+                                board.get('testId'), size, len(entries), keep)
+        del entries[keep:]
+    return board
+
+def build_leaderboard(test_id, test_data, attempts):
+    """
+    Builds a leaderboard document from (attempt_id, attempt_data) pairs.
+    Only the first submission of each user is ranked; the top LEADERBOARD_TOP_K are kept.
+    """
+    entries = [make_leaderboard_entry(attempt_id, data) for attempt_id, data in attempts if data.get('userId')]
+    entries.sort(key=lambda e: (_timestamp_seconds(e.get('submittedAt')), e['attemptId']))
+
+    ranked_entries = []
+    ranked_users = set()
+    for entry in entries:
+        if entry['userId'] in ranked_users:
+            continue
+        ranked_users.add(entry['userId'])
+        ranked_entries.append(entry)
+    ranked_entries.sort(key=leaderboard_sort_key)
+
+    return _cap_leaderboard({
+        'testId': test_id,
+        'testName': test_data.get('name', 'Test'),
+        'totalMarks': test_data.get('totalMarks', 0),
+        'entries': ranked_entries,
+        'updatedAt': datetime.now()
+    })
+
+def _build_leaderboard_in_transaction(transaction, test_id, test_data):
+    attempts_query = db.collection('testAttempts').where('testId', '==', test_id).select(LEADERBOARD_ENTRY_FIELDS)
+    attempts = ((doc.id, doc.to_dict()) for doc in attempts_query.stream(transaction=transaction))
+    return build_leaderboard(test_id, test_data, attempts)
+
+@firestore.transactional
+def _rebuild_leaderboard(transaction, board_ref, test_id, test_data):
+    board_ref.get(transaction=transaction)  # lock the snapshot against concurrent inserts
+    board = _build_leaderboard_in_transaction(transaction, test_id, test_data)
+    transaction.set(board_ref, board)
+    return board
+
+def leaderboard_has_room_for(board, entry):
+    """Whether `entry` makes the board's top LEADERBOARD_TOP_K."""
+    entries = board.get('entries', [])
+    return len(entries) < LEADERBOARD_TOP_K or leaderboard_sort_key(entry) < leaderboard_sort_key(entries[-1])
+
+@firestore.transactional
+def _insert_leaderboard_entry(transaction, board_ref, test_id, test_data, entry):
+    snapshot = board_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        # First write for this test: backfill from testAttempts (includes this entry)
+        board = _build_leaderboard_in_transaction(transaction, test_id, test_data)
+        transaction.set(board_ref, board)
+        return board
+
+    board = snapshot.to_dict()
+    entries = board.setdefault('entries', [])
+    if any(e.get('userId') == entry['userId'] for e in entries) or not leaderboard_has_room_for(board, entry):
+        return board  # already ranked (retry or duplicate attempt), or below the top K
+
+    bisect.insort(entries, entry, key=leaderboard_sort_key)
+    for legacy_field in ('userScores', 'totalAttempts', 'percentageSum'):
+        board.pop(legacy_field, None)  # uncapped aggregates of older snapshots
+    board['testName'] = test_data.get('name', board.get('testName', 'Test'))
+    board['totalMarks'] = test_data.get('totalMarks', board.get('totalMarks', 0))
+    board['updatedAt'] = datetime.now()
+    transaction.set(board_ref, _cap_leaderboard(board))
+    return board
+
+def add_attempt_to_leaderboard(test_id, test_data, attempt_id, attempt_data):
+    """Inserts a freshly saved attempt into the test's leaderboard snapshot if it makes the top K."""
+    board_ref = db.collection('leaderboards').document(test_id)
+    entry = make_leaderboard_entry(attempt_id, attempt_data)
+    # Once the board is full most attempts rank below its last row; those skip the transaction
+    board_doc = board_ref.get()
+    if board_doc.exists and not leaderboard_has_room_for(board_doc.to_dict(), entry):
+        return board_doc.to_dict()
+    return _insert_leaderboard_entry(db.transaction(), board_ref, test_id, test_data, entry)
+
+def rebuild_leaderboard(test_id):
+    """Recomputes leaderboards/<test_id> from testAttempts. Returns None if the test is missing."""
+    test_doc = db.collection('tests').document(test_id).get(field_paths=['name', 'totalMarks'])
+    if not test_doc.exists:
+        return None
+    board_ref = db.collection('leaderboards').document(test_id)
+    return _rebuild_leaderboard(db.transaction(), board_ref, test_id, test_doc.to_dict())
+
+def get_leaderboard(test_id):
+    """Single-document read of the snapshot, built on first use for older tests."""
+    board_doc = db.collection('leaderboards').document(test_id).get()
+    if board_doc.exists:
+        return board_doc.to_dict()
+    leaderboard_log.info("No leaderboard snapshot for test %s, building it now", test_id)
+    return rebuild_leaderboard(test_id)
+
+# (attempt count, average percentage) per test
+leaderboard_stats_cache = TTLCache(maxsize=500, ttl=LEADERBOARD_STATS_TTL)
+
+def get_leaderboard_stats(test_id):
+    """Attempt count and average percentage of a test, from one aggregation query (cached briefly)."""
+    stats = leaderboard_stats_cache.get(test_id)
+    if stats is None:
+        attempts_query = db.collection('testAttempts').where('testId', '==', test_id)
+        results = attempts_query.count(alias='attempts').avg('percentage', alias='avgPercentage').get()
+        values = {result.alias: result.value for result in results[0]}
+        stats = (values.get('attempts') or 0, values.get('avgPercentage') or 0)
+        leaderboard_stats_cache.set(test_id, stats)
+    return stats
+
+def count_scores_above(entries, score):
+    """Number of ranked entries with a strictly higher score (binary search)."""
+    return bisect.bisect_left(entries, -score, key=lambda e: -(e.get('score') or 0))
+
+def count_attempts_above(test_id, score):
+    """Number of attempts at a test with a strictly higher score (one count aggregation)."""
+    attempts_query = db.collection('testAttempts').where('testId', '==', test_id).where('score', '>', score)
+    return attempts_query.count(alias='above').get()[0][0].value
+
+def find_leaderboard_rank(test_id, board, attempt_doc):
+    """
+    Returns (rank, entry) for a student's attempt, or (None, None) without one.
+    Ranks are competition ranks (ties share a rank): 1 + attempts scoring higher,
+    found on the snapshot when the attempt is on it, else counted in testAttempts.
+    """
+    if attempt_doc is None:
+        return None, None
+
+    entry = make_leaderboard_entry(attempt_doc.id, attempt_doc.to_dict())
+    entries = board.get('entries', [])
+    index = count_scores_above(entries, entry['score'])
+    for ranked in entries[index:]:
+        if ranked.get('score') != entry['score']:
+            break
+        if ranked.get('attemptId') == entry['attemptId']:
+            return index + 1, ranked
+    return count_attempts_above(test_id, entry['score']) + 1, entry
+
+def format_leaderboard_row(entry, rank, user_names):
+    row = {field: entry.get(field) for field in LEADERBOARD_ENTRY_FIELDS}
+    row['id'] = entry.get('attemptId')
+    row['rank'] = rank
+    row['submittedAt'] = to_iso_timestamp(entry.get('submittedAt'))
+    row['userName'] = user_names.get(entry.get('userId'), 'Anonymous')
+    return row
+
 # ============================================
 # FEATURE 3: LEADERBOARD ENDPOINT
 # ============================================
@@ -1626,104 +3559,35 @@ def track_video_watched():
 def get_student_leaderboard(test_id):
     """
     Get leaderboard for a specific test.
+
+    Query params:
+        limit:  rows per page (default LEADERBOARD_PAGE_SIZE)
+        cursor: nextCursor from the previous page
     """
     try:
         user_id = request.user_id
+        limit = get_page_size(LEADERBOARD_PAGE_SIZE, LEADERBOARD_MAX_PAGE_SIZE)
+        cursor = request.args.get('cursor')
         
-        print(f"📊 Leaderboard request for test {test_id} by user {user_id}")
+        leaderboard_log.debug("Leaderboard request for test %s by user %s", test_id, user_id)
 
-        # --- Fetch Test Details ---
-        test_doc_ref = db.collection('tests').document(test_id)
-        test_doc = test_doc_ref.get()
+        # --- Fetch Snapshot, the student's own attempt and the header stats together ---
+        board, own_attempt, (total_attempts, avg_percentage) = parallel_fetch(
+            partial(get_leaderboard, test_id),
+            partial(find_test_attempt, user_id, test_id),
+            partial(get_leaderboard_stats, test_id)
+        )
 
-        if not test_doc.exists:
-            print(f"❌ Test not found: {test_id}")
+        if board is None:
+            leaderboard_log.info("Test not found: %s", test_id)
             return jsonify({'error': 'Test not found'}), 404
 
-        test_data = test_doc.to_dict()
-        test_name = test_data.get('name', 'Test')
-        total_marks = test_data.get('totalMarks', 0)
-        
-        print(f"✅ Test found: {test_name}, Total Marks: {total_marks}")
-
-        # --- Fetch All Attempts for This Test ---
-        try:
-            attempts_query = db.collection('testAttempts') \
-                .where('testId', '==', test_id) \
-                .order_by('score', direction=firestore.Query.DESCENDING)
-
-            attempts_list = []
-            for doc in attempts_query.stream():
-                attempt_data = doc.to_dict()
-                attempt_data['id'] = doc.id
-                
-                # ✅ IMPROVED TIMESTAMP CONVERSION
-                if 'submittedAt' in attempt_data:
-                    submitted_at = attempt_data['submittedAt']
-                    
-                    try:
-                        # Check if it's already a datetime object
-                        if isinstance(submitted_at, datetime):
-                            attempt_data['submittedAt'] = submitted_at.isoformat() + "Z"
-                        # Check if it's a Firestore Timestamp
-                        elif hasattr(submitted_at, 'seconds'):
-                            # Convert Firestore Timestamp to datetime
-                            timestamp_datetime = datetime.fromtimestamp(submitted_at.seconds)
-                            attempt_data['submittedAt'] = timestamp_datetime.isoformat() + "Z"
-                        # Check if it has _seconds (older format)
-                        elif hasattr(submitted_at, '_seconds'):
-                            timestamp_datetime = datetime.fromtimestamp(submitted_at._seconds)
-                            attempt_data['submittedAt'] = timestamp_datetime.isoformat() + "Z"
-                        # If it's already a string, validate and keep it
-                        elif isinstance(submitted_at, str):
-                            # Try to parse it to validate
-                            try:
-                                datetime.fromisoformat(submitted_at.replace('Z', ''))
-                                # It's valid, keep it
-                                pass
-                            except:
-                                # Invalid string, set to None
-                                print(f"⚠️ Invalid timestamp string: {submitted_at}")
-                                attempt_data['submittedAt'] = None
-                        else:
-                            print(f"⚠️ Unknown timestamp type: {type(submitted_at)}")
-                            attempt_data['submittedAt'] = None
-                    
-                    except Exception as ts_error:
-                        print(f"⚠️ Timestamp conversion error for attempt {doc.id}: {ts_error}")
-                        print(f"   Timestamp value: {submitted_at}")
-                        print(f"   Timestamp type: {type(submitted_at)}")
-                        attempt_data['submittedAt'] = None
-                else:
-                    attempt_data['submittedAt'] = None
-                
-                # Get user name
-                try:
-                    user_doc = db.collection('users').document(attempt_data.get('userId', '')).get()
-                    if user_doc.exists:
-                        attempt_data['userName'] = user_doc.to_dict().get('name', 'Anonymous')
-                    else:
-                        attempt_data['userName'] = 'Anonymous'
-                except:
-                    attempt_data['userName'] = 'Anonymous'
-                
-                attempts_list.append(attempt_data)
-            
-            print(f"✅ Found {len(attempts_list)} attempts")
-            
-        except Exception as query_error:
-            error_msg = str(query_error)
-            if 'index' in error_msg.lower() or 'requires an index' in error_msg.lower():
-                print(f"❌ Firestore index required! Error: {error_msg}")
-                return jsonify({
-                    'error': 'Database index required',
-                    'message': 'Please create a Firestore index to enable leaderboard sorting.'
-                }), 503
-            else:
-                raise query_error
+        test_name = board.get('testName', 'Test')
+        total_marks = board.get('totalMarks', 0)
+        entries = board.get('entries', [])
 
         # --- Handle Empty Leaderboard ---
-        if len(attempts_list) == 0:
+        if len(entries) == 0:
             return jsonify({
                 'success': True,
                 'data': {
@@ -1732,6 +3596,7 @@ def get_student_leaderboard(test_id):
                     'totalMarks': total_marks,
                     'totalAttempts': 0,
                     'attempts': [],
+                    'nextCursor': None,
                     'currentUser': {
                         'attempted': False,
                         'rank': None,
@@ -1743,32 +3608,54 @@ def get_student_leaderboard(test_id):
                 }
             }), 200
 
+        # --- Select Page ---
+        start = 0
+        if cursor:
+            try:
+                last_key = decode_leaderboard_cursor(cursor)
+            except ValueError:
+                return jsonify({'error': 'Invalid cursor'}), 400
+            start = bisect.bisect_right(entries, last_key, key=leaderboard_sort_key)
+        page = entries[start:start + limit]
+        next_cursor = None
+        if start + limit < len(entries):
+            next_cursor = encode_cursor(list(leaderboard_sort_key(page[-1])))
+
+        # --- Find Current User's Rank (count of higher scores) ---
+        current_user_rank, current_user_entry = find_leaderboard_rank(test_id, board, own_attempt)
+        # The stats may be a few seconds older than the snapshot and the rank count
+        total_attempts = max(total_attempts, len(entries), current_user_rank or 0)
+
+        user_names = resolve_user_names(
+            [e.get('userId') for e in page] + ([user_id] if current_user_entry else [])
+        )
+
+        cached = not_modified('leaderboard', test_id, board.get('updatedAt'), total_attempts, avg_percentage,
+                              start, limit, user_id, current_user_rank, sorted(user_names.items()))
+        if cached:
+            return cached
+
         # --- Assign Ranks ---
-        current_rank = 1
-        for i, attempt in enumerate(attempts_list):
-            if i > 0 and attempt.get('score', 0) < attempts_list[i-1].get('score', 0):
-                current_rank = i + 1
-            attempt['rank'] = current_rank
+        attempts_list = []
+        current_rank = None
+        for i, entry in enumerate(page):
+            score = entry.get('score') or 0
+            if current_rank is None:
+                current_rank = count_scores_above(entries, score) + 1
+            elif score < (page[i-1].get('score') or 0):
+                current_rank = start + i + 1
+            attempts_list.append(format_leaderboard_row(entry, current_rank, user_names))
 
-        # --- Find Current User's Attempt ---
         current_user_attempt = None
-        current_user_rank = None
         current_user_percentile = None
 
-        for attempt in attempts_list:
-            if attempt.get('userId') == user_id:
-                current_user_attempt = attempt
-                current_user_rank = attempt['rank']
-                
-                total_attempts = len(attempts_list)
-                current_user_percentile = ((total_attempts - current_user_rank + 1) / total_attempts) * 100
-                break
+        if current_user_entry is not None:
+            current_user_attempt = format_leaderboard_row(current_user_entry, current_user_rank, user_names)
+            current_user_percentile = ((total_attempts - current_user_rank + 1) / total_attempts) * 100
 
         # --- Calculate Stats ---
-        total_attempts = len(attempts_list)
-        percentages = [a.get('percentage', 0) for a in attempts_list]
-        avg_score = sum(percentages) / len(percentages) if percentages else 0
-        highest_score_percentage = attempts_list[0].get('percentage', 0) if attempts_list else 0
+        avg_score = avg_percentage
+        highest_score_percentage = entries[0].get('percentage', 0)
 
         # --- Response ---
         response_data = {
@@ -1777,9 +3664,10 @@ def get_student_leaderboard(test_id):
             'totalMarks': total_marks,
             'totalAttempts': total_attempts,
             'attempts': attempts_list,
+            'nextCursor': next_cursor,
             'currentUser': {
                 'attempted': current_user_attempt is not None,
-                'rank': current_user_rank,
+                'rank': current_user_rank if current_user_attempt else None,
                 'percentile': round(current_user_percentile, 2) if current_user_percentile else None,
                 'attemptData': current_user_attempt
             },
@@ -1787,16 +3675,12 @@ def get_student_leaderboard(test_id):
             'highestScore': round(highest_score_percentage, 2)
         }
 
-        print(f"✅ Leaderboard generated: {total_attempts} attempts")
+        leaderboard_log.debug("Leaderboard generated: %d attempts", total_attempts)
 
         return jsonify({'success': True, 'data': response_data}), 200
 
     except Exception as e:
-        print(f"❌ LEADERBOARD ERROR for test {test_id}:")
-        print(f"   Error type: {type(e).__name__}")
-        print(f"   Error message: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        leaderboard_log.exception("Leaderboard error for test %s", test_id)
         
         return jsonify({
             'error': 'Failed to load leaderboard',
@@ -1820,6 +3704,80 @@ def health_check():
         }
     }), 200
 
+@app.route('/api/internal/metrics', methods=['GET'])
+@require_internal_token
+def internal_metrics():
+    """Cache counters for this worker process (ops only)"""
+    return jsonify({
+        'success': True,
+        'data': {
+            'pid': os.getpid(),
+            'caches': {
+                'userDocs': user_doc_cache.stats(),
+                'verifiedTokens': verified_token_cache.stats(),
+                'userNames': user_name_cache.stats(),
+                'answerKeys': answer_key_cache.stats(),
+                'signedUrls': signed_url_cache.stats(),
+                'blobExists': blob_exists_cache.stats(),
+                'questionBanks': question_bank_cache.stats(),
+                'testVersionBanks': test_version_banks.stats(),
+                'compressedBodies': compressed_body_cache.stats(),
+                'testStats': test_stats_cache.stats(),
+                'downloadCounts': download_counts_cache.stats()
+            },
+            'catalog': catalog_cache.stats(),
+            'writeBuffer': write_buffer.stats()
+        }
+    }), 200
+
+@app.route('/metrics', methods=['GET'])
+@require_internal_token
+def prometheus_metrics():
+    """Per-endpoint timings and Firestore call counts for this worker (Prometheus text format)"""
+    lines = [request_metrics.render()]
+    caches = {
+        'userDocs': user_doc_cache,
+        'verifiedTokens': verified_token_cache,
+        'userNames': user_name_cache,
+        'answerKeys': answer_key_cache,
+        'signedUrls': signed_url_cache,
+        'blobExists': blob_exists_cache,
+        'questionBanks': question_bank_cache,
+        'testVersionBanks': test_version_banks,
+        'compressedBodies': compressed_body_cache,
+        'testStats': test_stats_cache,
+        'downloadCounts': download_counts_cache,
+    }
+    for field, kind in (('hits', 'counter'), ('misses', 'counter'), ('size', 'gauge')):
+        name = f'geocatalyst_cache_{field}' + ('_total' if kind == 'counter' else '')
+        lines.append(f'# TYPE {name} {kind}\n')
+        for cache_name, cache in caches.items():
+            lines.append(f'{name}{{cache="{cache_name}"}} {cache.stats()[field]}\n')
+    return Response(''.join(lines), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/internal/catalog/refresh', methods=['POST'])
+@require_internal_token
+def refresh_catalog():
+    """Rebuilds the test index and reloads this worker's catalog cache right away (e.g. after an admin edit)"""
+    try:
+        if TEST_INDEX_MAX_AGE > 0:
+            sync_test_index()
+        versions = catalog_cache.refresh()
+        return jsonify({'success': True, 'data': {'pid': os.getpid(), 'versions': versions}}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/internal/test-index/sync', methods=['POST'])
+@require_internal_token
+def sync_test_index_endpoint():
+    """Rebuilds the test index and this worker's catalog (call after editing tests)"""
+    try:
+        rows = sync_test_index()
+        versions = catalog_cache.refresh()
+        return jsonify({'success': True, 'data': {'pid': os.getpid(), 'tests': len(rows), 'versions': versions}}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/', methods=['GET'])
 def index():
     """Root endpoint"""
@@ -1841,6 +3799,163 @@ def not_found(e):
 def internal_error(e):
     return jsonify({'error': 'Internal server error'}), 500
 
+# ============================================
+# MAINTENANCE COMMANDS
+# ============================================
+# Run with: flask --app backend <command>
+
+@app.cli.command('rebuild-leaderboards')
+@click.argument('test_ids', nargs=-1)
+@click.option('--check', is_flag=True, help='Only report snapshots that differ from testAttempts.')
+def rebuild_leaderboards_command(test_ids, check):
+    """Recompute leaderboard snapshots from testAttempts (all tests if none given)."""
+    if not test_ids:
+        test_ids = [doc.id for doc in db.collection('tests').select([]).stream()]
+
+    for test_id in test_ids:
+        if check:
+            test_doc = db.collection('tests').document(test_id).get(field_paths=['name', 'totalMarks'])
+            board_doc = db.collection('leaderboards').document(test_id).get()
+            if not test_doc.exists:
+                click.echo(f"⚠️ {test_id}: test not found")
+                continue
+            expected = _build_leaderboard_in_transaction(None, test_id, test_doc.to_dict())
+            current = board_doc.to_dict() if board_doc.exists else {}
+            expected_ids = [e['attemptId'] for e in expected['entries']]
+            current_ids = [e.get('attemptId') for e in current.get('entries', [])]
+            status = 'ok' if expected_ids == current_ids else 'STALE'
+            click.echo(f"{status:5} {test_id}: snapshot={len(current_ids)} expected={len(expected_ids)}")
+            continue
+
+        board = rebuild_leaderboard(test_id)
+        if board is None:
+            click.echo(f"⚠️ {test_id}: test not found")
+        else:
+            click.echo(f"✅ {test_id}: {len(board['entries'])} ranked attempts")
+
+@app.cli.command('process-pending-attempts')
+@click.option('--older-than', default=120, show_default=True,
+              help='Only attempts submitted at least this many seconds ago.')
+def process_pending_attempts_command(older_than):
+    """Re-run the post-submission pipeline for attempts whose jobs were lost."""
+    cutoff = time.time() - older_than
+    pending = db.collection('testAttempts').where('postProcessingPending', '==', True)
+    processed = failed = 0
+    for doc in pending.stream():
+        attempt_data = doc.to_dict()
+        if _timestamp_seconds(attempt_data.get('submittedAt')) > cutoff:
+            continue  # probably still queued in a worker
+        if run_post_submission(doc.id, attempt_data):
+            processed += 1
+        else:
+            failed += 1
+    click.echo(f"✅ Processed {processed} pending attempts ({failed} still failing)")
+
+@app.cli.command('migrate-attempt-ids')
+@click.option('--dry-run', is_flag=True, help='Only report what would be moved.')
+def migrate_attempt_ids_command(dry_run):
+    """Move attempts saved under random IDs to testAttempts/<userId>_<testId>."""
+    attempts_by_key = {}
+    for doc in db.collection('testAttempts').stream():
+        attempt_data = doc.to_dict()
+        user_id, test_id = attempt_data.get('userId'), attempt_data.get('testId')
+        if user_id and test_id:
+            attempts_by_key.setdefault((user_id, test_id), []).append((doc.id, attempt_data))
+
+    moved = duplicates = 0
+    touched_tests = set()
+    for (user_id, test_id), attempts in attempts_by_key.items():
+        target_id = attempt_doc_id(user_id, test_id)
+        if any(attempt_id == target_id for attempt_id, _ in attempts):
+            duplicates += len(attempts) - 1
+            continue
+        # The first submission is the one that counts (same rule as the leaderboard)
+        attempts.sort(key=lambda a: (_timestamp_seconds(a[1].get('submittedAt')), a[0]))
+        legacy_id, attempt_data = attempts[0]
+        duplicates += len(attempts) - 1
+        moved += 1
+        touched_tests.add(test_id)
+        if dry_run:
+            continue
+        batch = db.batch()
+        batch.create(attempt_ref_for(user_id, test_id), {**attempt_data, 'legacyAttemptId': legacy_id})
+        batch.delete(db.collection('testAttempts').document(legacy_id))
+        batch.commit()
+
+    if not dry_run:
+        # Snapshot entries reference attempt IDs
+        for test_id in sorted(touched_tests):
+            rebuild_leaderboard(test_id)
+    verb = 'Would move' if dry_run else 'Moved'
+    click.echo(f"✅ {verb} {moved} attempts across {len(touched_tests)} tests "
+               f"({duplicates} duplicate attempts left in place)")
+    if not dry_run:
+        click.echo("ℹ️ Every attempt now has a deterministic ID; LEGACY_ATTEMPT_LOOKUP=false is safe")
+
+@app.cli.command('sync-test-index')
+def sync_test_index_command():
+    """Rebuild testIndex from the active tests."""
+    rows = sync_test_index()
+    banked = sum(1 for row in rows if row.get('questionBankId'))
+    click.echo(f"✅ Test index holds {len(rows)} active tests ({banked} with a published question bank)")
+
+@app.cli.command('backfill-question-counts')
+@click.option('--check', is_flag=True, help='Only report tests whose questionCount is missing or wrong.')
+def backfill_question_counts_command(check):
+    """Set tests/<id>.questionCount from each test's questions (or question bank)."""
+    fixed = ok = missing = 0
+    batch = db.batch()
+    for doc in db.collection('tests').select(['questions', 'questionCount', 'questionBankId']).stream():
+        test_data = doc.to_dict()
+        count = question_count(test_data)
+        if count is None:
+            missing += 1
+            click.echo(f"⚠️ Skipped {doc.id}: question bank {test_data.get('questionBankId')} not found")
+            continue
+        if test_data.get('questionCount') == count:
+            ok += 1
+            continue
+        fixed += 1
+        click.echo(f"{'STALE' if check else 'fixed'} {doc.id}: questionCount={test_data.get('questionCount')} questions={count}")
+        if not check:
+            batch.update(doc.reference, {'questionCount': count})
+            if len(batch) >= 500:
+                batch.commit()
+                batch = db.batch()
+    if not check and len(batch):
+        batch.commit()
+    verb = 'Found' if check else 'Fixed'
+    click.echo(f"✅ {verb} {fixed} tests with a missing or stale questionCount ({ok} already correct, "
+               f"{missing} skipped)")
+
+@app.cli.command('backfill-test-counters')
+@click.option('--dry-run', is_flag=True, help='Only report how many attempts would be counted.')
+def backfill_test_counters_command(dry_run):
+    """Add attempts saved before test counters existed to the tests' counter shards."""
+    fields = ['userId', 'testId', 'score', 'percentage', 'submittedAt', 'postProcessed', 'postProcessingPending']
+    attempts_by_key = {}
+    for doc in db.collection('testAttempts').select(fields).stream():
+        attempt_data = doc.to_dict()
+        user_id, test_id = attempt_data.get('userId'), attempt_data.get('testId')
+        if user_id and test_id:
+            attempts_by_key.setdefault((user_id, test_id), []).append((doc.id, attempt_data))
+
+    counted = skipped = 0
+    for (user_id, test_id), attempts in attempts_by_key.items():
+        # One attempt per student and test: the deterministic one, else the first submitted
+        attempts.sort(key=lambda a: (a[0] != attempt_doc_id(user_id, test_id),
+                                     _timestamp_seconds(a[1].get('submittedAt')), a[0]))
+        attempt_id, attempt_data = attempts[0]
+        if attempt_data.get('postProcessed', {}).get('testCounters') or attempt_data.get('postProcessingPending'):
+            skipped += 1  # already counted, or the pipeline will count it
+            continue
+        counted += 1
+        if not dry_run:
+            update_test_counters_step(attempt_id, attempt_data)
+
+    verb = 'Would count' if dry_run else 'Counted'
+    click.echo(f"✅ {verb} {counted} attempts ({skipped} already counted or pending)")
+
 # ============================================
 # RUN SERVER
 # ============================================
@@ -0,0 +1,305 @@
+"""
+Benchmark: end-to-end request scenarios against an in-memory Firestore.
+
+Seeds a realistic dataset (see seed_data.py) into FakeFirestore with a
+simulated per-RPC latency, points backend.db at it and drives the Flask app
+through its test client from several threads:
+
+    test-listing      GET /api/tests for random students
+    submission-burst  students submitting the same mocks at once (exam end)
+    leaderboard       GET /api/student/leaderboard/<id> on the popular mocks
+    dashboard         what the dashboard loads: profile, stats, courses,
+                      attempts and tests (timed as one sequential page load)
+
+For each scenario it prints p50/p95/p99 latency and, per request, the
+Firestore RPCs, documents read and documents written. Post-submission work
+that runs on background threads is reported separately.
+
+--save writes the results as JSON; --compare exits with status 1 when a
+scenario's p95, RPCs or documents read per request grew by more than
+--tolerance against a saved baseline, so regressions show up before deploy.
+
+Usage:
+    python benchmarks/bench_scenarios.py [--scenario leaderboard ...] [--latency 0.008]
+        [--requests 300] [--concurrency 8] [--users 2000] [--tests 60]
+        [--save results.json] [--compare baseline.json] [--tolerance 0.2]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+import backend  # noqa: E402
+from flask import g  # noqa: E402
+
+from fake_firestore import FakeFirestore  # noqa: E402
+from seed_data import DEFAULT_SCALE, make_answers, seed_dataset  # noqa: E402
+
+FIRESTORE_FIELDS = ('rpcs', 'reads', 'queries', 'docs', 'writes')
+
+_captured = threading.local()
+
+
+@backend.app.after_request
+def _capture_firestore_calls(response):
+    # Registered after backend's hooks, so it runs first; the view is done by now
+    stats = g.get('firestore_stats')
+    calls = getattr(_captured, 'calls', None)
+    if stats is not None and calls is not None:
+        calls.append(stats.snapshot())
+    return response
+
+
+def install_fake_firestore(latency):
+    fs = FakeFirestore(
+        latency=latency,
+        on_rpc=lambda kind, seconds, **counts: backend.current_firestore_stats().record(kind, seconds, **counts)
+    )
+    backend.db = fs
+    # uid == token, so requests can pick any seeded student
+    backend.auth.verify_id_token = lambda id_token, **kwargs: {
+        'uid': id_token, 'email': f'{id_token}@example.com', 'exp': time.time() + 3600
+    }
+    return fs
+
+
+def auth_headers(user_id):
+    return {'Authorization': f'Bearer {user_id}'}
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_requests(items, do_request, concurrency):
+    """Runs do_request(client, item) for every item on `concurrency` threads."""
+    samples = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(chunk):
+        client = backend.app.test_client()
+        for item in chunk:
+            _captured.calls = []
+            start = time.perf_counter()
+            statuses = do_request(client, item)
+            elapsed = time.perf_counter() - start
+            totals = {field: sum(calls[field] for calls in _captured.calls) for field in FIRESTORE_FIELDS}
+            with lock:
+                samples.append((elapsed, totals))
+                errors.extend(status for status in statuses if status >= 400)
+
+    chunks = [items[i::concurrency] for i in range(concurrency)]
+    threads = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks if chunk]
+    wall_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, errors, time.perf_counter() - wall_start
+
+
+def summarize(samples, errors, wall_seconds):
+    latencies = sorted(elapsed * 1000 for elapsed, _ in samples)
+    n = len(samples)
+    result = {
+        'requests': n,
+        'errors': len(errors),
+        'throughput_rps': round(n / wall_seconds, 1) if wall_seconds else 0,
+        'mean_ms': round(sum(latencies) / n, 2) if n else 0,
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+    }
+    for field in FIRESTORE_FIELDS:
+        result[f'{field}_per_request'] = round(sum(t[field] for _, t in samples) / n, 2) if n else 0
+    return result
+
+
+# --- Scenarios ---
+
+def scenario_test_listing(ctx, args):
+    users = [ctx['rng'].choice(ctx['data']['users']) for _ in range(args.requests)]
+
+    def do_request(client, user_id):
+        return [client.get('/api/tests', headers=auth_headers(user_id)).status_code]
+
+    return users, do_request, None
+
+
+def scenario_submission_burst(ctx, args):
+    rng = ctx['rng']
+    fs = ctx['fs']
+    popular = ctx['data']['tests'][:5]
+    pairs = []
+    for user_id, remaining in ctx['data']['unattempted'].items():
+        for test_id in remaining:
+            if test_id in popular:
+                pairs.append((user_id, test_id))
+    rng.shuffle(pairs)
+    pairs = pairs[:args.requests]
+    questions = {test_id: fs.peek(f'tests/{test_id}')['questions'] for test_id in popular}
+    bodies = {pair: {'answers': make_answers(rng, questions[pair[1]]), 'timeTaken': rng.randint(1200, 10800)}
+              for pair in pairs}
+    for pair in pairs:
+        ctx['data']['unattempted'][pair[0]].remove(pair[1])
+
+    def do_request(client, pair):
+        user_id, test_id = pair
+        response = client.post(f'/api/tests/{test_id}/submit', headers=auth_headers(user_id), json=bodies[pair])
+        return [response.status_code]
+
+    def drain():
+        # Wait for the post-submission jobs (user stats, leaderboard) to finish
+        deadline = time.time() + 120
+        pending = [f'testAttempts/{u}_{t}' for u, t in pairs]
+        while pending and time.time() < deadline:
+            pending = [p for p in pending if (fs.peek(p) or {}).get('postProcessingPending')]
+            time.sleep(0.05)
+        return len(pending)
+
+    return pairs, do_request, drain
+
+
+def scenario_leaderboard(ctx, args):
+    rng = ctx['rng']
+    popular = ctx['data']['tests'][:5]
+    items = [(rng.choice(ctx['data']['users']), rng.choice(popular)) for _ in range(args.requests)]
+
+    def do_request(client, item):
+        user_id, test_id = item
+        return [client.get(f'/api/student/leaderboard/{test_id}', headers=auth_headers(user_id)).status_code]
+
+    return items, do_request, None
+
+
+DASHBOARD_CALLS = ['/api/user/profile', '/api/user/stats', '/api/courses', '/api/user/test-attempts', '/api/tests']
+
+
+def scenario_dashboard(ctx, args):
+    users = [ctx['rng'].choice(ctx['data']['users']) for _ in range(args.requests)]
+
+    def do_request(client, user_id):
+        headers = auth_headers(user_id)
+        return [client.get(path, headers=headers).status_code for path in DASHBOARD_CALLS]
+
+    return users, do_request, None
+
+
+SCENARIOS = {
+    'test-listing': scenario_test_listing,
+    'submission-burst': scenario_submission_burst,
+    'leaderboard': scenario_leaderboard,
+    'dashboard': scenario_dashboard,
+}
+
+
+def prepare(args):
+    fs = install_fake_firestore(latency=0)
+    seed_start = time.perf_counter()
+    data = seed_dataset(fs, users=args.users, tests=args.tests, attempts_per_user=args.attempts_per_user,
+                        grants=args.grants, questions=args.questions, seed=args.seed)
+    # Leaderboard snapshots exist in steady state (`flask rebuild-leaderboards`)
+    for test_id in data['tests'][:10]:
+        backend.rebuild_leaderboard(test_id)
+    print(f"Seeded {len(fs._store.docs)} documents in {time.perf_counter() - seed_start:.1f}s "
+          f"({len(data['users'])} users, {len(data['tests'])} tests, {len(data['attempted'])} attempts)")
+    fs.latency = args.latency
+    return {'fs': fs, 'data': data, 'rng': random.Random(args.seed)}
+
+
+def run_scenario(ctx, name, args):
+    items, do_request, drain = SCENARIOS[name](ctx, args)
+    warmup = items[:args.warmup] if name != 'submission-burst' else []
+    if warmup:
+        run_requests(warmup, do_request, args.concurrency)
+
+    background_before = backend.background_firestore_stats.snapshot()
+    samples, errors, wall_seconds = run_requests(items, do_request, args.concurrency)
+    result = summarize(samples, errors, wall_seconds)
+    if drain is not None:
+        drain_start = time.perf_counter()
+        result['still_pending'] = drain()
+        result['drain_ms'] = round((time.perf_counter() - drain_start) * 1000, 1)
+    background = backend.background_firestore_stats.snapshot()
+    result['background_rpcs'] = background['rpcs'] - background_before['rpcs']
+    return result
+
+
+def print_results(results, args):
+    print(f"\nlatency {args.latency * 1000:.1f}ms/RPC, concurrency {args.concurrency} "
+          f"(ms per request; Firestore counts are per request)")
+    print(f"{'scenario':18}{'n':>6}{'err':>5}{'p50':>9}{'p95':>9}{'p99':>9}{'rps':>8}"
+          f"{'rpcs':>7}{'docs':>8}{'writes':>7}{'bg rpcs':>9}")
+    for name, r in results.items():
+        print(f"{name:18}{r['requests']:6}{r['errors']:5}{r['p50_ms']:9.1f}{r['p95_ms']:9.1f}{r['p99_ms']:9.1f}"
+              f"{r['throughput_rps']:8.1f}{r['rpcs_per_request']:7.1f}{r['docs_per_request']:8.1f}"
+              f"{r['writes_per_request']:7.1f}{r['background_rpcs']:9}")
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    for name, current in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        for metric in ('p95_ms', 'docs_per_request', 'rpcs_per_request'):
+            allowed = before[metric] * (1 + tolerance) + (0.5 if metric != 'p95_ms' else 1.0)
+            if current[metric] > allowed:
+                regressions.append(f"{name}: {metric} {before[metric]} -> {current[metric]}")
+    if regressions:
+        print("\nRegressions against " + baseline_path + ":")
+        for line in regressions:
+            print("  " + line)
+    else:
+        print(f"\nNo regressions against {baseline_path} (tolerance {tolerance:.0%})")
+    return not regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='Scenario to run (repeatable; default: all)')
+    parser.add_argument('--latency', type=float, default=0.008, help='Simulated seconds per Firestore RPC')
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--users', type=int, default=DEFAULT_SCALE['users'])
+    parser.add_argument('--tests', type=int, default=DEFAULT_SCALE['tests'])
+    parser.add_argument('--attempts-per-user', type=int, default=DEFAULT_SCALE['attempts_per_user'])
+    parser.add_argument('--grants', type=int, default=DEFAULT_SCALE['grants'])
+    parser.add_argument('--questions', type=int, default=DEFAULT_SCALE['questions'])
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--save', help='Write results as JSON')
+    parser.add_argument('--compare', help='Baseline JSON from an earlier --save')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    ctx = prepare(args)
+    results = {}
+    for name in args.scenario or list(SCENARIOS):
+        results[name] = run_scenario(ctx, name, args)
+    print_results(results, args)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+        print(f"\nSaved results to {args.save}")
+    if args.compare and not compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
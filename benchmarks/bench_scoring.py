@@ -0,0 +1,192 @@
+"""
+Benchmark: compiled answer key scorer vs. the original per-question loop.
+
+Builds a 65-question GATE-style mock (1- and 2-mark MCQs with negative
+marking, MSQs and numerical answers), checks that both scorers agree on
+randomized submissions (including malformed answers), then times them.
+
+Usage:
+    python benchmarks/bench_scoring.py [--submissions 2000] [--seed 7]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import backend  # noqa: E402
+
+OPTIONS = ['A', 'B', 'C', 'D']
+
+
+def legacy_score(questions, student_answers):
+    """The scoring loop submit_test_attempt used before answer keys were compiled."""
+    score = 0.0
+    correct_count = 0
+    wrong_count = 0
+    unattempted_count = 0
+    evaluated_answers = {}
+
+    for i, q in enumerate(questions):
+        q_index_str = str(i)
+        student_answer = student_answers.get(q_index_str)
+        q_marks = float(q.get('marks', 0))
+        q_negative_marks = float(q.get('negativeMarks', 0))
+        q_type = q.get('type')
+        is_correct = False
+
+        if student_answer is None or student_answer == '':
+            unattempted_count += 1
+            evaluated_answers[q_index_str] = {'status': 'unattempted'}
+            continue
+
+        try:
+            if q_type == 'mcq':
+                correct_answer = q.get('correctAnswer')
+                if student_answer == correct_answer:
+                    is_correct = True
+                else:
+                    score -= q_negative_marks
+                    wrong_count += 1
+            elif q_type == 'msq':
+                correct_answers_set = set(q.get('correctAnswers', []))
+                student_answers_list = student_answer if isinstance(student_answer, list) else [student_answer]
+                student_answers_set = set(student_answers_list)
+                if student_answers_set == correct_answers_set and len(student_answers_set) > 0:
+                    is_correct = True
+                else:
+                    wrong_count += 1
+            elif q_type == 'numerical':
+                correct_num = float(q.get('correctAnswer', float('inf')))
+                tolerance = float(q.get('tolerance', 0))
+                try:
+                    student_num = float(student_answer)
+                    if abs(student_num - correct_num) <= tolerance:
+                        is_correct = True
+                    else:
+                        wrong_count += 1
+                except (ValueError, TypeError):
+                    wrong_count += 1
+            elif q_type == 'true-false':
+                correct_bool = q.get('correctAnswer')
+                student_bool = str(student_answer).lower() == 'true'
+                if student_bool == correct_bool:
+                    is_correct = True
+                else:
+                    score -= q_negative_marks
+                    wrong_count += 1
+
+            if is_correct:
+                score += q_marks
+                correct_count += 1
+                evaluated_answers[q_index_str] = {'status': 'correct'}
+            else:
+                evaluated_answers[q_index_str] = {'status': 'wrong'}
+
+        except Exception:
+            wrong_count += 1
+            evaluated_answers[q_index_str] = {'status': 'error'}
+
+    return score, correct_count, wrong_count, unattempted_count
+
+
+def make_gate_mock(rng):
+    questions = []
+    for i in range(65):
+        marks = 1 if i < 30 else 2
+        kind = rng.choices(['mcq', 'msq', 'numerical'], weights=[6, 2, 2])[0]
+        q = {'type': kind, 'question': f'Q{i + 1}', 'marks': str(marks) if i % 5 == 0 else marks}
+        if kind == 'mcq':
+            q.update(options=OPTIONS, correctAnswer=rng.choice(OPTIONS), negativeMarks=round(marks / 3, 2))
+        elif kind == 'msq':
+            q.update(options=OPTIONS, correctAnswers=rng.sample(OPTIONS, rng.randint(1, 3)), negativeMarks=0)
+        else:
+            q.update(correctAnswer=str(round(rng.uniform(0, 100), 2)), tolerance='0.05', negativeMarks=0)
+        questions.append(q)
+    # A few awkward keys the old loop tolerated
+    questions.append({'type': 'true-false', 'marks': 1, 'negativeMarks': 0.5, 'correctAnswer': True})
+    questions.append({'type': 'numerical', 'marks': 1, 'correctAnswer': None})
+    questions.append({'type': 'msq', 'marks': 1, 'correctAnswers': None})
+    questions.append({'type': 'matching', 'marks': 1})
+    return {'name': 'GATE Mock', 'subject': 'Mock', 'totalMarks': 100, 'questions': questions}
+
+
+def random_answer(rng, q):
+    roll = rng.random()
+    if roll < 0.15:
+        return None
+    if roll < 0.18:
+        return ''
+    if roll < 0.21:
+        return rng.choice([['A', 'B'], {'x': 1}, 'not-a-number', True, [['A']], []])
+    if q['type'] == 'mcq':
+        return q['correctAnswer'] if rng.random() < 0.6 else rng.choice(OPTIONS)
+    if q['type'] == 'msq':
+        if q.get('correctAnswers') and rng.random() < 0.5:
+            return list(reversed(q['correctAnswers']))
+        return rng.sample(OPTIONS, rng.randint(1, 4))
+    if q['type'] == 'numerical':
+        try:
+            target = float(q['correctAnswer'])
+        except (TypeError, ValueError):
+            return '1'
+        return str(round(target + rng.choice([0, 0.01, -0.04, 0.3]), 2))
+    if q['type'] == 'true-false':
+        return rng.choice(['true', 'false', 'TRUE'])
+    return 'A'
+
+
+def make_submissions(rng, test_data, n):
+    submissions = []
+    for _ in range(n):
+        answers = {}
+        for i, q in enumerate(test_data['questions']):
+            answer = random_answer(rng, q)
+            if answer is not None:
+                answers[str(i)] = answer
+        submissions.append(answers)
+    return submissions
+
+
+def timed(fn, submissions):
+    start = time.perf_counter()
+    for answers in submissions:
+        fn(answers)
+    return (time.perf_counter() - start) / len(submissions) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--submissions', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    test_data = make_gate_mock(rng)
+    questions = test_data['questions']
+    submissions = make_submissions(rng, test_data, args.submissions)
+    answer_key = backend.CompiledAnswerKey(test_data)
+
+    mismatches = 0
+    for answers in submissions:
+        if legacy_score(questions, answers) != backend.score_submission(answer_key, answers):
+            mismatches += 1
+    print(f"Equivalence: {args.submissions - mismatches}/{args.submissions} submissions scored identically")
+
+    legacy_us = timed(lambda answers: legacy_score(questions, answers), submissions)
+    compiled_us = timed(lambda answers: backend.score_submission(answer_key, answers), submissions)
+    cold_us = timed(lambda answers: backend.score_submission(backend.CompiledAnswerKey(test_data), answers), submissions)
+
+    print(f"\n{len(questions)} questions, {args.submissions} submissions (µs per submission)")
+    print(f"  legacy loop              {legacy_us:8.1f}")
+    print(f"  compiled key (cached)    {compiled_us:8.1f}   {legacy_us / compiled_us:.1f}x")
+    print(f"  compile + score (cold)   {cold_us:8.1f}")
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Micro-benchmark: verify_firebase_token with and without the verified-token cache.
+
+Signs a real RS256 Firebase-style ID token with a throwaway key and verifies it
+the same way firebase-admin does (RSA signature + claims), so the numbers
+reflect the CPU the cache removes from every authenticated request.
+
+Usage:
+    python benchmarks/bench_token_cache.py [--requests 2000]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from google.auth import crypt, jwt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import backend  # noqa: E402
+
+PROJECT_ID = 'geocatalyst-bench'
+KEY_ID = 'bench-key'
+
+
+def make_signer_and_certs():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    )
+    public_pem = key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    signer = crypt.RSASigner.from_string(private_pem, key_id=KEY_ID)
+    return signer, {KEY_ID: public_pem}
+
+
+def make_token(signer, uid='bench-user'):
+    now = int(time.time())
+    payload = {
+        'iss': f'https://securetoken.google.com/{PROJECT_ID}',
+        'aud': PROJECT_ID,
+        'sub': uid,
+        'uid': uid,
+        'email': f'{uid}@example.com',
+        'iat': now,
+        'auth_time': now,
+        'exp': now + 3600,
+    }
+    return jwt.encode(signer, payload).decode()
+
+
+def install_verifier(certs):
+    """Stand-in for auth.verify_id_token doing the same signature + claim checks."""
+    def verify_id_token(id_token, check_revoked=False, **kwargs):
+        claims = jwt.decode(id_token, certs=certs, audience=PROJECT_ID)
+        claims['uid'] = claims['sub']
+        return claims
+    backend.auth.verify_id_token = verify_id_token
+
+
+def run(client, token, n, clear_cache):
+    headers = {'Authorization': f'Bearer {token}'}
+    timings = []
+    for _ in range(n):
+        if clear_cache:
+            backend.verified_token_cache.clear()
+        start = time.perf_counter()
+        response = client.get('/_bench/ping', headers=headers)
+        timings.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.get_data(as_text=True)
+    timings.sort()
+    return {
+        'mean_us': sum(timings) / n * 1e6,
+        'p50_us': timings[n // 2] * 1e6,
+        'p99_us': timings[min(n - 1, int(n * 0.99))] * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    signer, certs = make_signer_and_certs()
+    install_verifier(certs)
+    token = make_token(signer)
+
+    @backend.app.route('/_bench/ping')
+    @backend.verify_firebase_token
+    def bench_ping():
+        return 'ok'
+
+    client = backend.app.test_client()
+    run(client, token, 50, clear_cache=False)  # warm up
+
+    uncached = run(client, token, args.requests, clear_cache=True)
+    cached = run(client, token, args.requests, clear_cache=False)
+
+    print(f"\n{'':12}{'mean':>10}{'p50':>10}{'p99':>10}   (µs per request, {args.requests} requests)")
+    for label, result in (('uncached', uncached), ('cached', cached)):
+        print(f"{label:12}{result['mean_us']:10.1f}{result['p50_us']:10.1f}{result['p99_us']:10.1f}")
+    saving = uncached['mean_us'] - cached['mean_us']
+    print(f"\nSaving per request: {saving:.1f} µs ({saving / uncached['mean_us'] * 100:.0f}%)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+"""
+backend.app backed by a seeded in-memory Firestore, for load tests against a
+real gunicorn server (see replay_traffic.py):
+
+    gunicorn --preload -w 4 --threads 1 -b 127.0.0.1:8000 --pythonpath benchmarks fake_app:app
+
+Bearer tokens are taken as user IDs (e.g. "Authorization: Bearer user00042").
+The dataset size and simulated Firestore latency come from BENCH_USERS,
+BENCH_TESTS, BENCH_ATTEMPTS_PER_USER, BENCH_SEED and BENCH_LATENCY (seconds).
+
+With --preload the dataset is seeded once in the master and shared with the
+workers copy-on-write. After the fork every worker has its own copy, so writes
+made by one worker (submissions) are not visible to the others.
+"""
+
+import argparse
+import os
+
+from bench_scenarios import backend, prepare
+from seed_data import DEFAULT_SCALE
+
+_args = argparse.Namespace(
+    users=int(os.environ.get('BENCH_USERS', DEFAULT_SCALE['users'])),
+    tests=int(os.environ.get('BENCH_TESTS', DEFAULT_SCALE['tests'])),
+    attempts_per_user=int(os.environ.get('BENCH_ATTEMPTS_PER_USER', DEFAULT_SCALE['attempts_per_user'])),
+    grants=DEFAULT_SCALE['grants'],
+    questions=DEFAULT_SCALE['questions'],
+    seed=int(os.environ.get('BENCH_SEED', 7)),
+    latency=float(os.environ.get('BENCH_LATENCY', 0.008)),
+)
+prepare(_args)
+
+app = backend.app
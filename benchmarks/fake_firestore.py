@@ -0,0 +1,674 @@
+"""
+In-memory stand-in for the subset of the Firestore client API used by backend.py.
+
+Supports documents, collections and collection groups, where / order_by / limit /
+select / start_after queries, count / sum / avg aggregations, get_all, write
+batches and transactions (with optimistic concurrency, so @firestore.transactional
+retries on contention) and the Increment / ArrayUnion / ArrayRemove /
+SERVER_TIMESTAMP transforms.
+
+Every call that would be an RPC against Firestore sleeps for `latency` seconds
+and is counted in `stats` with the same fields backend.FirestoreCallStats uses:
+rpcs, reads (get / get_all RPCs), queries, writes (documents written) and docs
+(documents returned). Pass `on_rpc` to also forward each RPC, e.g. to
+backend.current_firestore_stats().record, so /metrics and Server-Timing work.
+
+    fs = FakeFirestore(latency=0.008)
+    fs.seed('users/u1', {'name': 'Asha', 'plan': 'free'})
+    backend.db = fs
+"""
+
+import copy
+import itertools
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from google.api_core.exceptions import AlreadyExists, Aborted, NotFound
+from google.cloud.firestore_v1 import transforms
+
+
+class Stats:
+    FIELDS = ('rpcs', 'reads', 'queries', 'writes', 'docs')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            for field in self.FIELDS:
+                setattr(self, field, 0)
+
+    def record(self, kind, docs=0, writes=0):
+        with self.lock:
+            self.rpcs += 1
+            if kind in ('reads', 'queries'):
+                setattr(self, kind, getattr(self, kind) + 1)
+            self.docs += docs
+            self.writes += writes
+
+    def snapshot(self):
+        with self.lock:
+            return {field: getattr(self, field) for field in self.FIELDS}
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _get_path(data, path):
+    cur = data
+    for part in path.split('.'):
+        if not isinstance(cur, dict) or part not in cur:
+            raise KeyError(path)
+        cur = cur[part]
+    return cur
+
+
+def _apply_value(target, key, value):
+    if value is transforms.SERVER_TIMESTAMP:
+        target[key] = _now()
+    elif value is transforms.DELETE_FIELD:
+        target.pop(key, None)
+    elif isinstance(value, transforms.Increment):
+        target[key] = target.get(key, 0) + value.value
+    elif isinstance(value, transforms.ArrayUnion):
+        cur = list(target.get(key, []))
+        for v in value.values:
+            if v not in cur:
+                cur.append(v)
+        target[key] = cur
+    elif isinstance(value, transforms.ArrayRemove):
+        target[key] = [v for v in target.get(key, []) if v not in value.values]
+    elif isinstance(value, dict):
+        target[key] = _materialize(value)
+    else:
+        target[key] = copy.deepcopy(value)
+
+
+def _materialize(data):
+    out = {}
+    for k, v in data.items():
+        _apply_value(out, k, v)
+    return out
+
+
+def _merge(target, data):
+    for k, v in data.items():
+        if isinstance(v, dict) and isinstance(target.get(k), dict):
+            _merge(target[k], v)
+        else:
+            _apply_value(target, k, v)
+
+
+def _update_paths(target, data):
+    for path, v in data.items():
+        parts = path.split('.')
+        cur = target
+        for p in parts[:-1]:
+            if not isinstance(cur.get(p), dict):
+                cur[p] = {}
+            cur = cur[p]
+        _apply_value(cur, parts[-1], v)
+
+
+def _sort_key(value):
+    # Firestore type ordering: null < bool < number < timestamp < string < ref < ...
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return (3, value.timestamp())
+    if isinstance(value, str):
+        return (4, value)
+    if isinstance(value, FakeDocumentReference):
+        return (5, value.path)
+    return (6, str(value))
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data, update_time=None, create_time=None):
+        self.reference = reference
+        self._data = data
+        self.update_time = update_time
+        self.create_time = create_time
+
+    @property
+    def id(self):
+        return self.reference.id
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        return copy.deepcopy(_get_path(self._data or {}, field_path))
+
+
+def _index_key(value):
+    # Equality index key; None for values that cannot be indexed (lists, maps)
+    if isinstance(value, (list, dict)):
+        return None
+    return _sort_key(value)
+
+
+class _Store:
+    """
+    Documents by path, grouped by parent collection. Equality filters use
+    per-(collection, field) hash indexes that are built on first use and kept
+    up to date on writes, so query cost scales with the result, not the
+    collection (as it does in Firestore).
+    """
+
+    def __init__(self):
+        self.docs = {}         # path -> (data, update_time, create_time, version)
+        self.collections = {}  # collection path -> {doc path: entry}
+        self.indexes = {}      # (collection path, field) -> {value key: set of doc paths}
+        self.lock = threading.RLock()
+        self.version = itertools.count(1)
+
+    def put(self, path, entry):
+        collection = path.rsplit('/', 1)[0]
+        old = self.docs.get(path)
+        if entry is None:
+            self.docs.pop(path, None)
+            self.collections.get(collection, {}).pop(path, None)
+        else:
+            self.docs[path] = entry
+            self.collections.setdefault(collection, {})[path] = entry
+        for (index_collection, field), index in self.indexes.items():
+            if index_collection != collection:
+                continue
+            if old is not None:
+                self._unindex(index, path, old[0], field)
+            if entry is not None:
+                self._index(index, path, entry[0], field)
+
+    @staticmethod
+    def _index(index, path, data, field):
+        try:
+            key = _index_key(_get_path(data, field))
+        except KeyError:
+            return
+        if key is not None:
+            index.setdefault(key, set()).add(path)
+
+    @staticmethod
+    def _unindex(index, path, data, field):
+        try:
+            key = _index_key(_get_path(data, field))
+        except KeyError:
+            return
+        if key is not None:
+            index.get(key, set()).discard(path)
+
+    def lookup(self, collection, field, value):
+        """Paths in `collection` whose `field` equals `value`."""
+        index = self.indexes.get((collection, field))
+        if index is None:
+            index = self.indexes[(collection, field)] = {}
+            for path, entry in self.collections.get(collection, {}).items():
+                self._index(index, path, entry[0], field)
+        return index.get(_index_key(value), ())
+
+
+class FakeDocumentReference:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    @property
+    def id(self):
+        return self.path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        return FakeCollectionReference(self._client, self.path.rsplit('/', 1)[0])
+
+    def collection(self, name):
+        return FakeCollectionReference(self._client, f"{self.path}/{name}")
+
+    def _snapshot(self, field_paths=None):
+        entry = self._client._store.docs.get(self.path)
+        if entry is None:
+            return FakeSnapshot(self, None)
+        data = copy.deepcopy(entry[0])
+        if field_paths is not None:
+            data = _project(data, field_paths)
+        return FakeSnapshot(self, data, entry[1], entry[2])
+
+    def get(self, field_paths=None, transaction=None, **kwargs):
+        if transaction is not None:
+            transaction._note_read(self.path)
+        with self._client._store.lock:
+            snapshot = self._snapshot(field_paths)
+        self._client._rpc('reads', docs=int(snapshot.exists))
+        return snapshot
+
+    def set(self, data, merge=False):
+        self._client._rpc('writes', writes=1)
+        self._client._write(self.path, 'set', data, merge=merge)
+
+    def create(self, data):
+        self._client._rpc('writes', writes=1)
+        self._client._write(self.path, 'create', data)
+
+    def update(self, data):
+        self._client._rpc('writes', writes=1)
+        self._client._write(self.path, 'update', data)
+
+    def delete(self):
+        self._client._rpc('writes', writes=1)
+        self._client._write(self.path, 'delete', None)
+
+
+def _project(data, field_paths):
+    out = {}
+    for fp in field_paths:
+        try:
+            value = _get_path(data, fp)
+        except KeyError:
+            continue
+        cur = out
+        parts = fp.split('.')
+        for p in parts[:-1]:
+            cur = cur.setdefault(p, {})
+        cur[parts[-1]] = value
+    return out
+
+
+_OPS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: _sort_key(a) < _sort_key(b),
+    '<=': lambda a, b: _sort_key(a) <= _sort_key(b),
+    '>': lambda a, b: _sort_key(a) > _sort_key(b),
+    '>=': lambda a, b: _sort_key(a) >= _sort_key(b),
+    'in': lambda a, b: a in b,
+    'not-in': lambda a, b: a not in b,
+    'array_contains': lambda a, b: isinstance(a, list) and b in a,
+    'array_contains_any': lambda a, b: isinstance(a, list) and any(x in a for x in b),
+}
+
+
+class _AggregationResult:
+    def __init__(self, alias, value):
+        self.alias = alias
+        self.value = value
+
+
+class FakeAggregationQuery:
+    def __init__(self, query, aggregations=()):
+        self._query = query
+        self._aggregations = list(aggregations)  # (kind, field, alias)
+
+    def _add(self, kind, field, alias):
+        alias = alias or f'field_{len(self._aggregations) + 1}'
+        return FakeAggregationQuery(self._query, self._aggregations + [(kind, field, alias)])
+
+    def count(self, alias=None):
+        return self._add('count', None, alias)
+
+    def sum(self, field_ref, alias=None):
+        return self._add('sum', field_ref, alias)
+
+    def avg(self, field_ref, alias=None):
+        return self._add('avg', field_ref, alias)
+
+    def get(self, transaction=None, **kwargs):
+        rows = self._query._matching()
+        self._query._client._rpc('queries')
+        results = []
+        for kind, field, alias in self._aggregations:
+            if kind == 'count':
+                value = len(rows)
+            else:
+                numbers = []
+                for _, entry in rows:
+                    try:
+                        number = _get_path(entry[0], field)
+                    except KeyError:
+                        continue
+                    if isinstance(number, (int, float)) and not isinstance(number, bool):
+                        numbers.append(number)
+                if kind == 'sum':
+                    value = sum(numbers)
+                else:
+                    value = sum(numbers) / len(numbers) if numbers else None
+            results.append(_AggregationResult(alias, value))
+        return [results]
+
+
+class FakeQuery:
+    DESCENDING = 'DESCENDING'
+    ASCENDING = 'ASCENDING'
+
+    def __init__(self, client, path, group=False, filters=(), orders=(), limit_=None,
+                 fields=None, start=None):
+        self._client = client
+        self._path = path
+        self._group = group
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit_
+        self._fields = fields
+        self._start = start
+
+    def _copy(self, **kw):
+        args = dict(filters=self._filters, orders=self._orders, limit_=self._limit,
+                    fields=self._fields, start=self._start)
+        args.update(kw)
+        return FakeQuery(self._client, self._path, self._group, **args)
+
+    def where(self, field_path=None, op_string=None, value=None, *, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction='ASCENDING'):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit_=count)
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    def start_after(self, document_fields):
+        return self._copy(start=document_fields)
+
+    def count(self, alias=None):
+        return FakeAggregationQuery(self).count(alias)
+
+    def sum(self, field_ref, alias=None):
+        return FakeAggregationQuery(self).sum(field_ref, alias)
+
+    def avg(self, field_ref, alias=None):
+        return FakeAggregationQuery(self).avg(field_ref, alias)
+
+    def _candidates(self):
+        store = self._client._store
+        if self._group:
+            collections = [c for c in store.collections if c.rsplit('/', 1)[-1] == self._path]
+        else:
+            collections = [self._path]
+        equality = next(((f, v) for f, op, v in self._filters
+                         if op == '==' and f != '__name__' and _index_key(v) is not None), None)
+        for collection in collections:
+            docs = store.collections.get(collection, {})
+            if equality is None:
+                yield from list(docs.items())
+            else:
+                for path in list(store.lookup(collection, *equality)):
+                    yield path, docs[path]
+
+    def _value(self, path, data, field):
+        if field == '__name__':
+            return FakeDocumentReference(self._client, path)
+        return _get_path(data, field)
+
+    def _matching(self):
+        with self._client._store.lock:
+            rows = []
+            for path, entry in self._candidates():
+                data = entry[0]
+                ok = True
+                for field, op, value in self._filters:
+                    try:
+                        current = self._value(path, data, field)
+                    except KeyError:
+                        ok = False
+                        break
+                    if not _OPS[op](current, value):
+                        ok = False
+                        break
+                if not ok:
+                    continue
+                try:
+                    for field, _ in self._orders:
+                        self._value(path, data, field)
+                except KeyError:
+                    continue
+                rows.append((path, entry))
+
+            orders = list(self._orders)
+            if not any(f == '__name__' for f, _ in orders):
+                last_dir = orders[-1][1] if orders else 'ASCENDING'
+                orders.append(('__name__', last_dir))
+            for field, direction in reversed(orders):
+                rows.sort(key=lambda r: _sort_key(self._value(r[0], r[1][0], field)),
+                          reverse=(direction == 'DESCENDING'))
+
+            if self._start is not None:
+                cursor = self._start
+                if isinstance(cursor, FakeSnapshot):
+                    values = dict(cursor._data)
+                    values['__name__'] = cursor.reference
+                else:
+                    values = dict(cursor)
+                keyed = []
+                for field, direction in orders:
+                    if field not in values:
+                        break
+                    v = values[field]
+                    if field == '__name__' and isinstance(v, str):
+                        v = FakeDocumentReference(self._client, f"{self._path}/{v}")
+                    keyed.append((field, direction, _sort_key(v)))
+
+                def after(row):
+                    for field, direction, ck in keyed:
+                        rk = _sort_key(self._value(row[0], row[1][0], field))
+                        if rk == ck:
+                            continue
+                        return (rk > ck) if direction != 'DESCENDING' else (rk < ck)
+                    return False
+                rows = [r for r in rows if after(r)]
+
+            if self._limit is not None:
+                rows = rows[:self._limit]
+            return rows
+
+    def stream(self, transaction=None, **kwargs):
+        rows = self._matching()
+        self._client._rpc('queries', docs=len(rows))
+        for path, entry in rows:
+            data = copy.deepcopy(entry[0])
+            if self._fields is not None:
+                data = _project(data, self._fields)
+            yield FakeSnapshot(FakeDocumentReference(self._client, path), data, entry[1], entry[2])
+
+    def get(self, transaction=None, **kwargs):
+        return list(self.stream(transaction=transaction))
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+
+    @property
+    def id(self):
+        return self._path.rsplit('/', 1)[-1]
+
+    @property
+    def parent(self):
+        if '/' not in self._path:
+            return None
+        return FakeDocumentReference(self._client, self._path.rsplit('/', 1)[0])
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self._client, f"{self._path}/{document_id or uuid.uuid4().hex[:20]}")
+
+    def add(self, document_data, document_id=None):
+        ref = self.document(document_id)
+        ref.create(document_data)
+        return _now(), ref
+
+    def list_documents(self):
+        return [FakeDocumentReference(self._client, p) for p, _ in self._candidates()]
+
+
+class FakeWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._ops = []
+
+    def set(self, ref, data, merge=False):
+        self._ops.append((ref.path, 'set', data, merge))
+
+    def update(self, ref, data):
+        self._ops.append((ref.path, 'update', data, False))
+
+    def create(self, ref, data):
+        self._ops.append((ref.path, 'create', data, False))
+
+    def delete(self, ref):
+        self._ops.append((ref.path, 'delete', None, False))
+
+    def __len__(self):
+        return len(self._ops)
+
+    def commit(self):
+        self._client._rpc('writes', writes=len(self._ops))
+        with self._client._store.lock:
+            for path, kind, data, merge in self._ops:
+                self._client._write(path, kind, data, merge=merge)
+        self._ops = []
+
+
+class FakeTransaction(FakeWriteBatch):
+    def __init__(self, client, max_attempts=5, read_only=False):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = read_only
+        self._id = None
+        self._reads = {}
+
+    def _clean_up(self):
+        self._ops = []
+        self._reads = {}
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._client._rpc(None)
+        self._id = uuid.uuid4().bytes
+
+    def _note_read(self, path):
+        entry = self._client._store.docs.get(path)
+        self._reads[path] = entry[3] if entry else 0
+
+    def get(self, ref_or_query, **kwargs):
+        return ref_or_query.get(transaction=self)
+
+    def _commit(self):
+        store = self._client._store
+        with store.lock:
+            for path, version in self._reads.items():
+                entry = store.docs.get(path)
+                if (entry[3] if entry else 0) != version:
+                    self._clean_up()
+                    raise Aborted('contention')
+            self._client._rpc('writes', writes=len(self._ops))
+            for path, kind, data, merge in self._ops:
+                self._client._write(path, kind, data, merge=merge)
+        self._clean_up()
+        return []
+
+    def _rollback(self):
+        self._client._rpc(None)
+        self._clean_up()
+
+
+class FakeFirestore:
+    """Thread-safe in-memory Firestore with optional simulated per-RPC latency."""
+
+    def __init__(self, latency=0.0, on_rpc=None):
+        self._store = _Store()
+        self.latency = latency
+        self.on_rpc = on_rpc
+        self.stats = Stats()
+
+    def _rpc(self, kind, docs=0, writes=0):
+        # kind: 'reads', 'queries', 'writes' or None (begin/rollback)
+        if self.latency:
+            time.sleep(self.latency)
+        self.stats.record(kind, docs=docs, writes=writes)
+        if self.on_rpc is not None:
+            self.on_rpc(kind, self.latency, docs=docs, writes=writes)
+
+    def _write(self, path, kind, data, merge=False):
+        store = self._store
+        with store.lock:
+            entry = store.docs.get(path)
+            now = _now()
+            if kind == 'create':
+                if entry is not None:
+                    raise AlreadyExists(f'Document already exists: {path}')
+                store.put(path, (_materialize(data), now, now, next(store.version)))
+            elif kind == 'set':
+                if merge and entry is not None:
+                    new = copy.deepcopy(entry[0])
+                    _merge(new, data)
+                else:
+                    new = _materialize(data)
+                store.put(path, (new, now, entry[2] if entry else now, next(store.version)))
+            elif kind == 'update':
+                if entry is None:
+                    raise NotFound(f'No document to update: {path}')
+                new = copy.deepcopy(entry[0])
+                _update_paths(new, data)
+                store.put(path, (new, now, entry[2], next(store.version)))
+            elif kind == 'delete':
+                store.put(path, None)
+
+    def collection(self, path):
+        return FakeCollectionReference(self, path)
+
+    def collection_group(self, collection_id):
+        return FakeQuery(self, collection_id, group=True)
+
+    def document(self, path):
+        return FakeDocumentReference(self, path)
+
+    def get_all(self, references, field_paths=None, transaction=None, **kwargs):
+        references = list(references)
+        with self._store.lock:
+            snaps = [ref._snapshot(field_paths) for ref in references]
+        for ref in references:
+            if transaction is not None:
+                transaction._note_read(ref.path)
+        self._rpc('reads', docs=sum(snap.exists for snap in snaps))
+        yield from snaps
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self, max_attempts=5, read_only=False):
+        return FakeTransaction(self, max_attempts=max_attempts, read_only=read_only)
+
+    # Seeding / inspection helpers: bypass latency and RPC accounting.
+    def seed(self, path, data):
+        self._write(path, 'set', data)
+
+    def peek(self, path):
+        entry = self._store.docs.get(path)
+        return copy.deepcopy(entry[0]) if entry else None
+
+    def paths(self, collection):
+        with self._store.lock:
+            return list(self._store.collections.get(collection, {}))
@@ -0,0 +1,392 @@
+"""
+Load test: generate request traces and replay them as concurrent traffic.
+
+Traces are JSON Lines. The first line holds the dataset the trace was generated
+for, each following line one request at `t` seconds from the start:
+
+    {"meta": {"mix": "exam-end", "users": 2000, "tests": 60, "attempts_per_user": 8, "seed": 7}}
+    {"t": 0.042, "method": "GET", "path": "/api/tests", "route": "/api/tests", "user": "user00042"}
+    {"t": 0.051, "method": "POST", "path": "/api/tests/test003/submit", "route": "/api/tests/<test_id>/submit",
+     "user": "user01337", "json": {"answers": {"0": "A"}, "timeTaken": 5400}}
+
+`generate` builds a trace from a traffic mix on top of the seed_data.py dataset:
+
+    steady             students browsing: dashboard, tests, lectures, materials, results
+    exam-end           steady traffic plus a live mock ending: --students submissions
+                       bunched towards the end of --spike-window, a few double
+                       submits, then everyone opens their result and the leaderboard
+    leaderboard-storm  steady traffic plus --students students refreshing one
+                       leaderboard every few seconds for --spike-window seconds
+
+`replay` sends a trace open-loop (each request at its scheduled time, scaled by
+--speed) from --concurrency client threads, either in-process through the WSGI
+test client with the in-memory Firestore (--target wsgi) or over HTTP to a
+server such as `gunicorn ... fake_app:app` (--target http://127.0.0.1:8000).
+It prints throughput, latency percentiles and a latency histogram per route,
+plus the mean number of requests in flight (Little's law), which is the number
+of sync gunicorn workers the server needs to keep up with that traffic.
+There is no Cloud Storage bucket behind the in-memory Firestore, so material
+downloads answer 503 (storage unavailable) in both targets; they are counted
+under that route's server errors.
+
+Usage:
+    python benchmarks/replay_traffic.py generate --mix exam-end --duration 120 --rate 20 -o exam.jsonl
+    python benchmarks/replay_traffic.py replay exam.jsonl [--target wsgi|URL] [--concurrency 32] [--speed 1]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+from fake_firestore import FakeFirestore  # noqa: E402
+from seed_data import DEFAULT_SCALE, make_answers, seed_dataset  # noqa: E402
+
+# (weight, method, route); <placeholders> are filled per request
+BROWSING_MIX = [
+    (18, 'GET', '/api/tests'),
+    (10, 'GET', '/api/user/profile'),
+    (10, 'GET', '/api/user/stats'),
+    (8, 'GET', '/api/courses'),
+    (8, 'GET', '/api/courses/<course_id>/lectures'),
+    (6, 'GET', '/api/materials'),
+    (3, 'GET', '/api/material/<material_id>/download'),
+    (8, 'GET', '/api/user/test-attempts'),
+    (3, 'GET', '/api/user/test-attempts/<attempt_id>'),
+    (6, 'GET', '/api/tests/<test_id>/check-attempt'),
+    (4, 'GET', '/api/tests/<test_id>'),
+    (6, 'GET', '/api/student/leaderboard/<test_id>'),
+    (3, 'GET', '/api/doubts'),
+    (2, 'POST', '/api/tests/<test_id>/submit'),
+]
+
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+# --- Trace generation ---
+
+class TraceBuilder:
+    def __init__(self, fs, data, rng):
+        self.fs = fs
+        self.data = data
+        self.rng = rng
+        self.records = []
+        self.active_tests = [t for t in data['tests'] if fs.peek(f'tests/{t}').get('isActive')]
+        self.attempted_by_user = {}
+        for user_id, test_id in data['attempted']:
+            self.attempted_by_user.setdefault(user_id, []).append(test_id)
+        self.questions = {}
+
+    def add(self, t, method, route, user_id, **params):
+        path = route
+        for name, value in params.items():
+            path = path.replace(f'<{name}>', value)
+        record = {'t': round(t, 3), 'method': method, 'path': path, 'route': route, 'user': user_id}
+        if route.endswith('/submit'):
+            record['json'] = self.submission_body(params['test_id'])
+        self.records.append(record)
+
+    def submission_body(self, test_id):
+        if test_id not in self.questions:
+            self.questions[test_id] = self.fs.peek(f'tests/{test_id}')['questions']
+        return {'answers': make_answers(self.rng, self.questions[test_id]),
+                'timeTaken': self.rng.randint(1200, 10800)}
+
+    def take_unattempted(self, user_id, test_id=None):
+        remaining = [t for t in self.data['unattempted'][user_id] if t in self.active_tests]
+        if test_id is None:
+            test_id = self.rng.choice(remaining) if remaining else None
+        if test_id in remaining:
+            self.data['unattempted'][user_id].remove(test_id)
+            self.attempted_by_user.setdefault(user_id, []).append(test_id)
+            return test_id
+        return None
+
+    def browsing_request(self, t, user_id):
+        rng = self.rng
+        weights = [w for w, _, _ in BROWSING_MIX]
+        _, method, route = rng.choices(BROWSING_MIX, weights=weights)[0]
+        params = {}
+        if '<course_id>' in route:
+            params['course_id'] = rng.choice(self.data['courses'])
+        if '<material_id>' in route:
+            params['material_id'] = rng.choice(self.data['materials'])
+        if '<attempt_id>' in route:
+            attempted = self.attempted_by_user.get(user_id)
+            if not attempted:
+                return self.add(t, 'GET', '/api/user/test-attempts', user_id)
+            params['attempt_id'] = f'{user_id}_{rng.choice(attempted)}'
+        if route.endswith('/submit'):
+            test_id = self.take_unattempted(user_id)
+            if test_id is None:
+                return self.add(t, 'GET', '/api/tests', user_id)
+            params['test_id'] = test_id
+        elif '<test_id>' in route:
+            # Popular mocks get most of the traffic
+            params['test_id'] = rng.choices(self.active_tests, weights=[1 / (i + 1) for i in range(len(self.active_tests))])[0]
+        self.add(t, method, route, user_id, **params)
+
+    def steady(self, duration, rate):
+        t = 0.0
+        while True:
+            t += self.rng.expovariate(rate)
+            if t >= duration:
+                break
+            self.browsing_request(t, self.rng.choice(self.data['users']))
+
+    def exam_end(self, start, window, students):
+        rng = self.rng
+        # The live mock: the active test most students have not taken yet
+        test_id = max(self.active_tests[:10],
+                      key=lambda tid: sum(tid in remaining for remaining in self.data['unattempted'].values()))
+        candidates = [u for u, remaining in self.data['unattempted'].items() if test_id in remaining]
+        rng.shuffle(candidates)
+        for user_id in candidates[:students]:
+            # Submissions bunch up as the timer runs out
+            t = start + rng.triangular(0, window, window)
+            self.take_unattempted(user_id, test_id)
+            self.add(t, 'POST', '/api/tests/<test_id>/submit', user_id, test_id=test_id)
+            if rng.random() < 0.03:  # double click / client retry
+                self.add(t + rng.uniform(0.05, 0.5), 'POST', '/api/tests/<test_id>/submit', user_id, test_id=test_id)
+            self.add(t + rng.uniform(1, 5), 'GET', '/api/user/test-attempts/<attempt_id>', user_id,
+                     attempt_id=f'{user_id}_{test_id}')
+            if rng.random() < 0.7:
+                self.add(t + rng.uniform(5, 60), 'GET', '/api/student/leaderboard/<test_id>', user_id,
+                         test_id=test_id)
+        return test_id
+
+    def leaderboard_storm(self, start, window, students):
+        rng = self.rng
+        test_id = self.active_tests[0]
+        for user_id in rng.sample(self.data['users'], min(students, len(self.data['users']))):
+            t = start + rng.uniform(0, 10)
+            while t < start + window:
+                self.add(t, 'GET', '/api/student/leaderboard/<test_id>', user_id, test_id=test_id)
+                t += rng.uniform(3, 15)
+        return test_id
+
+
+def generate(args):
+    rng = random.Random(args.seed)
+    fs = FakeFirestore()
+    data = seed_dataset(fs, users=args.users, tests=args.tests, attempts_per_user=args.attempts_per_user,
+                        seed=args.seed)
+    builder = TraceBuilder(fs, data, rng)
+    builder.steady(args.duration, args.rate)
+
+    spike_at = args.duration * args.spike_at
+    window = min(args.spike_window, args.duration - spike_at)
+    if args.mix == 'exam-end':
+        test_id = builder.exam_end(spike_at, window, args.students)
+        print(f"Exam ends for {test_id} between t={spike_at:.0f}s and t={spike_at + window:.0f}s")
+    elif args.mix == 'leaderboard-storm':
+        test_id = builder.leaderboard_storm(spike_at, window, args.students)
+        print(f"Leaderboard storm on {test_id} between t={spike_at:.0f}s and t={spike_at + window:.0f}s")
+
+    builder.records.sort(key=lambda r: r['t'])
+    meta = {'mix': args.mix, 'users': args.users, 'tests': args.tests,
+            'attempts_per_user': args.attempts_per_user, 'seed': args.seed}
+    with open(args.output, 'w') as f:
+        f.write(json.dumps({'meta': meta}) + '\n')
+        for record in builder.records:
+            f.write(json.dumps(record) + '\n')
+    print(f"Wrote {len(builder.records)} requests over {args.duration:.0f}s to {args.output}")
+
+
+# --- Replay ---
+
+def load_trace(path, max_requests=None):
+    meta = {}
+    records = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'meta' in record:
+                meta = record['meta']
+                continue
+            records.append(record)
+            if max_requests and len(records) >= max_requests:
+                break
+    return meta, records
+
+
+def make_wsgi_sender(meta, latency):
+    import bench_scenarios
+    bench_scenarios.prepare(argparse.Namespace(
+        users=meta.get('users', DEFAULT_SCALE['users']),
+        tests=meta.get('tests', DEFAULT_SCALE['tests']),
+        attempts_per_user=meta.get('attempts_per_user', DEFAULT_SCALE['attempts_per_user']),
+        grants=DEFAULT_SCALE['grants'], questions=DEFAULT_SCALE['questions'],
+        seed=meta.get('seed', 7), latency=latency,
+    ))
+    local = threading.local()
+
+    def send(record):
+        if not hasattr(local, 'client'):
+            local.client = bench_scenarios.backend.app.test_client()
+        response = local.client.open(record['path'], method=record['method'], json=record.get('json'),
+                                     headers={'Authorization': f"Bearer {record['user']}"})
+        response.close()
+        return response.status_code
+
+    return send
+
+
+def make_http_sender(base_url):
+    import requests
+    local = threading.local()
+
+    def send(record):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        try:
+            response = local.session.request(record['method'], base_url.rstrip('/') + record['path'],
+                                             json=record.get('json'), timeout=30,
+                                             headers={'Authorization': f"Bearer {record['user']}"})
+            return response.status_code
+        except requests.RequestException:
+            return 599
+
+    return send
+
+
+def replay(records, send, concurrency, speed):
+    results = []  # (route, status, latency seconds, lag seconds)
+    lock = threading.Lock()
+    cursor = iter(records)
+    start = time.perf_counter() + 0.5
+
+    def worker():
+        while True:
+            with lock:
+                record = next(cursor, None)
+            if record is None:
+                return
+            scheduled = start + record['t'] / speed
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            sent = time.perf_counter()
+            status = send(record)
+            done = time.perf_counter()
+            with lock:
+                results.append((record['route'], status, done - sent, max(0.0, sent - scheduled)))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))]
+
+
+def histogram(latencies_ms):
+    counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+    for value in latencies_ms:
+        index = next((i for i, bound in enumerate(LATENCY_BUCKETS_MS) if value <= bound), len(LATENCY_BUCKETS_MS))
+        counts[index] += 1
+    return counts
+
+
+def report(results, wall_seconds):
+    by_route = {}
+    for route, status, latency, _ in results:
+        by_route.setdefault(route, []).append((status, latency * 1000))
+
+    summary = {}
+    print(f"\n{'route':42}{'n':>6}{'rps':>7}{'4xx':>5}{'5xx':>5}{'p50':>8}{'p95':>8}{'p99':>8}{'max':>8}")
+    for route in sorted(by_route, key=lambda r: -len(by_route[r])):
+        rows = by_route[route]
+        latencies = sorted(ms for _, ms in rows)
+        summary[route] = {
+            'requests': len(rows),
+            'rps': round(len(rows) / wall_seconds, 2),
+            'client_errors': sum(400 <= s < 500 for s, _ in rows),
+            'server_errors': sum(s >= 500 for s, _ in rows),
+            'p50_ms': round(percentile(latencies, 50), 1),
+            'p95_ms': round(percentile(latencies, 95), 1),
+            'p99_ms': round(percentile(latencies, 99), 1),
+            'max_ms': round(latencies[-1], 1),
+            'histogram': histogram(latencies),
+        }
+        s = summary[route]
+        print(f"{route:42}{s['requests']:6}{s['rps']:7.1f}{s['client_errors']:5}{s['server_errors']:5}"
+              f"{s['p50_ms']:8.1f}{s['p95_ms']:8.1f}{s['p99_ms']:8.1f}{s['max_ms']:8.1f}")
+
+    bounds = [f'≤{b}' for b in LATENCY_BUCKETS_MS] + [f'>{LATENCY_BUCKETS_MS[-1]}']
+    print(f"\nLatency histogram (ms)\n{'route':42}" + ''.join(f'{b:>7}' for b in bounds))
+    for route, s in summary.items():
+        print(f"{route:42}" + ''.join(f'{c:7}' for c in s['histogram']))
+
+    latencies = [latency for _, _, latency, _ in results]
+    lags = sorted(lag * 1000 for _, _, _, lag in results)
+    in_flight = sum(latencies) / wall_seconds if wall_seconds else 0
+    print(f"\n{len(results)} requests in {wall_seconds:.1f}s = {len(results) / wall_seconds:.1f} req/s; "
+          f"mean in flight {in_flight:.1f} (≈ sync gunicorn workers needed), "
+          f"dispatch lag p95 {percentile(lags, 95):.0f}ms")
+    if percentile(lags, 95) > 100:
+        print("⚠️ Requests left late: raise --concurrency, or the server is saturated")
+    return {'routes': summary, 'requests': len(results), 'seconds': round(wall_seconds, 2),
+            'mean_in_flight': round(in_flight, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    gen = commands.add_parser('generate', help='Write a synthetic trace')
+    gen.add_argument('--mix', choices=['steady', 'exam-end', 'leaderboard-storm'], default='exam-end')
+    gen.add_argument('--duration', type=float, default=120, help='Trace length in seconds')
+    gen.add_argument('--rate', type=float, default=20, help='Background requests per second')
+    gen.add_argument('--students', type=int, default=400, help='Students in the spike')
+    gen.add_argument('--spike-at', type=float, default=0.3, help='Spike start as a fraction of --duration')
+    gen.add_argument('--spike-window', type=float, default=60, help='Spike length in seconds')
+    gen.add_argument('--users', type=int, default=DEFAULT_SCALE['users'])
+    gen.add_argument('--tests', type=int, default=DEFAULT_SCALE['tests'])
+    gen.add_argument('--attempts-per-user', type=int, default=DEFAULT_SCALE['attempts_per_user'])
+    gen.add_argument('--seed', type=int, default=7)
+    gen.add_argument('-o', '--output', required=True)
+
+    rep = commands.add_parser('replay', help='Replay a trace as concurrent load')
+    rep.add_argument('trace')
+    rep.add_argument('--target', default='wsgi', help="'wsgi' (in-process) or a base URL")
+    rep.add_argument('--latency', type=float, default=0.008, help='Simulated Firestore RPC latency (wsgi target)')
+    rep.add_argument('--concurrency', type=int, default=32, help='Client threads')
+    rep.add_argument('--speed', type=float, default=1.0, help='Replay speed multiplier')
+    rep.add_argument('--max-requests', type=int)
+    rep.add_argument('--save', help='Write the per-route summary as JSON')
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        generate(args)
+        return
+
+    meta, records = load_trace(args.trace, args.max_requests)
+    if args.target == 'wsgi':
+        os.environ.setdefault('LOG_LEVEL', 'ERROR')
+        send = make_wsgi_sender(meta, args.latency)
+    else:
+        send = make_http_sender(args.target)
+    print(f"Replaying {len(records)} requests ({meta.get('mix', 'unknown')} mix) at {args.speed}x "
+          f"against {args.target} with {args.concurrency} client threads")
+    results, wall_seconds = replay(records, send, args.concurrency, args.speed)
+    summary = report(results, wall_seconds)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'meta': meta, 'args': vars(args), **summary}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Seed generators for the in-memory Firestore used by the benchmarks.
+
+Documents have the shapes the admin panel and backend.py write: users with
+plan / enrolledCourses / stats, GATE-style tests with 65 questions, attempts at
+testAttempts/<userId>_<testId>, admin test grants, courses with lectures, study
+materials and doubts. Attempts follow a long-tailed distribution, so the most
+popular mocks have leaderboards with thousands of rows.
+"""
+
+import random
+from datetime import datetime, timedelta
+
+SUBJECTS = [
+    'Remote Sensing',
+    'Geographic Information System (GIS)',
+    'Image Processing',
+    'Global Positioning System (GPS)',
+    'Surveying',
+    'Engineering Mathematics',
+    'General Aptitude',
+]
+OPTIONS = ['A', 'B', 'C', 'D']
+
+# Default scale: roughly one exam season for a single cohort
+DEFAULT_SCALE = {
+    'users': 2000,
+    'tests': 60,
+    'attempts_per_user': 8,
+    'grants': 300,
+    'questions': 65,
+}
+
+
+def make_questions(rng, count):
+    questions = []
+    for i in range(count):
+        marks = 1 if i < count // 2 else 2
+        kind = rng.choices(['mcq', 'msq', 'numerical'], weights=[6, 2, 2])[0]
+        q = {
+            'type': kind,
+            'question': f'Q{i + 1}. ' + 'Lorem ipsum dolor sit amet ' * 6,
+            'marks': marks,
+            'explanation': 'Because ' + 'consectetur adipiscing elit ' * 4,
+        }
+        if kind == 'mcq':
+            q.update(options=[f'{o}) option text' for o in OPTIONS], correctAnswer=rng.choice(OPTIONS),
+                     negativeMarks=round(marks / 3, 2))
+        elif kind == 'msq':
+            q.update(options=[f'{o}) option text' for o in OPTIONS],
+                     correctAnswers=rng.sample(OPTIONS, rng.randint(1, 3)), negativeMarks=0)
+        else:
+            q.update(correctAnswer=str(round(rng.uniform(0, 100), 2)), tolerance='0.05', negativeMarks=0)
+        questions.append(q)
+    return questions
+
+
+def make_answers(rng, questions):
+    answers = {}
+    for i, q in enumerate(questions):
+        if rng.random() < 0.15:
+            continue  # unattempted
+        if q['type'] == 'mcq':
+            answers[str(i)] = q['correctAnswer'] if rng.random() < 0.55 else rng.choice(OPTIONS)
+        elif q['type'] == 'msq':
+            answers[str(i)] = q['correctAnswers'] if rng.random() < 0.4 else rng.sample(OPTIONS, 2)
+        else:
+            answers[str(i)] = q['correctAnswer'] if rng.random() < 0.4 else '1.5'
+    return answers
+
+
+def seed_dataset(fs, users=2000, tests=60, attempts_per_user=8, grants=300, questions=65, seed=7):
+    """
+    Fills `fs` (a FakeFirestore) and returns the generated IDs:
+        {'users': [...], 'tests': [...], 'attempted': {(uid, tid), ...},
+         'unattempted': {uid: [tid, ...]}, 'materials': [...], 'courses': [...]}
+    """
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+
+    course_ids = []
+    material_ids = []
+    for c, subject in enumerate(SUBJECTS):
+        course_id = f'course{c}'
+        course_ids.append(course_id)
+        fs.seed(f'courses/{course_id}', {'name': subject, 'description': f'{subject} for GATE GE', 'order': c})
+        for n in range(20):
+            fs.seed(f'courses/{course_id}/lectures/lec{n}', {
+                'title': f'{subject} lecture {n + 1}', 'order': n + 1, 'isFree': n < 2,
+                'youtubeId': f'yt{c}{n}', 'duration': 1800
+            })
+        for n in range(10):
+            material_id = f'mat{c}_{n}'
+            material_ids.append(material_id)
+            fs.seed(f'materials/{material_id}', {
+                'title': f'{subject} notes {n + 1}', 'subject': subject,
+                'access': 'free' if n == 0 else 'premium',
+                'storageUrl': f'materials/{material_id}.pdf', 'downloads': rng.randint(0, 500),
+                'uploadedAt': now - timedelta(days=n)
+            })
+
+    test_ids = []
+    test_docs = {}
+    for t in range(tests):
+        test_id = f'test{t:03d}'
+        test_ids.append(test_id)
+        subject = 'Mock' if t % 5 == 0 else SUBJECTS[t % len(SUBJECTS)]
+        test_questions = make_questions(rng, questions)
+        test_docs[test_id] = {
+            'name': f'{subject} Test {t + 1}', 'subject': subject,
+            'type': 'mock' if subject == 'Mock' else 'subject', 'duration': 180,
+            'totalMarks': sum(q['marks'] for q in test_questions), 'isActive': t % 17 != 16,
+            'access': 'free' if t % 10 == 0 else 'premium', 'questions': test_questions,
+            'questionCount': len(test_questions),
+            'createdAt': now - timedelta(days=tests - t)
+        }
+        fs.seed(f'tests/{test_id}', test_docs[test_id])
+
+    # Long tail: a few popular mocks collect most attempts
+    popularity = [1 / (rank + 1) for rank in range(tests)]
+    user_ids = [f'user{u:05d}' for u in range(users)]
+    attempted = set()
+    unattempted = {}
+    for u, user_id in enumerate(user_ids):
+        enrolled = rng.sample(SUBJECTS, rng.randint(0, 3))
+        if u % 7 == 0:
+            enrolled.append('Test Series Only')
+        plan = 'master' if u % 50 == 0 else ('premium' if enrolled else 'free')
+        chosen = set()
+        for _ in range(attempts_per_user):
+            chosen.add(rng.choices(test_ids, weights=popularity)[0])
+
+        percentage_sum = 0
+        for test_id in sorted(chosen):
+            test_data = test_docs[test_id]
+            correct = rng.randint(5, questions - 5)
+            wrong = rng.randint(0, questions - correct)
+            score = round(correct * 1.5 - wrong * 0.4, 2)
+            percentage = round(score / test_data['totalMarks'] * 100, 2)
+            percentage_sum += percentage
+            fs.seed(f'testAttempts/{user_id}_{test_id}', {
+                'userId': user_id, 'testId': test_id, 'testTitle': test_data['name'],
+                'subject': test_data['subject'], 'score': score, 'totalMarks': test_data['totalMarks'],
+                'percentage': percentage, 'correctAnswers': correct, 'wrongAnswers': wrong,
+                'unattempted': questions - correct - wrong, 'timeTaken': rng.randint(1200, 10800),
+                'submittedAt': now - timedelta(minutes=rng.randint(10, 60 * 24 * 30)),
+                'answers': make_answers(rng, test_data['questions']),
+                'postProcessingPending': False,
+                'postProcessed': {'userStats': True, 'leaderboard': True},
+            })
+            attempted.add((user_id, test_id))
+        unattempted[user_id] = [t for t in test_ids if t not in chosen]
+
+        fs.seed(f'users/{user_id}', {
+            'uid': user_id, 'name': f'Student {u}', 'email': f'{user_id}@example.com',
+            'plan': plan, 'enrolledCourses': enrolled, 'createdAt': now - timedelta(days=90),
+            'stats': {
+                'testsAttempted': len(chosen), 'totalPercentageSum': percentage_sum,
+                'avgScore': round(percentage_sum / len(chosen), 2) if chosen else 0,
+                'videosWatched': rng.randint(0, 80), 'doubtsAsked': u % 4,
+            }
+        })
+        for d in range(u % 4):
+            fs.seed(f'doubts/d{u}_{d}', {
+                'userId': user_id, 'userName': f'Student {u}', 'subject': rng.choice(SUBJECTS),
+                'question': 'How do I ' + 'solve this ' * 10, 'status': 'open',
+                'createdAt': now - timedelta(days=d),
+                'conversation': [{'sender': 'student', 'text': 'Question text', 'timestamp': now}]
+            })
+
+    for n in range(grants):
+        fs.seed(f'testAccessGrants/grant{n}', {
+            'userId': rng.choice(user_ids), 'testId': rng.choice(test_ids),
+            'isActive': rng.random() < 0.9, 'grantedAt': now - timedelta(days=rng.randint(0, 60))
+        })
+
+    return {
+        'users': user_ids,
+        'tests': test_ids,
+        'attempted': attempted,
+        'unattempted': unattempted,
+        'materials': material_ids,
+        'courses': course_ids,
+    }
@@ -1,4 +1,4 @@
-const CACHE_VERSION = 'geocatalyst-v1.0.0'; // Update this version with each deployment
+const CACHE_VERSION = 'geocatalyst-v1.0.1'; // Update this version with each deployment
 
 self.addEventListener('install', (event) => {
     console.log('Service Worker: Installing...');
@@ -23,18 +23,29 @@ self.addEventListener('activate', (event) => {
 });
 
 self.addEventListener('fetch', (event) => {
-    // Network-first strategy for your app
+    // Only GETs can be cached; submissions and other writes go straight to the network
+    if (event.request.method !== 'GET') {
+        return;
+    }
+
+    // Network-first strategy for your app.
+    // API responses carry an ETag and "Cache-Control: private, no-cache", so this
+    // fetch goes through the browser's HTTP cache: it revalidates with
+    // If-None-Match and an unchanged response comes back as a 304 without a body.
+    // The copy in CACHE_VERSION is only the offline fallback.
     event.respondWith(
         fetch(event.request)
             .then(response => {
-                // Clone the response
-                const responseToCache = response.clone();
-                
-                // Cache the fetched response
-                caches.open(CACHE_VERSION).then(cache => {
-                    cache.put(event.request, responseToCache);
-                });
-                
+                if (response.ok) {
+                    // Clone the response
+                    const responseToCache = response.clone();
+
+                    // Cache the fetched response
+                    caches.open(CACHE_VERSION).then(cache => {
+                        cache.put(event.request, responseToCache);
+                    });
+                }
+
                 return response;
             })
             .catch(() => {